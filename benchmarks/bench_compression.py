@@ -0,0 +1,51 @@
+"""Benchmark of the GeoCore object content encodings.
+
+Serializes realistic GeoCore item records (see bench_serializers.py) with the compact serializer,
+then encodes them with encode_body() as identity, gzip (levels 1, 6 and 9) and zstd when zstandard
+is installed. Reports the stored bytes per record, the bytes saved and the CPU time per record to
+encode and to decode the objects, and the size of the lastRun.txt manifest of the same records.
+
+Usage: python benchmarks/bench_compression.py [number of records]
+"""
+import gzip
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stac-to-geocore'))
+from bench_serializers import make_records  # noqa: E402
+from serializers import decode_body, encode_body, serialize_json, zstandard  # noqa: E402
+
+
+def best_time(function, repeat=3):
+    best = None
+    for _ in range(repeat):
+        started = time.process_time()
+        function()
+        seconds = time.process_time() - started
+        best = seconds if best is None else min(best, seconds)
+    return best
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    bodies = [serialize_json(record) for record in make_records(count)]
+    raw_size = sum(len(body) for body in bodies)
+    cases = [('identity', None), ('gzip', 1), ('gzip', 6), ('gzip', 9)]
+    if zstandard is not None:
+        cases += [('zstd', 3), ('zstd', 9)]
+    for encoding, level in cases:
+        encoded = [encode_body(body, encoding=encoding, level=level)[0] for body in bodies]
+        size = sum(len(body) for body in encoded)
+        encode_seconds = best_time(lambda: [encode_body(body, encoding=encoding, level=level) for body in bodies])
+        decode_seconds = best_time(lambda: [decode_body(body) for body in encoded])
+        name = encoding if level is None else f'{encoding} -{level}'
+        print(f'{name:>10}: {size / count:7,.0f} bytes/record ({size / raw_size:4.0%}), '
+              f'{(raw_size - size) / count:7,.0f} bytes saved/record, '
+              f'encode {encode_seconds / count * 1e6:6.1f} us/record, decode {decode_seconds / count * 1e6:6.1f} us/record')
+    keys = ''.join(f"ccmeo-coll-{i % 20}-item-{i:08d}.geojson\n" for i in range(count)).encode('utf-8')
+    print(f'lastRun.txt: {len(keys):,} bytes, gzip {len(gzip.compress(keys, mtime=0)):,} bytes')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,45 @@
+"""Micro-benchmark of the GeoCore options de-duplication.
+
+Compares the previous pairwise list comprehension with stac_to_geocore.dedup_options()
+on a record with 1,000 options, a quarter of them duplicated.
+
+Usage: python benchmarks/bench_dedup.py [number of options]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stac-to-geocore'))
+from stac_to_geocore import dedup_options  # noqa: E402
+
+
+def make_options(count):
+    options = []
+    for i in range(count):
+        # every fourth option repeats an earlier one
+        n = i // 2 if i % 4 == 3 else i
+        options.append({
+            'url': f'https://datacube.services.geo.ca/api/collections/coll/items/item-{n}/asset.tif',
+            'protocol': 'Unknown',
+            'name': {'en': f'Asset - COG {n}', 'fr': f'Asset - COG {n}'},
+            'description': {'en': 'Data;TIFF;eng', 'fr': 'Data;TIFF;fra'},
+        })
+    return options
+
+
+def pairwise_dedup(options_list):
+    return [i for n, i in enumerate(options_list) if i not in options_list[n + 1:]]
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 1000
+    options = make_options(count)
+    assert pairwise_dedup(options) == dedup_options(options)
+    for name, function in (('pairwise', pairwise_dedup), ('dedup_options', dedup_options)):
+        runs = 5 if name == 'pairwise' else 200
+        seconds = min(timeit.repeat(lambda: function(options), number=runs, repeat=3)) / runs
+        print(f'{name:>14}: {seconds * 1000:8.3f} ms per record of {count} options')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,62 @@
+"""Benchmark of the page geometry stage.
+
+Builds the GeoCore polygon coordinates and WKT of synthetic bboxes one record at a time (as
+to_features_geometry() and item_to_features_properties() do) and one page at a time with
+geometry_batch.page_geometries(), with and without numpy.
+
+Usage: python benchmarks/bench_geometry.py [page size] [number of pages]
+"""
+import contextlib
+import io
+import os
+import random
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stac-to-geocore'))
+import geometry_batch  # noqa: E402
+
+
+def make_pages(page_size, pages):
+    random.seed(0)
+    boxes = []
+    for _ in range(page_size * pages):
+        west, south = random.uniform(-141, -53), random.uniform(42, 83)
+        boxes.append([west, south, west + random.uniform(0.01, 2), south + random.uniform(0.01, 1)])
+    return [boxes[i:i + page_size] for i in range(0, len(boxes), page_size)]
+
+
+def per_record(page):
+    results = []
+    for bbox in page:
+        west, south, east, north = [round(coord, 2) for coord in bbox]
+        coordinates = [[[west, south], [east, south], [east, north], [west, north], [west, south]]]
+        west, south, east, north = [round(coord, 2) for coord in bbox]
+        wkt = f"POLYGON(({west} {south}, {east} {south}, {east} {north}, {west} {north}, {west} {south}))"
+        results.append((coordinates, wkt))
+    return results
+
+
+def main():
+    page_size = int(sys.argv[1]) if len(sys.argv) > 1 else 100
+    pages = make_pages(page_size, int(sys.argv[2]) if len(sys.argv) > 2 else 500)
+    count = page_size * len(pages)
+    numpy = geometry_batch.np
+    cases = [('per record', per_record, numpy), ('page, python', geometry_batch.page_geometries, None)]
+    if numpy is not None:
+        cases.append(('page, numpy', geometry_batch.page_geometries, numpy))
+    for name, function, np in cases:
+        geometry_batch.np = np
+        best = None
+        for _ in range(3):
+            started = time.perf_counter()
+            with contextlib.redirect_stdout(io.StringIO()):
+                for page in pages:
+                    function(page)
+            seconds = time.perf_counter() - started
+            best = seconds if best is None else min(best, seconds)
+        print(f'{name:>13}: {best * 1e6 / count:5.2f} us per bbox ({count} bboxes, pages of {page_size})')
+
+
+if __name__ == '__main__':
+    main()
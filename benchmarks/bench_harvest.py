@@ -0,0 +1,216 @@
+"""Offline end-to-end benchmark of lambda_handler.
+
+Starts the synthetic STAC API (stac_server.py) and a local S3 stand-in in child processes, then
+runs lambda_handler in this process and reports the records per second, the HTTP and S3 calls,
+the bytes transferred and the peak memory of the harvest. Nothing leaves the machine.
+
+The S3 stand-in is a moto server reached through S3_ENDPOINT_URL. With --s3 mock, moto mocks S3
+inside this process instead (no port needed, but the stored objects then count in the peak memory).
+Run one configuration per process: the peak memory is the peak of the whole process.
+
+Usage: python benchmarks/bench_harvest.py [--collections 10] [--items 1000] [--links 5] [--assets 3]
+                                          [--page-size 30] [--max-limit 1000] [--no-fields] [--runs 1] [--s3 server|mock]
+                                          [--env HARVEST_ENGINE=async --env ...]
+"""
+import argparse
+import json
+import multiprocessing
+import os
+import socket
+import sys
+import time
+import urllib.request
+
+BENCHMARKS_DIR = os.path.dirname(os.path.abspath(__file__))
+APP_DIR = os.path.join(BENCHMARKS_DIR, '..', 'stac-to-geocore')
+sys.path.insert(0, BENCHMARKS_DIR)
+import stac_server  # noqa: E402
+
+TEMPLATE_BUCKET = 'benchmark-geocore-template'
+GEOCORE_BUCKET = 'benchmark-geocore-json-to-geojson'
+TEMPLATE_NAME = 'geocore-format-null-template.json'
+# The fields of the GeoCore null template that the mappers fill in
+NULL_TEMPLATE = {'type': 'FeatureCollection', 'features': [{
+    'type': 'Feature',
+    'geometry': {'type': None, 'coordinates': None},
+    'properties': {
+        'id': None, 'title': {'en': None, 'fr': None}, 'description': {'en': None, 'fr': None},
+        'keywords': {'en': None, 'fr': None}, 'topicCategory': None,
+        'date': {'published': {'text': None, 'date': None}, 'created': {'text': None, 'date': None},
+                 'revision': {'text': None, 'date': None}},
+        'type': None, 'geometry': None, 'temporalExtent': {'begin': None, 'end': None}, 'refSys': None,
+        'status': None, 'maintenance': None, 'metadataStandard': {'en': 'ISO', 'fr': 'ISO'},
+        'parentIdentifier': None, 'contact': [], 'options': [], 'useLimits': {'en': None, 'fr': None},
+        'spatialRepresentation': None, 'sourceSystemName': None, 'graphicOverview': [{'overviewFileName': None}],
+    },
+}]}
+
+
+class LambdaContext:
+    function_name = 'stac-to-geocore-benchmark'
+    aws_request_id = 'benchmark'
+
+    def get_remaining_time_in_millis(self):
+        return 900000
+
+
+class S3CallCounter:
+    """Count the S3 calls and the request body bytes of every boto3 client of the default session"""
+
+    def __init__(self):
+        self.calls = {}
+        self.bytes = 0
+
+    def __call__(self, model, params, **kwargs):
+        self.calls[model.name] = self.calls.get(model.name, 0) + 1
+        body = params.get('body')
+        if isinstance(body, (bytes, bytearray)):
+            self.bytes += len(body)
+        elif hasattr(body, 'seek'):
+            # botocore wraps the PUT bodies in file objects to compute their checksum
+            position = body.tell()
+            body.seek(0, os.SEEK_END)
+            self.bytes += body.tell() - position
+            body.seek(position)
+
+
+def free_port():
+    with socket.socket() as s:
+        s.bind(('127.0.0.1', 0))
+        return s.getsockname()[1]
+
+
+def wait_for(url, timeout=30):
+    deadline = time.monotonic() + timeout
+    while True:
+        try:
+            urllib.request.urlopen(url, timeout=1).close()
+            return
+        except OSError:
+            if time.monotonic() > deadline:
+                raise
+            time.sleep(0.1)
+
+
+def run_moto_server(port):
+    import logging
+    from moto.server import ThreadedMotoServer
+    logging.getLogger('werkzeug').setLevel(logging.ERROR)
+    server = ThreadedMotoServer(ip_address='127.0.0.1', port=port, verbose=False)
+    server.start()
+    while True:
+        time.sleep(3600)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--collections', type=int, default=10)
+    parser.add_argument('--items', type=int, default=1000, help='items per collection')
+    parser.add_argument('--links', type=int, default=5, help='links per item')
+    parser.add_argument('--assets', type=int, default=3, help='assets per item')
+    parser.add_argument('--page-size', type=int, default=30)
+    parser.add_argument('--collections-page-size', type=int, default=100)
+    parser.add_argument('--max-limit', type=int, default=1000, help='largest page size of the STAC API searches')
+    parser.add_argument('--no-fields', action='store_true', help='the STAC API does not conform to the fields extension')
+    parser.add_argument('--runs', type=int, default=1, help='harvests in a row, each run replaces the previous one')
+    parser.add_argument('--s3', choices=['server', 'mock'], default='server')
+    parser.add_argument('--env', action='append', default=[], help='KEY=VALUE environment variable of the harvest')
+    parser.add_argument('--json', action='store_true', help='print the report as json')
+    args = parser.parse_args()
+
+    context = multiprocessing.get_context('spawn')
+    children = []
+    stac_port = free_port()
+    stac = context.Process(target=stac_server.serve, args=(stac_port,), daemon=True, kwargs={
+        'collections': args.collections, 'items': args.items, 'links': args.links, 'assets': args.assets,
+        'page_size': args.page_size, 'collections_page_size': args.collections_page_size, 'max_limit': args.max_limit,
+        'fields': not args.no_fields})
+    stac.start()
+    children.append(stac)
+    api_root = f'http://127.0.0.1:{stac_port}'
+
+    os.environ.update({
+        'GEOCORE_TEMPLATE_BUCKET_NAME': TEMPLATE_BUCKET, 'GEOCORE_TEMPLATE_NAME': TEMPLATE_NAME,
+        'GEOCORE_TO_PARQUET_BUCKET_NAME': GEOCORE_BUCKET, 'STAC_API_ROOT': api_root,
+        'ROOT_NAME': 'Synthetic datacube / Cube de données synthétique', 'SOURCE': 'benchmark',
+        'SOURCESYSTEMNAME': 'benchmark-datacube', 'HARVEST_SELF_INVOKE': 'false',
+        'AWS_DEFAULT_REGION': 'us-east-1', 'AWS_ACCESS_KEY_ID': 'benchmark', 'AWS_SECRET_ACCESS_KEY': 'benchmark',
+    })
+    for assignment in args.env:
+        key, value = assignment.split('=', 1)
+        os.environ[key] = value
+
+    mock = None
+    if args.s3 == 'server':
+        s3_port = free_port()
+        moto = context.Process(target=run_moto_server, args=(s3_port,), daemon=True)
+        moto.start()
+        children.append(moto)
+        os.environ['S3_ENDPOINT_URL'] = f'http://127.0.0.1:{s3_port}'
+        wait_for(f'http://127.0.0.1:{s3_port}/moto-api/')
+    else:
+        from moto import mock_aws
+        mock = mock_aws()
+        mock.start()
+    wait_for(f'{api_root}/_stats')
+
+    try:
+        import boto3
+        boto3.setup_default_session()
+        s3_counter = S3CallCounter()
+        boto3.DEFAULT_SESSION.events.register('before-call.s3', s3_counter)
+        s3 = boto3.client('s3', endpoint_url=os.environ.get('S3_ENDPOINT_URL'))
+        for bucket in (TEMPLATE_BUCKET, GEOCORE_BUCKET):
+            s3.create_bucket(Bucket=bucket)
+        s3.put_object(Bucket=TEMPLATE_BUCKET, Key=TEMPLATE_NAME, Body=json.dumps(NULL_TEMPLATE).encode('utf-8'))
+        s3_counter.calls.clear()
+        s3_counter.bytes = 0
+
+        sys.path.insert(0, APP_DIR)
+        cwd = os.getcwd()
+        import app
+        from memory_usage import peak_rss_mb
+        os.chdir(cwd)
+
+        records = 1 + args.collections * (args.items + 1)
+        timings = []
+        for _ in range(args.runs):
+            started = time.perf_counter()
+            app.lambda_handler({}, LambdaContext())
+            timings.append(time.perf_counter() - started)
+        os.chdir(cwd)
+        with urllib.request.urlopen(f'{api_root}/_stats') as response:
+            http_stats = json.loads(response.read())
+    finally:
+        if mock is not None:
+            mock.stop()
+        for child in children:
+            child.terminate()
+
+    report = {
+        'records': records,
+        'seconds': [round(seconds, 3) for seconds in timings],
+        'records_per_second': round(records / min(timings), 1),
+        'http_requests': sum(stats['requests'] for stats in http_stats.values()),
+        'http_bytes': sum(stats['bytes'] for stats in http_stats.values()),
+        'http': http_stats,
+        's3_calls': sum(s3_counter.calls.values()),
+        's3_request_bytes': s3_counter.bytes,
+        's3': dict(sorted(s3_counter.calls.items())),
+        'peak_rss_mb': round(peak_rss_mb(), 1),
+        'env': args.env,
+    }
+    if args.json:
+        print(json.dumps(report, indent=2))
+        return
+    endpoints = ', '.join(f"{endpoint} {stats['requests']}" for endpoint, stats in sorted(http_stats.items()))
+    operations = ', '.join(f'{name} {count}' for name, count in report['s3'].items())
+    seconds = ', '.join(f'{s:.2f}' for s in report['seconds'])
+    print(f"\n{records} records ({args.collections} collections x {args.items} items), {args.runs} run(s)")
+    print(f"  throughput: {report['records_per_second']:,.1f} records/s, best of {seconds} s")
+    print(f"  STAC API:   {report['http_requests']} requests, {report['http_bytes'] / 1e6:.1f} MB ({endpoints})")
+    print(f"  S3:         {report['s3_calls']} calls, {report['s3_request_bytes'] / 1e6:.1f} MB sent ({operations})")
+    print(f"  memory:     {report['peak_rss_mb']} MB process peak RSS, all runs included")
+
+if __name__ == '__main__':
+    main()
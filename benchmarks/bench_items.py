@@ -0,0 +1,67 @@
+"""Benchmark of the item mapping throughput.
+
+Maps synthetic STAC items of one collection with item_to_features_properties(), first rebuilding
+the invariant properties for every item (as the mapper did before the per-collection item
+prototype), then reusing the prototype that CollectionIndex builds once per collection.
+
+Usage: python benchmarks/bench_items.py [number of items]
+"""
+import copy
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stac-to-geocore'))
+from collection_index import CollectionIndex  # noqa: E402
+from stac_to_geocore import (  # noqa: E402
+    contact, item_to_features_properties, maintenance, spatialRepresentation, status, topicCategory,
+    type_data, useLimits_en, useLimits_fr,
+)
+
+ROOT_NAME = 'CCMEO Datacube API / CCCOT Cube de données API'
+PARAMS = {
+    'root_name': ROOT_NAME, 'root_links': [], 'root_id': 'ccmeo', 'root_des': '', 'root_bbox': [-141, 41, -52, 84],
+    'source': 'ccmeo', 'status': status, 'maintenance': maintenance, 'useLimits_en': useLimits_en,
+    'useLimits_fr': useLimits_fr, 'spatialRepresentation': spatialRepresentation, 'contact': contact,
+    'type_data': type_data, 'topicCategory': topicCategory, 'sourceSystemName': 'ccmeo-datacube',
+}
+COLLECTION = {
+    'id': 'landcover', 'title': 'Land cover of Canada/Couverture terrestre du Canada',
+    'description': 'Land cover classification/Classification de la couverture terrestre',
+    'keywords': ['land cover', 'landsat', 'couverture terrestre', 'landsat'],
+    'extent': {'spatial': {'bbox': [[-141, 41, -52, 84]]}, 'temporal': {'interval': [['2010-01-01T00:00:00Z', None]]}},
+    'links': [],
+}
+PROPERTIES_TEMPLATE = {'date': {'published': {}, 'created': {}}, 'temporalExtent': {}}
+
+
+def make_item(i):
+    url = f'https://datacube.services.geo.ca/api/collections/landcover/items/landcover-{i}'
+    return {
+        'id': f'landcover-{i}', 'collection': 'landcover', 'bbox': [-120.5 + i % 10, 49.1, -119.5 + i % 10, 50.2],
+        'properties': {'datetime': f'{2010 + i % 10}-01-01T00:00:00Z', 'created': '2022-03-01T00:00:00Z'},
+        'links': [{'rel': rel, 'href': url, 'type': 'application/geo+json'} for rel in ('self', 'parent', 'collection', 'root')],
+        'assets': {'cog': {'href': url + '.tif', 'type': 'image/tiff; application=geotiff; profile=cloud-optimized', 'roles': ['data']}},
+    }
+
+
+def run(items, rebuild_prototype):
+    collection_index = CollectionIndex([COLLECTION])
+    started = time.perf_counter()
+    for item in items:
+        if rebuild_prototype:
+            collection_index = CollectionIndex(fields={'landcover': collection_index.get('landcover')})
+        item_to_features_properties(PARAMS, {'properties': copy.deepcopy(PROPERTIES_TEMPLATE)}, item, collection_index)
+    return len(items) / (time.perf_counter() - started)
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 10000
+    items = [make_item(i) for i in range(count)]
+    for name, rebuild_prototype in (('per item', True), ('per collection', False)):
+        rate = max(run(items, rebuild_prototype) for _ in range(3))
+        print(f'{name:>14}: {rate:10,.0f} items/s ({count} items of one collection)')
+
+
+if __name__ == '__main__':
+    main()
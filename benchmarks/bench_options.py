@@ -0,0 +1,56 @@
+"""Benchmark of the GeoCore options builders.
+
+Times item_links_to_properties_options, coll_links_to_properties_options,
+root_links_to_properties_options and assets_to_properties_options on a synthetic
+STAC item with many links and assets, and reports the cost per link or asset.
+
+Usage: python benchmarks/bench_options.py [number of links] [number of assets]
+"""
+import os
+import sys
+import timeit
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stac-to-geocore'))
+from stac_to_geocore import (  # noqa: E402
+    assets_to_properties_options, assets_type, coll_links_to_properties_options,
+    item_links_to_properties_options, root_links_to_properties_options,
+)
+
+ROOT_NAME = 'CCMEO Datacube API / CCCOT Cube de données API'
+RELS = ['self', 'root', 'parent', 'collection', 'child', 'item', 'items', 'data', 'license', 'derived_from',
+        'service-desc', 'service-doc', 'conformance', 'search', 'alternate']
+MEDIA_TYPES = list(assets_type) + ['application/octet-stream']
+ROLES = [['data'], ['thumbnail'], ['overview'], ['metadata'], ['data', 'overview']]
+
+
+def make_links(count):
+    return [{'rel': RELS[i % len(RELS)], 'href': f'https://datacube.services.geo.ca/api/link/{i}', 'title': f'Link {i}'}
+            for i in range(count)]
+
+
+def make_assets(count):
+    return {f'asset-{i}': {'href': f'https://datacube-prod-data-public.s3.ca-central-1.amazonaws.com/item/{i}.tif',
+                           'type': MEDIA_TYPES[i % len(MEDIA_TYPES)], 'roles': ROLES[i % len(ROLES)],
+                           'title': f'Asset {i}/Ressource {i}'}
+            for i in range(count)}
+
+
+def main():
+    links_count = int(sys.argv[1]) if len(sys.argv) > 1 else 200
+    assets_count = int(sys.argv[2]) if len(sys.argv) > 2 else 200
+    links = make_links(links_count)
+    assets = make_assets(assets_count)
+    cases = {
+        'item links': (lambda: item_links_to_properties_options(links, 'item-1', ROOT_NAME, 'coll-1', 'item'), links_count),
+        'collection links': (lambda: coll_links_to_properties_options(links, 'coll-1', ROOT_NAME, 'collection'), links_count),
+        'root links': (lambda: root_links_to_properties_options(links, 'root', ROOT_NAME, None, None, 'root'), links_count),
+        'assets': (lambda: assets_to_properties_options(assets), assets_count),
+    }
+    for name, (function, count) in cases.items():
+        runs = 200
+        seconds = min(timeit.repeat(function, number=runs, repeat=5)) / runs
+        print(f'{name:>17}: {seconds * 1e6 / count:6.2f} us per link or asset ({count} per record)')
+
+
+if __name__ == '__main__':
+    main()
@@ -0,0 +1,59 @@
+"""Benchmark of the GeoCore record serializers.
+
+Serializes realistic GeoCore item records (mapped from synthetic STAC items, see bench_items.py)
+with the previous output (json, indent=4, then copied by bytes()), the compact json output, and
+the compact orjson output when orjson is installed. Reports the object size and the throughput.
+
+Usage: python benchmarks/bench_serializers.py [number of records]
+"""
+import copy
+import json
+import os
+import sys
+import time
+
+sys.path.insert(0, os.path.join(os.path.dirname(os.path.abspath(__file__)), '..', 'stac-to-geocore'))
+from bench_items import PARAMS, COLLECTION, PROPERTIES_TEMPLATE, make_item  # noqa: E402
+from collection_index import CollectionIndex  # noqa: E402
+from serializers import orjson, serialize_json  # noqa: E402
+from stac_to_geocore import item_to_features_properties  # noqa: E402
+
+
+def make_records(count):
+    collection_index = CollectionIndex([COLLECTION])
+    records = []
+    for i in range(count):
+        properties = item_to_features_properties(PARAMS, {'properties': copy.deepcopy(PROPERTIES_TEMPLATE)}, make_item(i), collection_index)
+        bbox = make_item(i)['bbox']
+        records.append({'type': 'FeatureCollection', 'features': [{
+            'type': 'Feature',
+            'geometry': {'type': 'Polygon', 'coordinates': [[[bbox[0], bbox[1]], [bbox[2], bbox[1]], [bbox[2], bbox[3]], [bbox[0], bbox[3]], [bbox[0], bbox[1]]]]},
+            'properties': properties,
+        }]})
+    return records
+
+
+def main():
+    count = int(sys.argv[1]) if len(sys.argv) > 1 else 5000
+    records = make_records(count)
+    cases = {
+        'indent=4 (previous)': lambda record: bytes(json.dumps(record, indent=4, ensure_ascii=False).encode('utf-8')),
+        'compact json': lambda record: serialize_json(record, json_format='compact', backend='json'),
+    }
+    if orjson is not None:
+        cases['compact orjson'] = lambda record: serialize_json(record, json_format='compact', backend='auto')
+    baseline_size = None
+    for name, function in cases.items():
+        best = None
+        for _ in range(3):
+            started = time.perf_counter()
+            size = sum(len(function(record)) for record in records)
+            seconds = time.perf_counter() - started
+            best = seconds if best is None else min(best, seconds)
+        baseline_size = baseline_size or size
+        print(f'{name:>20}: {size / count:8,.0f} bytes/record ({size / baseline_size:4.0%}), '
+              f'{count / best:9,.0f} records/s, {size / best / 1e6:6.1f} MB/s')
+
+
+if __name__ == '__main__':
+    main()
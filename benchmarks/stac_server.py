@@ -0,0 +1,269 @@
+"""Synthetic STAC API for the offline benchmarks.
+
+Serves a root catalog, a paginated /collections, /conformance and a GET/POST /search of
+N collections x M items, with the limit parameter and the fields extension. Items are generated on the fly from their index, so the server
+memory does not grow with the catalog. Like the Franklin STAC API of the datacube, every
+search page has a next link, even the last one. Responses carry an ETag and a GET with a
+matching If-None-Match gets a 304 Not Modified. GET /_stats returns the request counters.
+
+Usage: python benchmarks/stac_server.py [--port 8765] [--collections 10] [--items 1000] [--links 5]
+                                        [--assets 3] [--page-size 30] [--collections-page-size 100]
+                                        [--max-limit 1000] [--no-fields]
+"""
+import argparse
+import hashlib
+import json
+import threading
+import urllib.parse
+from datetime import datetime, timedelta, timezone
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+EPOCH = datetime(2010, 1, 1, tzinfo=timezone.utc)
+CONFORMANCE = [
+    'https://api.stacspec.org/v1.0.0/core',
+    'https://api.stacspec.org/v1.0.0/collections',
+    'https://api.stacspec.org/v1.0.0/item-search',
+    'https://api.stacspec.org/v1.0.0/item-search#fields',
+]
+ASSET_TYPES = ['image/tiff; application=geotiff; profile=cloud-optimized', 'text/xml', 'image/png', 'application/json']
+ASSET_ROLES = [['data'], ['metadata'], ['thumbnail'], ['overview']]
+LINK_RELS = ['self', 'root', 'parent', 'collection', 'derived_from', 'license', 'alternate']
+
+
+class SyntheticCatalog:
+    """Deterministic catalog of collections x items, item i of a collection is dated EPOCH + i days"""
+
+    def __init__(self, collections=10, items=1000, links=5, assets=3, page_size=30, collections_page_size=100,
+                 conformance=None, max_limit=1000, fields=True):
+        self.collections = collections
+        self.items = items
+        self.links = links
+        self.assets = assets
+        self.page_size = page_size
+        self.collections_page_size = collections_page_size
+        self.max_limit = max_limit
+        self.conformance = CONFORMANCE if conformance is None else conformance
+        if not fields:
+            self.conformance = [uri for uri in self.conformance if not uri.endswith('#fields')]
+
+    def collection(self, c, base):
+        coll_id = f'collection-{c}'
+        end = EPOCH + timedelta(days=max(self.items - 1, 0))
+        return {
+            'type': 'Collection', 'id': coll_id, 'stac_version': '1.0.0',
+            'title': f'Synthetic collection {c}/Collection synthétique {c}',
+            'description': f'Synthetic collection {c} for the benchmarks/Collection synthétique {c} pour les bancs d\'essai',
+            'keywords': ['synthetic', 'benchmark', 'synthétique', 'banc d\'essai'],
+            'extent': {'spatial': {'bbox': [[-141.0 + c % 50, 41.7, -52.6, 83.1]]},
+                       'temporal': {'interval': [[_format(EPOCH), _format(end)]]}},
+            'links': [{'rel': 'self', 'href': f'{base}/collections/{coll_id}', 'type': 'application/json'},
+                      {'rel': 'root', 'href': f'{base}/', 'type': 'application/json'},
+                      {'rel': 'items', 'href': f'{base}/collections/{coll_id}/items', 'type': 'application/geo+json'},
+                      {'rel': 'license', 'href': 'https://open.canada.ca/en/open-government-licence-canada', 'title': 'OGL'}],
+            'assets': {'thumbnail': {'href': f'{base}/thumbnails/{coll_id}.png', 'type': 'image/png',
+                                     'roles': ['thumbnail'], 'title': 'Thumbnail/Vignette'}},
+        }
+
+    def item(self, c, i, base):
+        coll_id = f'collection-{c}'
+        item_id = f'{coll_id}-item-{i}'
+        url = f'{base}/collections/{coll_id}/items/{item_id}'
+        west, south = -140.0 + (i * 0.37) % 85, 42.0 + (i * 0.13) % 40
+        return {
+            'type': 'Feature', 'stac_version': '1.0.0', 'id': item_id, 'collection': coll_id,
+            'bbox': [round(west, 6), round(south, 6), round(west + 0.5, 6), round(south + 0.25, 6)],
+            'geometry': {'type': 'Polygon', 'coordinates': [[[west, south], [west + 0.5, south], [west + 0.5, south + 0.25],
+                                                               [west, south + 0.25], [west, south]]]},
+            'properties': {'datetime': _format(EPOCH + timedelta(days=i)), 'created': '2022-01-01T00:00:00Z',
+                           'updated': '2022-01-02T00:00:00Z', 'proj:epsg': 3979},
+            'links': [{'rel': LINK_RELS[k % len(LINK_RELS)], 'href': f'{url}/link/{k}', 'type': 'application/json'}
+                      for k in range(self.links)],
+            'assets': {f'asset-{k}': {'href': f'https://datacube-prod-data-public.s3.ca-central-1.amazonaws.com/{item_id}/{k}.tif',
+                                      'type': ASSET_TYPES[k % len(ASSET_TYPES)], 'roles': ASSET_ROLES[k % len(ASSET_ROLES)],
+                                      'title': f'Asset {k}'}
+                       for k in range(self.assets)},
+        }
+
+    def search(self, collections=None, interval=None):
+        """Return the (collection, first item, last item + 1) ranges matching the search filters, in order"""
+        ranges = []
+        for c in range(self.collections):
+            if collections and f'collection-{c}' not in collections:
+                continue
+            first, stop = 0, self.items
+            if interval:
+                lower, upper = (interval.split('/') + ['..'])[:2]
+                if lower not in ('', '..'):
+                    first = max(first, -(-(_parse(lower) - EPOCH) // timedelta(days=1)))
+                if upper not in ('', '..'):
+                    stop = min(stop, (_parse(upper) - EPOCH) // timedelta(days=1) + 1)
+            if first < stop:
+                ranges.append((c, first, stop))
+        return ranges
+
+    def search_page(self, ranges, offset, limit, base):
+        features = []
+        for c, first, stop in ranges:
+            count = stop - first
+            if offset >= count:
+                offset -= count
+                continue
+            for i in range(first + offset, min(stop, first + offset + limit - len(features))):
+                features.append(self.item(c, i, base))
+            offset = 0
+            if len(features) == limit:
+                break
+        return features
+
+
+class StacRequestHandler(BaseHTTPRequestHandler):
+    catalog = SyntheticCatalog()
+    stats = {}
+    stats_lock = threading.Lock()
+
+    def log_message(self, format, *args):
+        pass
+
+    def do_GET(self):
+        url = urllib.parse.urlsplit(self.path)
+        query = {key: values[0] for key, values in urllib.parse.parse_qs(url.query).items()}
+        base = f'http://{self.headers.get("Host")}'
+        path = url.path.rstrip('/') or '/'
+        if path == '/_stats':
+            with self.stats_lock:
+                return self._send(self.stats, count=False)
+        if path == '/':
+            return self._send({
+                'type': 'Catalog', 'id': 'synthetic datacube', 'stac_version': '1.0.0',
+                'description': 'Synthetic STAC API for the benchmarks', 'conformsTo': self.catalog.conformance,
+                'links': [{'rel': 'self', 'href': f'{base}/', 'title': 'Self'},
+                          {'rel': 'data', 'href': f'{base}/collections', 'title': 'Collections'},
+                          {'rel': 'conformance', 'href': f'{base}/conformance', 'title': 'Conformance'},
+                          {'rel': 'search', 'href': f'{base}/search', 'title': 'Search'},
+                          {'rel': 'service-doc', 'href': f'{base}/docs', 'title': 'Documentation'}]})
+        if path == '/conformance':
+            return self._send({'conformsTo': self.catalog.conformance})
+        if path == '/collections':
+            offset = int(query.get('offset', 0))
+            size = self.catalog.collections_page_size
+            stop = min(offset + size, self.catalog.collections)
+            links = [{'rel': 'next', 'href': f'{base}/collections?offset={stop}'}] if stop < self.catalog.collections else []
+            return self._send({'collections': [self.catalog.collection(c, base) for c in range(offset, stop)], 'links': links})
+        if path == '/search':
+            if 'collections' in query:
+                query['collections'] = query['collections'].split(',')
+            return self._search(query, base, 'GET')
+        self._send({'code': 'NotFound', 'description': self.path}, status=404)
+
+    def do_POST(self):
+        body = self.rfile.read(int(self.headers.get('Content-Length', 0)))
+        if urllib.parse.urlsplit(self.path).path.rstrip('/') != '/search':
+            return self._send({'code': 'NotFound', 'description': self.path}, status=404)
+        self._search(json.loads(body or b'{}'), f'http://{self.headers.get("Host")}', 'POST')
+
+    def _search(self, query, base, method):
+        ranges = self.catalog.search(query.get('collections'), query.get('datetime'))
+        matched = sum(stop - first for c, first, stop in ranges)
+        limit = min(int(query.get('limit') or self.catalog.page_size), self.catalog.max_limit)
+        token = int(query.get('token') or 0)
+        features = self.catalog.search_page(ranges, token, limit, base)
+        if query.get('fields') and any(uri.endswith('#fields') for uri in self.catalog.conformance):
+            features = [select_fields(feature, query['fields']) for feature in features]
+        next_query = dict(query, token=token + limit)
+        # Franklin: a next link on every page, the client checks context.returned against context.matched
+        if method == 'GET':
+            flat = {key: (','.join(value) if isinstance(value, list) else value) for key, value in next_query.items()}
+            link = {'rel': 'next', 'href': f'{base}/search?{urllib.parse.urlencode(flat)}'}
+        else:
+            link = {'rel': 'next', 'href': f'{base}/search', 'method': 'POST', 'body': next_query}
+        self._send({'type': 'FeatureCollection', 'features': features, 'links': [link],
+                    'context': {'returned': len(features), 'matched': matched, 'limit': limit}})
+
+    def _send(self, data, status=200, count=True):
+        body = json.dumps(data).encode('utf-8')
+        etag = f'"{hashlib.sha1(body).hexdigest()}"'
+        if status == 200 and self.command == 'GET' and self.headers.get('If-None-Match') == etag:
+            status, body = 304, b''
+        self.send_response(status)
+        self.send_header('ETag', etag)
+        if status != 304:
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+        self.end_headers()
+        self.wfile.write(body)
+        if count:
+            endpoint = f"{self.command} {urllib.parse.urlsplit(self.path).path.rstrip('/') or '/'}"
+            if status == 304:
+                endpoint += ' 304'
+            with self.stats_lock:
+                stats = self.stats.setdefault(endpoint, {'requests': 0, 'bytes': 0})
+                stats['requests'] += 1
+                stats['bytes'] += len(body)
+
+
+def serve(port=8765, **catalog_options):
+    """Serve the synthetic catalog until the process is stopped"""
+    StacRequestHandler.catalog = SyntheticCatalog(**catalog_options)
+    server = ThreadingHTTPServer(('127.0.0.1', port), StacRequestHandler)
+    server.daemon_threads = True
+    server.serve_forever()
+
+
+def select_fields(feature, fields):
+    """Apply the fields extension to an item, fields is a POST {'include', 'exclude'} or a GET 'a,b,-c' string"""
+    if isinstance(fields, str):
+        names = [name for name in fields.split(',') if name]
+        fields = {'include': [name.lstrip('+') for name in names if not name.startswith('-')],
+                  'exclude': [name[1:] for name in names if name.startswith('-')]}
+    include, exclude = fields.get('include') or [], fields.get('exclude') or []
+    if include:
+        selected = {}
+        for name in include:
+            key, _, child = name.partition('.')
+            if key not in feature:
+                continue
+            if child:
+                if child in feature[key]:
+                    selected.setdefault(key, {})[child] = feature[key][child]
+            else:
+                selected[key] = feature[key]
+        feature = selected
+    for name in exclude:
+        if name not in include:
+            key, _, child = name.partition('.')
+            if child:
+                feature.get(key, {}).pop(child, None)
+            else:
+                feature.pop(key, None)
+    return feature
+
+
+def _format(value):
+    return value.strftime('%Y-%m-%dT%H:%M:%SZ')
+
+
+def _parse(value):
+    parsed = datetime.fromisoformat(value.replace('Z', '+00:00'))
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def main():
+    parser = argparse.ArgumentParser(description=__doc__.splitlines()[0])
+    parser.add_argument('--port', type=int, default=8765)
+    parser.add_argument('--collections', type=int, default=10)
+    parser.add_argument('--items', type=int, default=1000, help='items per collection')
+    parser.add_argument('--links', type=int, default=5, help='links per item')
+    parser.add_argument('--assets', type=int, default=3, help='assets per item')
+    parser.add_argument('--page-size', type=int, default=30)
+    parser.add_argument('--collections-page-size', type=int, default=100)
+    parser.add_argument('--max-limit', type=int, default=1000, help='largest page size of a search')
+    parser.add_argument('--no-fields', action='store_true', help='do not conform to the fields extension')
+    args = parser.parse_args()
+    print(f'Serving {args.collections} collections x {args.items} items on http://127.0.0.1:{args.port}')
+    serve(args.port, collections=args.collections, items=args.items, links=args.links, assets=args.assets,
+          page_size=args.page_size, collections_page_size=args.collections_page_size, max_limit=args.max_limit,
+          fields=not args.no_fields)
+
+
+if __name__ == '__main__':
+    main()
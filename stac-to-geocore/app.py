@@ -4,12 +4,29 @@ import re
 import json
 import logging 
 import boto3 
+import threading
+import time
 from datetime import datetime
 from botocore.exceptions import ClientError
 
+from http_client import *
 from pagination import *
 from s3_operations import *
 from stac_to_geocore import *
+from template_cache import *
+from upload_pipeline import *
+from incremental import *
+from checkpoint import *
+from run_manifest import *
+from fan_out import *
+from collection_index import *
+from shard_output import *
+from geometry_batch import *
+from memory_usage import *
+from async_engine import *
+from metrics import *
+from http_cache import *
+from upload_dedup import *
 
 
 # environment variables for lambda
@@ -36,12 +53,17 @@ sourceSystemName = os.environ['SOURCESYSTEMNAME']
 def lambda_handler(event, context):
     """STAC harvesting and mapping workflow 
         1. Before harvesting the stac records, we delete the previous harvested stac records logged in lastRun.txt.
-        2. Create an empty lastRun.txt to log the current harvest
+        2. Start a new lastRun.txt, written to S3 while the records are logged 
         3. Harvest and translate STAC catalog (root api endpoint)
         4. Loop through each STAC collection, harvest the collection json body and then mapp collection to GeoCore
         5. Loop through items within the collection, harvest the item json bady and map item to GeoCore. 
-        6. Update lastRun.txt 
+        6. Complete lastRun.txt, it replaces the manifest of the previous harvest. 
+    An event with a 'fan_out_shard' runs a single fan-out worker, see run_fan_out_worker(). 
+    The harvest modes and options are described in the README. 
     """
+    if event and 'fan_out_shard' in event: 
+        return run_fan_out_worker(event['fan_out_shard'], params=event['params'], collection_fields=event['collection_fields'], run_id=event['run_id'], 
+                                  search_params=event.get('search_params'))
     error_msg = ''
     
     #Change directory to /tmp folder, required if new files are created for lambda 
@@ -49,24 +71,104 @@ def lambda_handler(event, context):
     if not os.path.exists(os.path.join('mydir')):
         os.makedirs('mydir')
 
+    reset_http_stats()
+    reset_metrics()
+    # STAC_HTTP_CACHE: the GET responses of the previous harvests are revalidated instead of downloaded again 
+    open_http_cache()
     # Before harvesting the STAC api, we check the root api connectivity first   
     try: 
-        response_root = requests.get(f'{api_root}')
+        response_root = stac_get(f'{api_root}')
         print(f'Connection to root api is okay with status {response_root}')
     except: 
         error_msg = 'Connectivity issue: error trying to access the root api: ' + api_root 
     
     # Start the harvest and translation process if connection is okay 
     if response_root.status_code == 200:
-        #Delete previous harvest included in lastRun.txt 
+        # Get null geocore features body as a dictionary. The template is fetched and parsed once,
+        # then every record gets its own copy of the cached skeleton. Loaded before the previous 
+        # records are deleted, a missing template stops the handler with a RuntimeError 
+        template_skeleton = load_geocore_template(geocore_template_bucket_name, geocore_template_name)
+        # Resume an unfinished harvest, or start a new one. The lease of the checkpoint lets a single invocation run the harvest 
+        lease = CheckpointLease(geocore_template_bucket_name, context)
+        cursor = lease.acquire(event)
+        if cursor is None: 
+            cursor = new_cursor()
+            if not lease.claim(cursor): 
+                cursor = False
+        if cursor is False: 
+            print('Not harvesting: another invocation runs the harvest, or its checkpoint was given up')
+            close_http_cache()
+            return
+        # The first checkpoint of a harvest only claims it, the harvest starts over until a checkpoint holds its manifest 
+        resumed = 'manifest' in cursor
+        if resumed: 
+            print(f"Resuming the harvest from the checkpoint: phase {cursor['phase']}, collection {cursor['coll_index']}, page {cursor['page']}, item {cursor['item_offset']}")
+        if resumed and cursor.get('manifest'): 
+            manifest = ManifestWriter.resume(geocore_template_bucket_name, cursor['manifest'])
+        else: 
+            manifest = ManifestWriter(geocore_template_bucket_name)
         print(geocore_to_parquet_bucket_name)
         print(geocore_template_bucket_name)
-        e = delete_stac_s3(bucket_geojson=geocore_to_parquet_bucket_name, bucket_template=geocore_template_bucket_name)
-        if e != None: 
-            error_msg += e
-        # Create a new log file and write into log file for each sucessfull harvest 
-        print('Creating a new lastRun.txt')
-        with open('/tmp/lastRun.txt', 'w') as f:
+        if harvest_mode == 'incremental' and geocore_output_mode == 'objects': 
+            incremental = IncrementalHarvest(bucket=geocore_template_bucket_name)
+            if resumed: 
+                incremental.current = cursor.get('incremental', {})
+                incremental.unchanged = cursor.get('unchanged', 0)
+        else: 
+            incremental = None
+        # The unchanged records are not written again, their objects and S3 events are left as they are 
+        dedup = open_upload_dedup(geocore_to_parquet_bucket_name, prefix=f'{source}-') if geocore_output_mode == 'objects' else None
+        if not incremental: 
+            #Delete previous harvest included in lastRun.txt, after the harvest with the upload dedup 
+            if not resumed and dedup is None: 
+                with timed_phase('cleanup'): 
+                    e = delete_stac_s3(bucket_geojson=geocore_to_parquet_bucket_name, bucket_template=geocore_template_bucket_name)
+                if e != None: 
+                    error_msg += e
+        # Log the key of each sucessfull harvest in the new manifest 
+        print(f'Appending to the resumed {manifest.name}, {manifest.count} keys' if resumed else f'Creating a new {manifest.name}')
+        key_log_lock = threading.Lock()
+        def log_key(key, uploaded=True): 
+            with key_log_lock: 
+                if incremental and uploaded: 
+                    incremental.mark_uploaded(key)
+                manifest.write(key)
+        timer = CheckpointTimer(context)
+        handed_over = False
+        async_report = None
+        # Shards of a resumed harvest keep the run id of the harvest 
+        run_id = cursor.setdefault('run_id', getattr(context, 'aws_request_id', None) or datetime.utcnow().strftime('%Y%m%dT%H%M%S'))
+        fan_out_uploaded = fan_out_skipped = 0
+        # Number of pipeline.failed keys already logged, see log_failed_keys() 
+        failed_logged = 0
+        with open_output(bucket=geocore_to_parquet_bucket_name, on_success=log_key, run_id=run_id, resume=resumed, dedup=dedup, state=cursor.get('shard')) as pipeline:
+            # Translated records are uploaded by the pipeline threads (or batched in shards), keys are logged in lastRun.txt once uploaded 
+            def submit_record(key, json_data, updated=None): 
+                increment('records_translated')
+                queue_record(pipeline, incremental, log_key, key, json_data, updated)
+
+            def checkpoint_reached(): 
+                """Save a checkpoint when one is due, return True when this invocation must hand over"""
+                nonlocal failed_logged
+                hand_over = timer.hand_over_due()
+                if hand_over or timer.save_due(): 
+                    # The cursor must not get ahead of the key log: wait for the submitted uploads first 
+                    pipeline.drain()
+                    log_failed_keys(pipeline.failed[failed_logged:], incremental, log_key)
+                    failed_logged = len(pipeline.failed)
+                    if incremental: 
+                        cursor.update({'incremental': incremental.current, 'unchanged': incremental.unchanged})
+                    if geocore_output_mode != 'objects': 
+                        # The open shard is continued, not closed, so the shard size does not depend on the checkpoint interval 
+                        cursor['shard'] = pipeline.state()
+                    with key_log_lock: 
+                        if not lease.save(cursor, manifest, hand_over=hand_over): 
+                            hand_over = True
+                    timer.saved()
+                    if hand_over and geocore_output_mode != 'objects': 
+                        pipeline.suspend()
+                return hand_over
+
             # Catalog Level     
             #root_data = json.loads(response_root.text)
             root_data_json = response_root.json()
@@ -75,17 +177,17 @@ def lambda_handler(event, context):
                 root_id=root_id.replace(' ', '-')
             root_des = root_data_json['description']
             root_links = root_data_json['links']
+            # Larger search pages holding only the mapped item fields, when the API conformance classes allow them 
+            search_params = negotiate_search_params(api_root, root_data_json)
+            print(f'Search parameters: {search_params}' if search_params else 'Searching with the API default page size and fields')
             # GeoCore properties bounding box is a required for frontend, here we use the first collection
             #TBD using first collection bounding box could cause potential issues when collections have different extent, a solution is required. 
-            response_collection = requests.get(f'{api_root}/collections/')
-            collection_data_list = response_collection.json()['collections']
+            # Every page of /collections is fetched and parsed once, then shared by the collection and item mappings 
+            with timed_phase('collection_index'): 
+                collection_index = CollectionIndex.from_api(api_root)
+            collection_data_list = collection_index.collections
             root_bbox = collection_data_list[1]['extent']['spatial']['bbox'][0] 
-            
-            # Get null geocore features body as a dictionary 
-            geocore_features_dict = get_geocore_template(geocore_template_bucket_name,geocore_template_name) 
-           # print(f'This is the geocore_features_dict when it is loaded \n {geocore_features_dict}')
-            # Mapping to geocore features geometry and properties 
-            root_geometry_dict = to_features_geometry(geocore_features_dict, bbox=root_bbox, geometry_type='Polygon')
+
             # Perpare for parametes required for the function 
             params = {
                 'root_name': root_name, 
@@ -104,95 +206,392 @@ def lambda_handler(event, context):
                 'topicCategory': topicCategory,
                 'sourceSystemName': sourceSystemName
             }
-            #print(f"This is the geocore_features_dict when it is in the params before root_to_features_properties\n {params['geocore_features_dict']}")
-            root_properties_dict = root_to_features_properties(params, geocore_features_dict)
-            # Update the geocore body and finish mapping 
-            root_geocore_updated = update_geocore_dict(geocore_features_dict=geocore_features_dict, properties_dict =root_properties_dict ,geometry_dict=root_geometry_dict)
-            # upload the stac geocore to a S3 
-            root_upload = source + '-root-' + root_id + '.geojson'
-            msg = upload_file_s3(root_upload, bucket=geocore_to_parquet_bucket_name, json_data=root_geocore_updated, object_name=None)
-            if msg == True: 
-                print(f'Finished mapping root : {root_id}, uploaded the file to bucket: {geocore_to_parquet_bucket_name}')    
-                f.write(f"{root_upload}\n") 
+            # HARVEST_ENGINE=async maps the whole catalog with asyncio, without checkpoints. A resumed harvest continues with the sync loops
+            use_async = harvest_engine == 'async' and cursor['phase'] == 'root' and geocore_output_mode == 'objects'
+            if use_async and self_invoke:
+                # A harvest handing over to the next invocation needs the checkpoints of the sync loops
+                logging.error('HARVEST_ENGINE=async does not save checkpoints, it requires HARVEST_SELF_INVOKE=false. Running the sync engine')
+                use_async = False
+            if use_async:
+                with timed_phase('async_harvest'): 
+                    async_report = run_async_harvest(api_root, geocore_to_parquet_bucket_name, params, template_skeleton, collection_index, 
+                                                     translate_root, translate_collection, translate_item, 
+                                                     accept_record=lambda key, json_data, updated: record_needs_upload(incremental, log_key, key, json_data, updated), 
+                                                     on_success=log_key, search_params=search_params, dedup=dedup)
+                cursor['item_count'] = async_report['items']
+                print(f"Async engine: mapped {async_report['records']} records, {async_report['items']} items")
+                cursor['phase'] = 'done'
+                log_memory('async harvest')
+            if cursor['phase'] == 'root': 
+                with timed_phase('root'): 
+                    start = time.perf_counter()
+                    root_upload, root_geocore_updated = translate_root(template_skeleton, params)
+                    observe_record('translation', root_upload, time.perf_counter() - start)
+                    # upload the stac geocore to a S3 
+                    submit_record(root_upload, root_geocore_updated)
+                print(f'Finished mapping root : {root_id}, queued the file for upload to bucket: {geocore_to_parquet_bucket_name}')    
+                cursor['phase'] = 'collections'
+                log_memory('root')
         
             # Collection mapping 
-            coll_count = 0
-            for coll_dict in collection_data_list:
-                # Reload the null GeoCore template 
-                geocore_features_dict = get_geocore_template(geocore_template_bucket_name,geocore_template_name) 
-                coll_extent = coll_dict.get('extent')
-                coll_bbox = coll_extent.get('spatial', {}).get('bbox', [None])[0]
-                coll_geometry_dict = to_features_geometry(geocore_features_dict, bbox=coll_bbox, geometry_type='Polygon')
-                coll_properties_dict = coll_to_features_properties(coll_dict=coll_dict, params=params, geocore_features_dict=geocore_features_dict)
-                coll_geocore_updated = update_geocore_dict(geocore_features_dict=geocore_features_dict, properties_dict =coll_properties_dict, geometry_dict=coll_geometry_dict)
-                
-                coll_id = coll_dict.get('id')
-                coll_name = source + '-' + coll_id + '.geojson'
-                msg = upload_file_s3(coll_name, bucket=geocore_to_parquet_bucket_name, json_data=coll_geocore_updated, object_name=None)
-                if msg == True: 
-                    coll_count += 1 
-                    print(f'Mapping Collection {coll_count}: {coll_id}. Finished and Uploaded the collection to bucket: {geocore_to_parquet_bucket_name}')
-                    f.write(f"{coll_name}\n")    
+            if cursor['phase'] == 'collections': 
+                phase_start = time.perf_counter()
+                for coll_index in range(cursor['coll_index'], len(collection_data_list)):
+                    coll_dict = collection_data_list[coll_index]
+                    start = time.perf_counter()
+                    coll_name, coll_geocore_updated = translate_collection(template_skeleton, params, coll_dict, collection_index.get(coll_dict.get('id')))
+                    observe_record('translation', coll_name, time.perf_counter() - start)
+                    submit_record(coll_name, coll_geocore_updated, updated=coll_dict.get('updated'))
+                    cursor['coll_index'] = coll_index + 1
+                    if log_records: 
+                        print(f"Mapping Collection {cursor['coll_index']}: {coll_dict.get('id')}. Finished and queued the collection for upload to bucket: {geocore_to_parquet_bucket_name}")
+                    if checkpoint_reached(): 
+                        handed_over = True
+                        break
+                else: 
+                    cursor['phase'] = 'items'
+                add_phase_time('collections', time.perf_counter() - phase_start)
+                log_memory('collections')
                     
             #Item with paginate 
-            pages = search_pages_get(url=api_root +'/search')
-            item_count = 0 
-            # Get the keywords, description, and titles for all the collections as a dictionary  
-            coll_id_dict = create_coll_dict(api_root)
-            for page in pages: 
-                #Each page has 30 items 
-                r = requests.get(page)
-                j = r.json()
-                items_list = j['features']
-                for item in items_list: 
-                    #item is a dict
-                    item_id, item_bbox, item_links, item_assets, item_properties,coll_id = get_item_fields(item)
-                    geocore_features_dict = get_geocore_template(geocore_template_bucket_name,geocore_template_name)
-                    
-                    item_geometry_dict = to_features_geometry(geocore_features_dict=geocore_features_dict, bbox=item_bbox, geometry_type='Polygon')
-                    
-                    item_properties_dict = item_to_features_properties(params=params, geocore_features_dict=geocore_features_dict, item_dict=item, coll_id_dict=coll_id_dict)
-                    
-                    item_geocore_updated = update_geocore_dict(geocore_features_dict=geocore_features_dict, properties_dict =item_properties_dict ,geometry_dict=item_geometry_dict)
-                    item_name = source + '-' + coll_id + '-' + item_id + '.geojson'
-                    msg = upload_file_s3(item_name, bucket=geocore_to_parquet_bucket_name, json_data=item_geocore_updated, object_name=None)
-                    if msg == True: 
-                        item_count += 1 
-                        print(f'Maping item {item_count}: {item_id}. Finished and uploaded the item to bucket: {geocore_to_parquet_bucket_name}')  
-                        f.write(f"{item_name}\n")
-        f.close()
-        msg = upload_file_s3(filename='lastRun.txt', bucket=geocore_template_bucket_name, json_data = None, object_name=None)
-        if msg == True: 
-            print(f'Finished mapping the STAC datacube and uploaded the lastRun.txt to bucket: {geocore_template_name}')   
+            phase_start = time.perf_counter()
+            if cursor['phase'] == 'items' and not handed_over and harvest_strategy == 'fan-out': 
+                # Scatter: the shards are planned once, their dispatch state is saved in the checkpoints so a resumed 
+                # harvest keeps waiting for the running shards instead of dispatching them again 
+                if 'fan_out' not in cursor: 
+                    shards = plan_fan_out(api_root, collection_data_list)
+                    cursor['fan_out'] = new_fan_out_state(shards)
+                    print(f'Dispatching {len(shards)} shards to {fan_out_backend} workers')
+                dispatcher = ShardDispatcher(cursor['fan_out'], worker=run_fan_out_worker, run_id=run_id, bucket=geocore_template_bucket_name, context=context, worker_args={
+                    'params': params, 'collection_fields': collection_index.to_fields_dict(), 'run_id': run_id, 'search_params': search_params})
+                # Gather: the keys of each finished shard are logged in lastRun.txt 
+                while not dispatcher.finished(): 
+                    for shard_manifest in dispatcher.poll(): 
+                        for key in shard_manifest['keys']: 
+                            log_key(key, uploaded=False)
+                        if incremental: 
+                            incremental.current.update(shard_manifest.get('incremental', {}))
+                    if checkpoint_reached(): 
+                        handed_over = True
+                        break
+                dispatcher.close()
+                if not handed_over: 
+                    summaries = cursor['fan_out']['done']
+                    failed_shards = cursor['fan_out']['failed']
+                    if incremental: 
+                        incremental.unchanged += sum(summary['unchanged'] for summary in summaries)
+                    cursor['item_count'] = sum(summary['items'] for summary in summaries)
+                    fan_out_uploaded = sum(summary['uploaded'] for summary in summaries)
+                    fan_out_skipped = sum(summary['skipped'] for summary in summaries)
+                    print(f"Mapped {cursor['item_count']} items in {len(summaries)} shards, {fan_out_uploaded} uploaded")
+                    if failed_shards: 
+                        error_msg += f"Failed to harvest {len(failed_shards)} shards: {', '.join(shard['shard_id'] for shard in failed_shards)}. "
+                        if incremental or dedup: 
+                            # Without their keys, the previous records of the failed shards would be deleted as stale 
+                            carried = set(failed_shard_keys(geocore_template_bucket_name, cursor['fan_out'], source, collection_index.ids()))
+                            for key in sorted(carried): 
+                                log_key(key, uploaded=False)
+                            if incremental: 
+                                incremental.current.update({record_id: entry for record_id, entry in incremental.previous.items() 
+                                                            if entry.get('key') in carried and record_id not in incremental.current})
+                            print(f'Kept the {len(carried)} previous records of the failed shards')
+                    clear_shard_manifests(geocore_template_bucket_name, run_id)
+            elif cursor['phase'] == 'items' and not handed_over: 
+                # The collection dictionaries are not needed by the item mapping, only their parsed fields 
+                collection_index.release_collections()
+                collection_data_list = None
+                # Each valid page is fetched once, the next page is prefetched while this one is translated 
+                # (with STAC_STREAM_ITEMS, the items are parsed one at a time while the page is downloaded instead) 
+                # A resumed pagination continues from the saved page url, which holds the search parameters 
+                search_url = cursor['page'] or add_search_params(api_root + '/search', None, search_params)[0]
+                for page, items_list in timed_iter(search_pages_iter(url=search_url, returned=cursor['returned']), 'pagination'): 
+                    #Each page has 30 items 
+                    cursor['page'] = page
+                    # The bboxes of the page are rounded, validated and turned into geometries in one pass 
+                    if isinstance(items_list, list): 
+                        geometries = page_geometries([item.get('bbox') for item in items_list], ids=[item.get('id') for item in items_list])
+                    else: 
+                        geometries = None
+                    page_count = 0
+                    for item_index, item in enumerate(items_list): 
+                        page_count = item_index + 1
+                        if item_index < cursor['item_offset']: 
+                            continue
+                        start = time.perf_counter()
+                        item_name, item_geocore_updated, item_updated = translate_item(template_skeleton, params, item, collection_index, geometries[item_index] if geometries else None)
+                        observe_record('translation', item_name, time.perf_counter() - start)
+                        submit_record(item_name, item_geocore_updated, updated=item_updated)
+                        cursor['item_offset'] = item_index + 1
+                        cursor['item_count'] += 1 
+                        if log_records: 
+                            print(f"Maping item {cursor['item_count']}: {item.get('id')}. Finished and queued the item for upload to bucket: {geocore_to_parquet_bucket_name}")  
+                        if checkpoint_reached(): 
+                            handed_over = True
+                            break
+                    # Release the page before the next one is parsed 
+                    items_list = geometries = item = None
+                    if handed_over: 
+                        break
+                    cursor['returned'] += page_count
+                    cursor['item_offset'] = 0
+            if cursor['phase'] == 'items': 
+                add_phase_time('items', time.perf_counter() - phase_start)
+                log_memory('items')
+        # Leaving the with block waits for the pending uploads 
+        uploaded = pipeline.uploaded + (async_report['uploaded'] if async_report else 0)
+        failed = pipeline.failed + (async_report['failed'] if async_report else [])
+        log_failed_keys(failed[failed_logged:], incremental, log_key)
+        print(f'Uploaded {uploaded} records to bucket: {geocore_to_parquet_bucket_name}, {len(failed)} failed')
+        increment('records_uploaded', uploaded)
+        increment('records_failed', len(failed))
+        if failed: 
+            error_msg += f'Failed to upload {len(failed)} records to bucket: {geocore_to_parquet_bucket_name}. '
+        if handed_over: 
+            print('Stopping before the Lambda timeout, the harvest continues from the checkpoint')
+            if lease.lost: 
+                error_msg += 'Another invocation took over the checkpoint, this invocation stopped. '
+            elif self_invoke and not invoke_continuation(context, {'resume': True, 'lease': lease.next_owner}): 
+                error_msg += 'Could not invoke the function to continue the harvest, it resumes on the next scheduled run. '
+        else: 
+            phase_start = time.perf_counter()
+            if incremental: 
+                print(f'Incremental harvest: {incremental.unchanged} records unchanged')
+                increment('records_unchanged', incremental.unchanged)
+                # Records of the previous harvest that are gone upstream, the previous manifest is still in place until close() 
+                previous_keys = iter_manifest_keys(geocore_template_bucket_name) or []
+                report = delete_filelist_s3(deleted_filelist=stale_keys(previous_keys, incremental.current_keys()), bucket=geocore_to_parquet_bucket_name)
+                if report['errors']: 
+                    error_msg += f"Failed to delete {len(report['errors'])} stale records from {geocore_to_parquet_bucket_name}. "
+                incremental.save()
+            elif dedup: 
+                # Read before close() replaces the previous manifest 
+                previous_keys = set(iter_manifest_keys(geocore_template_bucket_name) or ())
+            if manifest.close(): 
+                print(f'Finished mapping the STAC datacube and uploaded the {manifest.name} ({manifest.count} keys) to bucket: {geocore_template_bucket_name}')   
+                if dedup: 
+                    deleted = 0
+                    if not incremental: 
+                        # Records of the previous harvest that are not in the new manifest 
+                        previous_keys.difference_update(iter_manifest_keys(geocore_template_bucket_name) or ())
+                        report = delete_filelist_s3(deleted_filelist=sorted(previous_keys), bucket=geocore_to_parquet_bucket_name)
+                        deleted = report['deleted']
+                        if report['errors']: 
+                            error_msg += f"Failed to delete {len(report['errors'])} stale records from {geocore_to_parquet_bucket_name}. "
+                    skipped = dedup.skipped + fan_out_skipped
+                    print(f'Upload dedup: {skipped} unchanged records skipped, {uploaded + fan_out_uploaded - skipped} written, {deleted} stale records deleted')
+                    increment('records_deleted', deleted)
+                lease.clear()
+            else: 
+                error_msg += f'Failed to upload {manifest.name} to bucket: {geocore_template_bucket_name}. '
+            add_phase_time('finalize', time.perf_counter() - phase_start)
     else:
         error_msg = 'Connectivity is fine but not return a HTTP 200 OK for '+  api_root + '/collections' + ' STAC translation is not initiated'
         #return error_msg
+    close_http_cache()
+    log_http_stats()
+    emit_metrics(function_name=getattr(context, 'function_name', None))
     print(error_msg)
 
 
-# requires open_file_s3()
+def log_failed_keys(failed_keys, incremental, log_key): 
+    """Log the keys of the records whose upload failed, the previous version of these records is still in the bucket
+    The keys stay in the key log (and the previous entries in the incremental manifest), so a transient upload error 
+    does not turn into the deletion of a valid record as stale. Called once the submitted uploads are finished.
+    Parameters:
+    - failed_keys: S3 keys of the records that could not be uploaded.
+    - incremental: IncrementalHarvest, or None for a full harvest.
+    - log_key: Function log_key(key, uploaded) writing a key to the key log.
+    """
+    for key in failed_keys: 
+        # A new record that failed has no previous version to keep 
+        kept_key = incremental.mark_failed(key) if incremental else key
+        if kept_key: 
+            log_key(kept_key, uploaded=False)
+
+
+def queue_record(pipeline, incremental, log_key, key, json_data, updated=None):
+    """Queue a translated record for upload
+    In incremental mode, a record that did not change since the previous harvest is only logged in the key log.
+    Parameters:
+    - pipeline: UploadPipeline or ShardWriter of the harvest, see open_output().
+    - incremental: IncrementalHarvest, or None for a full harvest.
+    - log_key: Function log_key(key, uploaded) writing a key to the key log.
+    - key: S3 key of the record.
+    - json_data: GeoCore dictionary.
+    - updated: STAC 'updated' timestamp of the record, if any.
+    """
+    if record_needs_upload(incremental, log_key, key, json_data, updated): 
+        pipeline.submit(key, json_data)
+
+
+def record_needs_upload(incremental, log_key, key, json_data, updated=None):
+    """Return True if a translated record must be uploaded
+    In incremental mode, a record that did not change since the previous harvest is only logged in the key log.
+    """
+    record_id = json_data['features'][0]['properties']['id']
+    if incremental and not incremental.is_changed(record_id, key, json_data, updated): 
+        # Unchanged since the previous harvest, the object in S3 is kept as is 
+        log_key(key, uploaded=False)
+        return False
+    return True
+
+
+def harvest_shard(shard, params, collection_fields, run_id, search_params=None):
+    """Fan-out worker: map and upload the items of one shard, then save the keys in a shard manifest
+    Parameters:
+    - shard: Shard returned by plan_fan_out(), a collection and an optional datetime window.
+    - params: Harvest parameters, see lambda_handler.
+    - collection_fields: Parsed collection fields returned by CollectionIndex.to_fields_dict().
+    - run_id: Identifier of the harvest, the shard manifests of a harvest share the same prefix.
+    - search_params: Page size and fields of the searches returned by negotiate_search_params().
+
+    Returns:
+    - A summary {'shard_id', 'collection', 'manifest', 'items', 'uploaded', 'unchanged', 'skipped', 'failed'}, uploaded counts the skipped 
+      records, whose content was already in the bucket
+    """
+    reset_metrics()
+    # Workers revalidate the cached pages but do not store new ones, the index is saved by the main harvest only 
+    opened_cache = get_http_cache() is None and open_http_cache(read_only=True) is not None
+    template_skeleton = load_geocore_template(geocore_template_bucket_name, geocore_template_name)
+    collection_index = CollectionIndex.from_fields(collection_fields)
+    incremental = IncrementalHarvest(bucket=geocore_template_bucket_name) if harvest_mode == 'incremental' and geocore_output_mode == 'objects' else None
+    # Each worker only lists the objects of its collection 
+    dedup = open_upload_dedup(geocore_to_parquet_bucket_name, prefix=f"{params['source']}-{shard['collection']}-") if geocore_output_mode == 'objects' else None
+    keys = []
+    key_log_lock = threading.Lock()
+    def log_key(key, uploaded=True): 
+        with key_log_lock: 
+            if incremental and uploaded: 
+                incremental.mark_uploaded(key)
+            keys.append(key)
+    item_count = 0
+    search_url, payload = shard_search_request(api_root, shard, search_params)
+    with open_output(bucket=geocore_to_parquet_bucket_name, on_success=log_key, run_id=run_id, name=shard['shard_id'], dedup=dedup) as pipeline: 
+        for page, items_list in timed_iter(search_pages_iter(url=search_url, payload=payload), 'pagination'): 
+            if isinstance(items_list, list): 
+                geometries = page_geometries([item.get('bbox') for item in items_list], ids=[item.get('id') for item in items_list])
+            else: 
+                geometries = None
+            for item_index, item in enumerate(items_list): 
+                if not shard_owns_item(shard, item): 
+                    # Mapped by the shard of the neighbouring datetime window 
+                    increment('items_outside_window')
+                    continue
+                start = time.perf_counter()
+                item_name, item_geocore_updated, item_updated = translate_item(template_skeleton, params, item, collection_index, geometries[item_index] if geometries else None)
+                observe_record('translation', item_name, time.perf_counter() - start)
+                increment('records_translated')
+                queue_record(pipeline, incremental, log_key, item_name, item_geocore_updated, item_updated)
+                item_count += 1
+            items_list = geometries = None
+    log_failed_keys(pipeline.failed, incremental, log_key)
+    log_memory(f"shard {shard['shard_id']}")
+    manifest_name = shard_manifest_name(run_id, shard)
+    summary = {'shard_id': shard['shard_id'], 'collection': shard['collection'], 'manifest': manifest_name, 'items': item_count, 'uploaded': pipeline.uploaded, 
+               'unchanged': incremental.unchanged if incremental else 0, 'skipped': dedup.skipped if dedup else 0, 'failed': len(pipeline.failed)}
+    # The coordinator polls the shard manifests, it merges the keys once the manifest is written 
+    manifest = {'summary': summary, 'keys': keys, 'incremental': incremental.current if incremental else {}}
+    if not upload_file_s3(manifest_name, bucket=geocore_template_bucket_name, json_data=manifest, object_name=None): 
+        raise RuntimeError(f'could not write {manifest_name}')
+    print(f"Shard {shard['shard_id']}: mapped {item_count} items, uploaded {pipeline.uploaded}, {len(pipeline.failed)} failed")
+    increment('records_uploaded', pipeline.uploaded)
+    increment('records_failed', len(pipeline.failed))
+    if opened_cache: 
+        close_http_cache()
+    # Each worker prints the metrics of its shard 
+    emit_metrics(properties={'shard_id': shard['shard_id']})
+    return summary
+
+
+def run_fan_out_worker(shard, **worker_args): 
+    """Fan-out worker entry point, see harvest_shard()
+    A shard that fails still writes a manifest holding its error, so the coordinator does not wait for it until 
+    FAN_OUT_SHARD_TIMEOUT. 
+    """
+    try: 
+        return harvest_shard(shard, **worker_args)
+    except Exception as e: 
+        logging.error(f"Shard {shard['shard_id']} failed: {e}")
+        summary = {'shard_id': shard['shard_id'], 'error': str(e)}
+        upload_file_s3(shard_manifest_name(worker_args['run_id'], shard), bucket=geocore_template_bucket_name, 
+                       json_data={'summary': summary, 'keys': []}, object_name=None)
+        return summary
+
+
+def translate_root(template_skeleton, params):
+    """Map the STAC root catalog to a GeoCore record
+    Parameters:
+    - template_skeleton: GeoCore null template returned by load_geocore_template().
+    - params: Harvest parameters, see lambda_handler.
+
+    Returns:
+    - (S3 key, GeoCore dictionary)
+    """
+    geocore_features_dict = copy_geocore_template(template_skeleton) 
+    # Mapping to geocore features geometry and properties 
+    root_geometry_dict = to_features_geometry(geocore_features_dict, bbox=params['root_bbox'], geometry_type='Polygon')
+    root_properties_dict = root_to_features_properties(params, geocore_features_dict)
+    # Update the geocore body and finish mapping 
+    root_geocore_updated = update_geocore_dict(geocore_features_dict=geocore_features_dict, properties_dict =root_properties_dict ,geometry_dict=root_geometry_dict)
+    root_upload = params['source'] + '-root-' + params['root_id'] + '.geojson'
+    return root_upload, root_geocore_updated
+
+
+def translate_collection(template_skeleton, params, coll_dict, coll_fields=None):
+    """Map a STAC collection to a GeoCore record
+    Parameters:
+    - template_skeleton: GeoCore null template returned by load_geocore_template().
+    - params: Harvest parameters, see lambda_handler.
+    - coll_dict: STAC collection dictionary.
+    - coll_fields: Parsed CollectionFields of the collection, from the collection index (optional).
+
+    Returns:
+    - (S3 key, GeoCore dictionary)
+    """
+    # Fresh copy of the null GeoCore template 
+    geocore_features_dict = copy_geocore_template(template_skeleton) 
+    coll_extent = coll_dict.get('extent')
+    coll_bbox = coll_extent.get('spatial', {}).get('bbox', [None])[0]
+    coll_geometry_dict = to_features_geometry(geocore_features_dict, bbox=coll_bbox, geometry_type='Polygon')
+    coll_properties_dict = coll_to_features_properties(coll_dict=coll_dict, params=params, geocore_features_dict=geocore_features_dict, coll_fields=coll_fields)
+    coll_geocore_updated = update_geocore_dict(geocore_features_dict=geocore_features_dict, properties_dict =coll_properties_dict, geometry_dict=coll_geometry_dict)
+    coll_name = params['source'] + '-' + coll_dict.get('id') + '.geojson'
+    return coll_name, coll_geocore_updated
+
+
+def translate_item(template_skeleton, params, item, collection_index, geometry=None):
+    """Map a STAC item to a GeoCore record
+    Parameters:
+    - template_skeleton: GeoCore null template returned by load_geocore_template().
+    - params: Harvest parameters, see lambda_handler.
+    - item: STAC item dictionary.
+    - collection_index: CollectionIndex of the harvest, for the collection titles, descriptions and keywords.
+    - geometry: BoxGeometry of the item bbox returned by page_geometries(), None computes it from the item.
+
+    Returns:
+    - (S3 key, GeoCore dictionary, STAC 'updated' timestamp of the item or None)
+    """
+    item_id, item_bbox, item_links, item_assets, item_properties,coll_id = get_item_fields(item)
+    geocore_features_dict = copy_geocore_template(template_skeleton)
+    item_geometry_dict = to_features_geometry(geocore_features_dict=geocore_features_dict, bbox=item_bbox, geometry_type='Polygon', 
+                                              coordinates=geometry.coordinates if geometry else None)
+    item_properties_dict = item_to_features_properties(params=params, geocore_features_dict=geocore_features_dict, item_dict=item, 
+                                                       collection_index=collection_index, geometry_wkt=geometry.wkt if geometry else None)
+    item_geocore_updated = update_geocore_dict(geocore_features_dict=geocore_features_dict, properties_dict =item_properties_dict ,geometry_dict=item_geometry_dict)
+    item_name = params['source'] + '-' + coll_id + '-' + item_id + '.geojson'
+    return item_name, item_geocore_updated, item_properties.get('updated')
+
+
+# requires load_geocore_template()
 def get_geocore_template(geocore_template_bucket_name,geocore_template_name):
     """Getting GeoCore null template from S3 bucket  
+    Every call returns a new copy; with GEOCORE_TEMPLATE_CACHE_TTL set, the parsed template is reused instead of re-fetched.
     Parameters:
     - geocore_template_bucket_name: S3 bucket name that stores the GeoCore template.
     - geocore_template_name: Name of the GeoCore template file.
     
     Returns:
-    - A dictionary containing the GeoCore feature, or None if an error occurs. 
+    - A dictionary containing the GeoCore feature, load_geocore_template() raises a RuntimeError if the template cannot be loaded. 
     """  
-    try: 
-        template= open_file_s3(geocore_template_bucket_name, geocore_template_name)
-        if not template: 
-            logging.error("Template not found.")
-            return None           
-        geocore_dict = json.loads(template)
-        return geocore_dict['features'][0] 
-    except ClientError as e:
-        logging.error(f"An error occurred while accessing S3: {e}")
-        return None
-    except json.JSONDecodeError as e:
-        logging.error(f"An error occurred while decoding JSON: {e}")
-        return None
-    except Exception as e:
-        logging.error(f"An unexpected error occurred: {e}")
-        return None
\ No newline at end of file
+    template_skeleton = load_geocore_template(geocore_template_bucket_name, geocore_template_name)
+    return copy_geocore_template(template_skeleton)
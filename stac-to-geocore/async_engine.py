@@ -0,0 +1,322 @@
+import asyncio
+import json
+import logging
+import os
+import time
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlsplit
+
+from http_cache import get_http_cache
+from http_client import (
+    accept_encoding, http_backoff_factor, http_connect_timeout, http_max_retries, http_read_timeout,
+    http_retry_status, record_http_call, stac_get, stac_post,
+)
+from pagination import get_next_request
+from s3_operations import encode_body_timed, s3_endpoint_url, s3_max_pool_connections, upload_file_s3
+from serializers import serialize_json
+from fan_out import plan_fan_out, shard_owns_item, shard_search_request
+from metrics import add_record_time, increment, observe_latency, observe_record
+
+try:
+    import httpx
+except ImportError:
+    httpx = None
+try:
+    from aiobotocore.config import AioConfig
+    from aiobotocore.session import get_session as get_aiobotocore_session
+except ImportError:
+    get_aiobotocore_session = None
+
+# 'sync' runs the harvest loops of lambda_handler, 'async' runs the root, collections and items with asyncio
+harvest_engine = os.environ.get('HARVEST_ENGINE', 'sync').lower()
+# STAC API requests in flight, the item searches of the collections (or datetime windows) run concurrently
+async_fetch_concurrency = int(os.environ.get('ASYNC_FETCH_CONCURRENCY', '16'))
+# S3 PUTs in flight, translation waits when this many uploads are pending (backpressure)
+async_upload_concurrency = int(os.environ.get('ASYNC_UPLOAD_CONCURRENCY', '64'))
+
+
+class AsyncStacClient:
+    """Fetch STAC API json with at most max_concurrency requests in flight
+    Uses httpx when it is installed, otherwise the shared requests session runs in threads.
+    """
+
+    def __init__(self, max_concurrency=None):
+        self.max_concurrency = max_concurrency or async_fetch_concurrency
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._client = None
+        self._executor = None
+
+    async def __aenter__(self):
+        if httpx is not None:
+            self._client = httpx.AsyncClient(
+                timeout=httpx.Timeout(http_read_timeout, connect=http_connect_timeout),
+                limits=httpx.Limits(max_connections=self.max_concurrency),
+                headers={'Accept-Encoding': accept_encoding, 'Accept': 'application/json, application/geo+json'},
+                # retries of the connection errors, 429/5xx responses are retried by get_json()
+                transport=httpx.AsyncHTTPTransport(retries=http_max_retries),
+            )
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=self.max_concurrency)
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        if self._client is not None:
+            await self._client.aclose()
+        if self._executor is not None:
+            self._executor.shutdown(wait=False)
+
+    async def get_json(self, url):
+        """Return the parsed json of a url, or None if it does not return a HTTP 200 OK
+        The responses are revalidated with the HTTP cache when one is open, see http_cache.py.
+        """
+        async with self._semaphore:
+            if self._client is None:
+                return await asyncio.get_running_loop().run_in_executor(self._executor, _get_json_blocking, url)
+            cache = get_http_cache()
+            response = await self._get(url, cache.request_headers(url) if cache else {})
+            if response is None:
+                return None
+            status_code, content = response.status_code, response.content
+            if cache is not None:
+                # The cache reads and writes the bodies in /tmp or S3, outside of the event loop
+                resolve = lambda response: cache.resolve(url, response.status_code, response.headers, response.content)
+                resolved = await asyncio.get_running_loop().run_in_executor(None, resolve, response)
+                if resolved is None:
+                    # 304 for a body that is no longer cached, ask for the full response
+                    response = await self._get(url, {})
+                    if response is None:
+                        return None
+                    resolved = await asyncio.get_running_loop().run_in_executor(None, resolve, response)
+                if resolved is not None:
+                    status_code, content_type, content = resolved
+            if status_code != 200:
+                logging.error(f'Could not fetch {url}: HTTP {status_code}')
+                return None
+            return json.loads(content)
+
+    async def post_json(self, url, payload):
+        """Return the parsed json of a POST request, or None if it does not return a HTTP 200 OK"""
+        async with self._semaphore:
+            if self._client is None:
+                return await asyncio.get_running_loop().run_in_executor(self._executor, _get_json_blocking, url, payload)
+            response = await self._get(url, {}, payload=payload)
+            if response is None:
+                return None
+            if response.status_code != 200:
+                logging.error(f'Could not fetch {url}: HTTP {response.status_code}')
+                return None
+            return json.loads(response.content)
+
+    async def _get(self, url, headers, payload=None):
+        """GET a url (POST the payload), retrying the 429/5xx responses, return the httpx response or None on a connection error"""
+        for attempt in range(http_max_retries + 1):
+            start = time.perf_counter()
+            response = None
+            try:
+                if payload is None:
+                    response = await self._client.get(url, headers=headers)
+                else:
+                    response = await self._client.post(url, headers=headers, json=payload)
+            except httpx.HTTPError as e:
+                logging.error(f'Could not fetch {url}: {e}')
+                return None
+            finally:
+                size = len(response.content) if response is not None else 0
+                error = response is None or response.status_code >= 400
+                record_http_call(urlsplit(url).path or '/', time.perf_counter() - start, size, error)
+            if response.status_code not in http_retry_status or attempt == http_max_retries:
+                break
+            retry_after = response.headers.get('Retry-After')
+            delay = float(retry_after) if retry_after and retry_after.isdigit() else http_backoff_factor * 2 ** attempt
+            await asyncio.sleep(delay)
+        return response
+
+
+def _get_json_blocking(url, payload=None):
+    r = stac_get(url) if payload is None else stac_post(url, json=payload)
+    try:
+        if r.status_code != 200:
+            logging.error(f'Could not fetch {url}: HTTP {r.status_code}')
+            return None
+        return r.json()
+    finally:
+        r.close()
+
+
+class AsyncUploader:
+    """Upload GeoCore records with at most max_concurrency PUTs in flight
+    Uses aiobotocore when it is installed, otherwise upload_file_s3() runs in threads.
+    on_success(key) is called for each uploaded record, uploaded and failed count the results.
+    With an UploadDedup, the records already in the bucket with the same content are not written again.
+    """
+
+    def __init__(self, bucket, on_success=None, max_concurrency=None, dedup=None):
+        self.bucket = bucket
+        self.on_success = on_success
+        self.dedup = dedup
+        self.max_concurrency = max_concurrency or async_upload_concurrency
+        self.uploaded = 0
+        self.failed = []
+        self._semaphore = asyncio.Semaphore(self.max_concurrency)
+        self._tasks = set()
+        self._client = None
+        self._client_context = None
+        self._executor = None
+
+    async def __aenter__(self):
+        if get_aiobotocore_session is not None:
+            config = AioConfig(max_pool_connections=self.max_concurrency, retries={'max_attempts': 5, 'mode': 'standard'})
+            self._client_context = get_aiobotocore_session().create_client('s3', config=config, endpoint_url=s3_endpoint_url)
+            self._client = await self._client_context.__aenter__()
+        else:
+            self._executor = ThreadPoolExecutor(max_workers=min(self.max_concurrency, s3_max_pool_connections))
+        return self
+
+    async def __aexit__(self, exc_type, exc_value, traceback):
+        await self.drain()
+        if self._client_context is not None:
+            await self._client_context.__aexit__(exc_type, exc_value, traceback)
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+
+    async def submit(self, key, json_data):
+        """Start the upload of a record, waits while max_concurrency uploads are in flight"""
+        await self._semaphore.acquire()
+        task = asyncio.ensure_future(self._upload(key, json_data))
+        self._tasks.add(task)
+        task.add_done_callback(self._done)
+
+    async def drain(self):
+        """Wait for the uploads started so far"""
+        while self._tasks:
+            await asyncio.gather(*list(self._tasks), return_exceptions=True)
+
+    def _done(self, task):
+        self._tasks.discard(task)
+        self._semaphore.release()
+
+    async def _upload(self, key, json_data):
+        try:
+            if self._client is not None:
+                start = time.perf_counter()
+                body = serialize_json(json_data)
+                add_record_time('serialization', time.perf_counter() - start)
+                body, encoding = encode_body_timed(body)
+                encoded = time.perf_counter()
+                if self.dedup is not None and self.dedup.unchanged(key, body):
+                    increment('s3_put_skipped')
+                else:
+                    extra = {'ContentEncoding': encoding} if encoding else {}
+                    try:
+                        await self._client.put_object(Bucket=self.bucket, Key=key, Body=body, **extra)
+                    finally:
+                        observe_latency('s3_put', time.perf_counter() - encoded)
+                    observe_record('upload', key, time.perf_counter() - encoded)
+                    increment('s3_put_bytes', len(body))
+                success = True
+            else:
+                success = await asyncio.get_running_loop().run_in_executor(
+                    self._executor, upload_file_s3, key, self.bucket, json_data, None, self.dedup)
+        except Exception as e:
+            logging.error(f'Upload of {key} failed: {e}')
+            success = False
+        if success:
+            self.uploaded += 1
+            if self.on_success:
+                self.on_success(key)
+        else:
+            self.failed.append(key)
+
+
+async def search_pages_async(client, url, payload=None):
+    """Async search_pages_iter(): yield the features of the valid pages of a search, see pagination.py"""
+    returned = 0
+    next_page = url
+    while next_page:
+        start = time.perf_counter()
+        j = await (client.get_json(next_page) if payload is None else client.post_json(next_page, payload))
+        add_record_time('pagination', time.perf_counter() - start)
+        if j is None:
+            break
+        # Test the returns total against total matched
+        returned += j['context']['returned']
+        if returned < j['context']['matched']:
+            next_page, payload = get_next_request(j['links'], payload)
+        else:
+            next_page = None
+        features = j.get('features', [])
+        del j
+        if returned > 0:
+            yield features
+
+
+async def harvest_async(api_root, bucket, params, template_skeleton, collection_index, translate_root,
+                        translate_collection, translate_item, accept_record=None, on_success=None, search_params=None,
+                        dedup=None):
+    """Run the root, collections and items mapping with asyncio
+    The item searches of the collections (or of their datetime windows, see FAN_OUT_PLANNER) are paginated
+    concurrently, each record is translated by the same mapping functions as the sync engine and uploaded
+    while the next ones are translated. The translations run in a worker thread, one at a time, so the event
+    loop keeps the requests and the uploads moving. The async engine does not save checkpoints.
+    Parameters:
+    - api_root: url of the STAC API root.
+    - bucket: GeoCore bucket name.
+    - params, template_skeleton, collection_index: see lambda_handler.
+    - translate_root, translate_collection, translate_item: the record mapping functions of app.py.
+    - accept_record: function accept_record(key, json_data, updated) returning False for the records that are
+      not uploaded (unchanged records of an incremental harvest), default uploads every record.
+    - on_success: function on_success(key) called for each uploaded record.
+    - search_params: page size and fields of the item searches returned by negotiate_search_params().
+    - dedup: UploadDedup skipping the records already in the bucket, see upload_dedup.py.
+
+    Returns:
+    - A report {'records', 'items', 'uploaded', 'failed'}, failed is the list of keys that could not be uploaded
+    """
+    report = {'records': 0, 'items': 0}
+    loop = asyncio.get_running_loop()
+    # A single thread, the mapping functions are not run concurrently
+    translator = ThreadPoolExecutor(max_workers=1, thread_name_prefix='translate')
+
+    async def translate(function, *args):
+        start = time.perf_counter()
+        result = await loop.run_in_executor(translator, function, template_skeleton, params, *args)
+        observe_record('translation', result[0], time.perf_counter() - start)
+        return result
+
+    try:
+        async with AsyncStacClient() as client, AsyncUploader(bucket, on_success=on_success, dedup=dedup) as uploader:
+            async def emit(key, json_data, updated=None):
+                report['records'] += 1
+                increment('records_translated')
+                if accept_record is None or accept_record(key, json_data, updated):
+                    await uploader.submit(key, json_data)
+
+            root_key, root_geocore = await translate(translate_root)
+            await emit(root_key, root_geocore)
+            for coll_dict in collection_index.collections:
+                coll_key, coll_geocore = await translate(translate_collection, coll_dict, collection_index.get(coll_dict.get('id')))
+                await emit(coll_key, coll_geocore, coll_dict.get('updated'))
+            print(f"Mapped the root and {len(collection_index.collections)} collections, mapping the items")
+
+            async def harvest_shard_async(shard):
+                async for items_list in search_pages_async(client, *shard_search_request(api_root, shard, search_params)):
+                    for item in items_list:
+                        if not shard_owns_item(shard, item):
+                            increment('items_outside_window')
+                            continue
+                        item_key, item_geocore, item_updated = await translate(translate_item, item, collection_index)
+                        report['items'] += 1
+                        await emit(item_key, item_geocore, item_updated)
+
+            # The planner probes are blocking requests
+            shards = await loop.run_in_executor(None, plan_fan_out, api_root, collection_index.collections)
+            await asyncio.gather(*(harvest_shard_async(shard) for shard in shards))
+    finally:
+        translator.shutdown(wait=False, cancel_futures=True)
+    report.update({'uploaded': uploader.uploaded, 'failed': uploader.failed})
+    return report
+
+
+def run_async_harvest(*args, **kwargs):
+    """Run harvest_async() in a new event loop, see harvest_async() for the parameters"""
+    return asyncio.run(harvest_async(*args, **kwargs))
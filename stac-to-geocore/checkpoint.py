@@ -0,0 +1,221 @@
+import json
+import logging
+import os
+import time
+import uuid
+
+import boto3
+from botocore.exceptions import ClientError
+
+from run_manifest import ManifestWriter
+from s3_operations import get_s3_client
+
+# Cursor of an unfinished harvest and the state of its run manifest, stored in the template bucket
+checkpoint_name = os.environ.get('HARVEST_CHECKPOINT_NAME', 'harvestCheckpoint.json')
+# Seconds between two checkpoints, so a hard timeout loses at most this much work
+checkpoint_interval = float(os.environ.get('HARVEST_CHECKPOINT_INTERVAL', '60'))
+# Remaining seconds of the invocation at which the harvest stops and hands over to the next invocation
+checkpoint_margin = float(os.environ.get('HARVEST_CHECKPOINT_MARGIN', '120'))
+# 'true' invokes the function again asynchronously to continue, 'false' waits for the next scheduled run
+self_invoke = os.environ.get('HARVEST_SELF_INVOKE', 'true').lower() == 'true'
+# Invocations that may resume a checkpoint without saving a new one, a checkpoint that keeps failing is given up
+checkpoint_max_attempts = int(os.environ.get('HARVEST_CHECKPOINT_MAX_ATTEMPTS', '3'))
+
+
+def new_cursor():
+    """Return the cursor of a harvest that starts from the beginning
+    - phase: 'root', 'collections' or 'items'
+    - coll_index: index of the next collection to map
+    - page: url of the search page being mapped, None for the first page
+    - returned: number of items returned by the search pages before this page
+    - item_offset: number of items of this page that are already mapped
+    - item_count: number of items mapped by the harvest so far
+    - manifest: ManifestWriter.state() of the run manifest, set by the checkpoints
+    - shard: ShardWriter.state() of the open shard of the ndjson and geoparquet outputs, set by the checkpoints
+    - lease: {'owner', 'expires'} of the invocation running the harvest, see CheckpointLease
+    - attempts: invocations that resumed this checkpoint, reset by every new checkpoint
+    """
+    return {'phase': 'root', 'coll_index': 0, 'page': None, 'returned': 0, 'item_offset': 0, 'item_count': 0}
+
+
+def load_checkpoint(bucket):
+    """Return (cursor, ETag) of the saved checkpoint of an unfinished harvest, or (None, None) if the last harvest finished
+    :param bucket: template bucket name
+    """
+    try:
+        response = get_s3_client().get_object(Bucket=bucket, Key=checkpoint_name)
+        return json.loads(response['Body'].read()), response['ETag']
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+            logging.error(e)
+        return None, None
+
+
+def save_checkpoint(bucket, cursor, manifest=None, etag=None):
+    """Save the cursor and the state of the run manifest, so the next invocation can resume the harvest
+    The manifest parts are uploaded first: a checkpoint always refers to a manifest that includes its records.
+    The write is conditional: it replaces the checkpoint only if its ETag is still etag, without etag it only
+    creates a checkpoint that does not exist yet.
+    :param bucket: template bucket name
+    :param cursor: harvest cursor, see new_cursor()
+    :param manifest: ManifestWriter of the harvest
+    :param etag: ETag of the checkpoint read or saved last by this invocation
+    :return: the ETag of the saved checkpoint, None if it could not be saved, or False if another invocation
+             changed the checkpoint since etag
+    """
+    if manifest is not None:
+        cursor['manifest'] = manifest.state()
+    condition = {'IfMatch': etag} if etag else {'IfNoneMatch': '*'}
+    try:
+        response = get_s3_client().put_object(Bucket=bucket, Key=checkpoint_name, Body=json.dumps(cursor).encode('utf-8'), **condition)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') in ('PreconditionFailed', 'ConditionalRequestConflict', '412', '409'):
+            logging.error(f'{checkpoint_name} was changed by another invocation')
+            return False
+        logging.error(e)
+        return None
+    return response['ETag']
+
+
+def clear_checkpoint(bucket, etag=None):
+    """Delete the checkpoint once the harvest finished and its manifest is stored
+    :param etag: ETag of the checkpoint saved last by this invocation, a checkpoint changed since then is kept
+    """
+    condition = {'IfMatch': etag} if etag else {}
+    try:
+        get_s3_client().delete_object(Bucket=bucket, Key=checkpoint_name, **condition)
+    except ClientError as e:
+        logging.error(e)
+
+
+def invoke_continuation(context, event):
+    """Invoke this Lambda function again, asynchronously, to continue the harvest from the checkpoint
+    :param context: Lambda context of the current invocation
+    :param event: event of the next invocation
+    """
+    try:
+        boto3.client('lambda').invoke(FunctionName=context.function_name, InvocationType='Event', Payload=json.dumps(event).encode('utf-8'))
+        print(f'Invoked {context.function_name} to continue the harvest')
+        return True
+    except ClientError as e:
+        logging.error(e)
+        return False
+
+
+class CheckpointTimer:
+    """Tell the harvest loops when to save a checkpoint and when to hand over to the next invocation"""
+
+    def __init__(self, context, interval=None, margin=None):
+        self.context = context
+        self.interval = checkpoint_interval if interval is None else interval
+        self.margin = checkpoint_margin if margin is None else margin
+        self.last_saved = time.monotonic()
+
+    def save_due(self):
+        return time.monotonic() - self.last_saved >= self.interval
+
+    def hand_over_due(self):
+        # Local runs have no Lambda context and never hand over
+        remaining = getattr(self.context, 'get_remaining_time_in_millis', None)
+        return remaining is not None and remaining() / 1000 < self.margin
+
+    def saved(self):
+        self.last_saved = time.monotonic()
+
+
+class CheckpointLease:
+    """Make sure a single invocation runs the harvest of a checkpoint.
+
+    The checkpoint holds the lease {'owner', 'expires'} of the invocation that saved it, which owns the harvest
+    until the end of its Lambda timeout. Another invocation that finds the lease running (e.g. a scheduled run
+    while a continuation is in flight) does not start. A hand over passes the lease to the continuation with a
+    token of its event. The checkpoint is only written with the ETag this invocation read or wrote last, so of
+    two invocations taking the same expired lease, one gets a 412 and stops.
+
+    attempts counts the invocations that resumed the checkpoint since the last one that saved a new checkpoint,
+    past max_attempts the checkpoint is given up: it is deleted and the next run starts a new harvest.
+
+    Example
+    -------
+    lease = CheckpointLease(bucket, context)
+    cursor = lease.acquire(event)
+    if cursor is None:
+        cursor = new_cursor()
+        lease.claim(cursor)
+    ...
+    lease.save(cursor, manifest, hand_over=True)
+    invoke_continuation(context, {'resume': True, 'lease': lease.next_owner})
+    """
+
+    def __init__(self, bucket, context, max_attempts=None):
+        self.bucket = bucket
+        self.context = context
+        self.max_attempts = checkpoint_max_attempts if max_attempts is None else max_attempts
+        self.owner = getattr(context, 'aws_request_id', None) or uuid.uuid4().hex
+        self.etag = None
+        # Token of the continuation, set by a hand over
+        self.next_owner = None
+        # True once another invocation changed the checkpoint, this invocation must stop
+        self.lost = False
+
+    def acquire(self, event=None):
+        """Load the checkpoint of an unfinished harvest and take its lease
+        :param event: event of the invocation, a continuation holds the 'lease' token of its hand over
+        :return: the cursor to resume, None if there is no checkpoint, or False if this invocation must not
+                 run the harvest (the lease is held by another invocation, or the checkpoint was given up)
+        """
+        cursor, self.etag = load_checkpoint(self.bucket)
+        if cursor is None:
+            return None
+        lease = cursor.get('lease') or {}
+        handed_over = lease.get('owner') is not None and (event or {}).get('lease') == lease['owner']
+        if not handed_over and lease.get('expires', 0) > time.time():
+            print(f"The harvest is run by another invocation until {time.strftime('%H:%M:%S', time.gmtime(lease['expires']))} UTC")
+            return False
+        cursor['attempts'] = cursor.get('attempts', 0) + 1
+        if cursor['attempts'] > self.max_attempts:
+            logging.error(f"Giving up {checkpoint_name}: {self.max_attempts} invocations resumed it without saving a new checkpoint, "
+                          "the next run starts a new harvest")
+            if cursor.get('manifest'):
+                ManifestWriter.resume(self.bucket, cursor['manifest']).abort()
+            clear_checkpoint(self.bucket, self.etag)
+            return False
+        return cursor if self._write(cursor) else False
+
+    def claim(self, cursor):
+        """Save the first checkpoint of a new harvest, return False if another invocation started one first"""
+        self.etag = None
+        return self._write(cursor)
+
+    def save(self, cursor, manifest=None, hand_over=False):
+        """Save a checkpoint of the harvest, see save_checkpoint()
+        :param hand_over: the lease goes to the continuation invoked with next_owner, or to the next run without self invoke
+        :return: False if another invocation took the checkpoint, this invocation must stop
+        """
+        cursor['attempts'] = 0
+        self.next_owner = uuid.uuid4().hex if hand_over and self_invoke else None
+        return self._write(cursor, manifest, hand_over)
+
+    def clear(self):
+        """Delete the checkpoint once the harvest finished, unless another invocation took it"""
+        if not self.lost:
+            clear_checkpoint(self.bucket, self.etag)
+
+    def _write(self, cursor, manifest=None, hand_over=False):
+        if hand_over:
+            # The continuation has until the margin to start, an expired lease is taken by the next run
+            cursor['lease'] = {'owner': self.next_owner, 'expires': time.time() + checkpoint_margin if self.next_owner else 0}
+        else:
+            cursor['lease'] = {'owner': self.owner, 'expires': time.time() + self._remaining()}
+        etag = save_checkpoint(self.bucket, cursor, manifest, self.etag)
+        if etag is False:
+            self.lost = True
+            return False
+        if etag:
+            self.etag = etag
+        return True
+
+    def _remaining(self):
+        # Local runs have no Lambda context, their lease lasts a checkpoint interval
+        remaining = getattr(self.context, 'get_remaining_time_in_millis', None)
+        return remaining() / 1000 if remaining is not None else checkpoint_interval + checkpoint_margin
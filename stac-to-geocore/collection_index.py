@@ -0,0 +1,99 @@
+import logging
+from collections import namedtuple
+
+from http_client import stac_get
+from pagination import get_next_page
+from stac_to_geocore import get_collection_fields, build_item_prototype
+
+# Parsed fields of a STAC collection used by the collection and item mappers
+CollectionFields = namedtuple('CollectionFields', [
+    'id', 'bbox', 'time_begin', 'time_end', 'title_en', 'title_fr',
+    'description_en', 'description_fr', 'keywords_en', 'keywords_fr',
+])
+
+
+def parse_collection_fields(coll_dict):
+    """Return the CollectionFields of a STAC collection dictionary, see get_collection_fields()"""
+    (coll_id, coll_bbox, time_begin, time_end, coll_links, coll_assets, title_en, title_fr,
+     description_en, description_fr, keywords_en, keywords_fr) = get_collection_fields(coll_dict)
+    return CollectionFields(coll_id, coll_bbox, time_begin, time_end, title_en, title_fr,
+                            description_en, description_fr, keywords_en, keywords_fr)
+
+
+class CollectionIndex:
+    """The collections of a STAC API, fetched and parsed once per harvest.
+
+    - collections: the STAC collection dictionaries, in the order of the API, for the collection mapping
+    - get(coll_id): the parsed CollectionFields of a collection, for the collection and item mappings
+    - item_prototype(coll_id, params): the GeoCore properties shared by the items of a collection, built once
+
+    Example
+    -------
+    collection_index = CollectionIndex.from_api('https://datacube.services.geo.ca/api')
+    for coll_dict in collection_index.collections:
+        coll_fields = collection_index.get(coll_dict['id'])
+    """
+
+    def __init__(self, collections=None, fields=None):
+        self.collections = collections or []
+        self._fields = fields if fields is not None else {
+            coll_dict.get('id'): parse_collection_fields(coll_dict) for coll_dict in self.collections}
+        self._item_prototypes = {}
+
+    @classmethod
+    def from_api(cls, api_root):
+        """Fetch every page of the /collections endpoint, following the next links
+        :param api_root: url of the STAC API root
+        """
+        collections = []
+        next_page = f'{api_root}/collections/'
+        visited = set()
+        while next_page and next_page not in visited:
+            visited.add(next_page)
+            r = stac_get(next_page)
+            if r.status_code != 200:
+                logging.error(f'Could not fetch {next_page}: HTTP {r.status_code}, the collection list may be incomplete')
+                break
+            j = r.json()
+            page_collections = j.get('collections', [])
+            collections.extend(page_collections)
+            # An empty page ends the pagination, even when the API still sends a next link
+            next_page = get_next_page(j.get('links', [])) if page_collections else None
+        print(f'Fetched {len(collections)} collections from {api_root}/collections/')
+        return cls(collections)
+
+    @classmethod
+    def from_fields(cls, fields_dict):
+        """Rebuild an index (without the collection dictionaries) from to_fields_dict(), used by the fan-out workers"""
+        return cls(fields={coll_id: CollectionFields(*values) for coll_id, values in fields_dict.items()})
+
+    def to_fields_dict(self):
+        """Return the parsed fields as a json serializable dictionary {coll_id: [field values]}"""
+        return {coll_id: list(fields) for coll_id, fields in self._fields.items()}
+
+    def ids(self):
+        """Return the ids of the indexed collections"""
+        return list(self._fields)
+
+    def get(self, coll_id, default=None):
+        """Return the CollectionFields of a collection, or default if the collection is unknown"""
+        return self._fields.get(coll_id, default)
+
+    def item_prototype(self, coll_id, params):
+        """Return the invariant item properties of a collection, see build_item_prototype()
+        The prototypes are cached for the harvest, params must not change between calls.
+        """
+        prototype = self._item_prototypes.get(coll_id)
+        if prototype is None:
+            prototype = self._item_prototypes[coll_id] = build_item_prototype(params, coll_id, self.get(coll_id))
+        return prototype
+
+    def release_collections(self):
+        """Drop the collection dictionaries once the collections are mapped, the parsed fields are kept"""
+        self.collections = []
+
+    def __contains__(self, coll_id):
+        return coll_id in self._fields
+
+    def __len__(self):
+        return len(self._fields)
@@ -0,0 +1,422 @@
+import json
+import logging
+import multiprocessing
+import os
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, ThreadPoolExecutor, wait
+from datetime import datetime, timedelta, timezone
+from urllib.parse import urlencode
+
+import boto3
+from botocore.exceptions import BotoCoreError, ClientError
+from dateutil.parser import isoparse
+
+from http_client import stac_post
+from pagination import add_search_params
+from run_manifest import iter_manifest_keys
+from s3_operations import delete_filelist_s3, list_etags_s3, open_file_s3
+
+# 'linear' maps every item through one /search pagination, 'fan-out' dispatches the items of each
+# collection (or of each datetime window of a collection) to parallel workers
+harvest_strategy = os.environ.get('HARVEST_STRATEGY', 'linear').lower()
+# 'lambda' invokes this function once per shard, 'process' runs the shards in a local process pool.
+# The process pool needs /dev/shm, which AWS Lambda does not provide, use it for local or container runs.
+fan_out_backend = os.environ.get('FAN_OUT_BACKEND', 'lambda').lower()
+fan_out_workers = int(os.environ.get('FAN_OUT_WORKERS', '8'))
+# Split the collections into datetime windows of this many days, 0 keeps one shard per collection
+fan_out_window_days = int(os.environ.get('FAN_OUT_WINDOW_DAYS', '0'))
+# 'windows' plans the shards with FAN_OUT_WINDOW_DAYS, 'matched' sizes the datetime windows of each collection
+# from the context.matched of POST /search probes and splits them until they hold at most FAN_OUT_SHARD_ITEMS
+fan_out_planner = os.environ.get('FAN_OUT_PLANNER', 'windows').lower()
+fan_out_shard_items = int(os.environ.get('FAN_OUT_SHARD_ITEMS', '10000'))
+# Windows shorter than this are not split further, whatever their number of items
+_min_window = timedelta(seconds=1)
+# Seconds between two listings of the shard manifests by the coordinator
+fan_out_poll_interval = float(os.environ.get('FAN_OUT_POLL_SECONDS', '5'))
+# A dispatched shard without a manifest after this many seconds is failed (worker timeout, dropped event)
+fan_out_shard_timeout = float(os.environ.get('FAN_OUT_SHARD_TIMEOUT', '1800'))
+# Prefix of the key manifests written by the workers in the template bucket
+fan_out_prefix = 'fanOut/'
+
+
+def plan_shards(collection_data_list, window_days=None):
+    """Split the item harvest into independent shards
+    :param collection_data_list: list of STAC collection dictionaries
+    :param window_days: length of the datetime windows, default is FAN_OUT_WINDOW_DAYS
+    :return a list of shards {'shard_id', 'collection', 'datetime'}, datetime is a STAC interval or None
+    """
+    window_days = fan_out_window_days if window_days is None else window_days
+    shards = []
+    for coll_dict in collection_data_list:
+        coll_id = coll_dict.get('id')
+        interval = (coll_dict.get('extent') or {}).get('temporal', {}).get('interval', [[None, None]])[0]
+        begin = _parse_datetime(interval[0])
+        if not window_days or begin is None:
+            shards.append({'shard_id': coll_id, 'collection': coll_id, 'datetime': None})
+            continue
+        end = _parse_datetime(interval[1]) or datetime.now(timezone.utc)
+        bounds = []
+        start = begin
+        while start < end:
+            bounds.append(start)
+            start += timedelta(days=window_days)
+        # Open ended first and last windows, so items outside of the collection extent are not missed
+        for i, start in enumerate(bounds):
+            lower = '..' if i == 0 else _format_datetime(start)
+            upper = '..' if i == len(bounds) - 1 else _format_datetime(bounds[i + 1] - timedelta(milliseconds=1))
+            shards.append({'shard_id': f'{coll_id}-{i}', 'collection': coll_id, 'datetime': f'{lower}/{upper}', 'owns_undated': i == 0})
+        if not bounds:
+            shards.append({'shard_id': coll_id, 'collection': coll_id, 'datetime': None})
+    return shards
+
+
+def plan_fan_out(api_root, collection_data_list):
+    """Return the shards of the item harvest, planned as FAN_OUT_PLANNER says"""
+    if fan_out_planner == 'matched':
+        return plan_search_queries(api_root, collection_data_list)
+    return plan_shards(collection_data_list)
+
+
+def plan_search_queries(api_root, collection_data_list, max_items=None, max_workers=None):
+    """Split the item harvest into POST /search shards of at most max_items items
+    Each collection is probed with a limit=1 search, a collection (then a datetime window) that matches more
+    than max_items items is split in two windows at the middle of its temporal extent, and the halves are probed
+    again, level by level with max_workers probes in flight. The first and last windows are open ended, the
+    windows without items are dropped. A window is larger than max_items when it cannot be split: a collection
+    without a temporal extent or a search without context.matched, a window shorter than 2 seconds, or a window
+    whose halves both match all of its items (items with start and end datetimes spanning the window).
+    :param api_root: url of the STAC API root
+    :param collection_data_list: list of STAC collection dictionaries
+    :param max_items: largest number of items of a shard, default is FAN_OUT_SHARD_ITEMS
+    :param max_workers: number of probes in flight, default is FAN_OUT_WORKERS
+    :return a list of shards {'shard_id', 'collection', 'datetime', 'matched', 'method'}, see plan_shards()
+    """
+    max_items = max_items or fan_out_shard_items
+    search_url = f'{api_root}/search'
+    now = datetime.now(timezone.utc)
+    windows = {}
+    # Windows to probe, in groups of the two halves of a split window (a collection to begin with). start and
+    # stop (excluded) are None for an open ended window, begin and end bound the collection temporal extent.
+    frontier = []
+    for coll_dict in collection_data_list:
+        coll_id = coll_dict.get('id')
+        interval = (coll_dict.get('extent') or {}).get('temporal', {}).get('interval', [[None, None]])[0]
+        windows[coll_id] = []
+        frontier.append([{'collection': coll_id, 'start': None, 'stop': None, 'begin': _parse_datetime(interval[0]),
+                          'end': _parse_datetime(interval[1]) or now, 'matched': None}])
+    probes = 0
+    with ThreadPoolExecutor(max_workers=max_workers or fan_out_workers) as executor:
+        while frontier:
+            probed = [window for group in frontier for window in group]
+            counts = executor.map(lambda window: probe_matched(search_url, _window_query(window)), probed)
+            for window, matched in zip(probed, counts):
+                window['matched'] = matched
+            probes += len(probed)
+            next_frontier = []
+            for group in frontier:
+                if len(group) == 2 and group[0]['matched'] == group[1]['matched'] == group[0]['parent_matched']:
+                    # Every item of the parent window spans its middle (start and end datetimes), splitting it
+                    # further would only repeat the same items in more shards
+                    parent = dict(group[0], stop=group[1]['stop'], matched=group[0]['parent_matched'])
+                    windows[parent['collection']].append(parent)
+                    continue
+                for window in group:
+                    matched = window['matched']
+                    if matched == 0:
+                        continue
+                    lower = window['start'] or window['begin']
+                    upper = window['stop'] or window['end']
+                    if matched is None or matched <= max_items or lower is None or upper - lower < 2 * _min_window:
+                        windows[window['collection']].append(window)
+                        continue
+                    middle = lower + timedelta(milliseconds=(upper - lower) // timedelta(milliseconds=1) // 2)
+                    next_frontier.append([dict(window, stop=middle, parent_matched=matched),
+                                          dict(window, start=middle, parent_matched=matched)])
+            frontier = next_frontier
+    shards = []
+    for coll_id, coll_windows in windows.items():
+        coll_windows.sort(key=lambda window: window['start'] or datetime.min.replace(tzinfo=timezone.utc))
+        for i, window in enumerate(coll_windows):
+            query = _window_query(window)
+            shard_id = coll_id if len(coll_windows) == 1 else f'{coll_id}-{i}'
+            shards.append({'shard_id': shard_id, 'collection': coll_id, 'datetime': query.get('datetime'),
+                           'matched': window['matched'], 'method': 'POST', 'owns_undated': i == 0})
+    print(f'Planned {len(shards)} shards of at most {max_items} items with {probes} /search probes')
+    return shards
+
+
+def probe_matched(search_url, query):
+    """Return the number of items matched by a POST /search query, or None when the API does not report it"""
+    r = stac_post(search_url, json=dict(query, limit=1))
+    try:
+        if r.status_code != 200:
+            logging.error(f'Could not probe {search_url} with {query}: HTTP {r.status_code}')
+            return None
+        j = r.json()
+    except ValueError as e:
+        logging.error(f'Could not probe {search_url} with {query}: {e}')
+        return None
+    finally:
+        r.close()
+    # STAC API 1.0 reports numberMatched, the context extension (Franklin) context.matched
+    matched = j.get('numberMatched', (j.get('context') or {}).get('matched'))
+    return int(matched) if matched is not None else None
+
+
+def _window_query(window):
+    query = {'collections': [window['collection']]}
+    if window['start'] or window['stop']:
+        lower = _format_datetime(window['start']) if window['start'] else '..'
+        upper = _format_datetime(window['stop'] - timedelta(milliseconds=1)) if window['stop'] else '..'
+        query['datetime'] = f'{lower}/{upper}'
+    return query
+
+
+def shard_search_url(api_root, shard):
+    """Return the /search url of the items of a shard"""
+    query = {'collections': shard['collection']}
+    if shard.get('datetime'):
+        query['datetime'] = shard['datetime']
+    return f'{api_root}/search?{urlencode(query)}'
+
+
+def shard_search_request(api_root, shard, search_params=None):
+    """Return the (url, POST payload) of the /search of a shard, the payload is None for a GET search
+    :param search_params: page size and fields of the search returned by negotiate_search_params()
+    """
+    if shard.get('method') != 'POST':
+        return add_search_params(shard_search_url(api_root, shard), None, search_params)
+    payload = {'collections': [shard['collection']]}
+    if shard.get('datetime'):
+        payload['datetime'] = shard['datetime']
+    return add_search_params(f'{api_root}/search', payload, search_params)
+
+
+def shard_owns_item(shard, item):
+    """Return False for an item that belongs to another datetime window of the collection
+    A search matches the items whose datetime range intersects the window, an item spanning a window boundary
+    is returned by the searches of both windows. Each item is owned by the window of its datetime (or its
+    start_datetime), so every item id is mapped by exactly one shard. An item without a datetime that can be
+    parsed is owned by the first window of its collection only.
+    """
+    if not shard.get('datetime'):
+        return True
+    properties = item.get('properties') or {}
+    anchor = _parse_datetime(properties.get('datetime') or properties.get('start_datetime'))
+    if anchor is None:
+        return bool(shard.get('owns_undated'))
+    lower, upper = shard['datetime'].split('/')
+    if lower not in ('', '..') and anchor < _parse_datetime(lower):
+        return False
+    # The upper bound is the last millisecond of the window
+    if upper not in ('', '..') and anchor >= _parse_datetime(upper) + timedelta(milliseconds=1):
+        return False
+    return True
+
+
+def shard_manifest_name(run_id, shard):
+    """Return the template bucket key of the key manifest written by a shard worker"""
+    return f"{fan_out_prefix}{run_id}/{shard['shard_id']}.json"
+
+
+def new_fan_out_state(shards):
+    """Return the dispatch state of the planned shards, saved in the harvest checkpoints
+    - pending: shards that are not dispatched yet
+    - running: shard id -> {'shard', 'started'}, the dispatched shards whose manifest is not merged yet
+    - done: summaries of the merged shards
+    - failed: shards that failed or timed out
+    """
+    return {'pending': list(shards), 'running': {}, 'done': [], 'failed': []}
+
+
+class ShardDispatcher:
+    """Dispatch the shards of a fan-out harvest and collect the manifests written by the workers.
+
+    The 'lambda' backend invokes this function asynchronously (InvocationType Event) once per shard, with at most
+    max_workers shards running at the same time. A worker does not return its result to the coordinator: it
+    writes its summary and its keys in a shard manifest, and poll() returns the manifests of the shards that
+    finished since the previous call. The dispatch state (see new_fan_out_state()) is saved in the harvest
+    checkpoints, a coordinator that hands over to the next invocation does not dispatch the running shards
+    again, the next invocation keeps waiting for their manifests. A shard without a manifest after
+    FAN_OUT_SHARD_TIMEOUT seconds is failed.
+
+    The 'process' backend runs the workers in a local process pool, the shards that were running when a
+    coordinator stopped are dispatched again.
+
+    Example
+    -------
+    dispatcher = ShardDispatcher(new_fan_out_state(shards), worker, worker_args, run_id, bucket, context)
+    while not dispatcher.finished():
+        for manifest in dispatcher.poll():
+            ...
+    dispatcher.close()
+    """
+
+    def __init__(self, state, worker, worker_args, run_id, bucket, context=None, backend=None, max_workers=None):
+        """
+        :param state: dispatch state returned by new_fan_out_state(), updated in place
+        :param worker: function worker(shard, **worker_args) used by the 'process' backend
+        :param worker_args: json serializable keyword arguments of the worker, the 'collection_fields' sent to a
+                            worker only hold the collection of its shard (an Event payload is limited to 256 KB)
+        :param run_id: identifier of the harvest, the prefix of the shard manifests
+        :param bucket: template bucket name, where the workers write the shard manifests
+        :param context: Lambda context, its function is invoked once per shard by the 'lambda' backend
+        :param backend: 'lambda' or 'process', default is FAN_OUT_BACKEND
+        :param max_workers: number of shards running at the same time, default is FAN_OUT_WORKERS
+        """
+        self.state = state
+        self.worker = worker
+        self.worker_args = worker_args
+        self.run_id = run_id
+        self.bucket = bucket
+        self.context = context
+        self.backend = backend or fan_out_backend
+        self.max_workers = max_workers or fan_out_workers
+        self._lambda_client = None
+        self._executor = None
+        self._futures = {}
+        if self.backend != 'lambda' and state['running']:
+            # The process pool of the previous invocation is gone with its workers
+            state['pending'] = [entry['shard'] for entry in state['running'].values()] + state['pending']
+            state['running'] = {}
+
+    def finished(self):
+        """Return True once every shard is merged or failed"""
+        return not self.state['pending'] and not self.state['running']
+
+    def poll(self):
+        """Dispatch the pending shards that fit in max_workers, then return the manifests of the finished shards
+        Waits up to FAN_OUT_POLL_SECONDS when no shard finished. A manifest is {'summary', 'keys', 'incremental'},
+        its summary is added to state['done'], the shards that failed are added to state['failed'].
+        """
+        self._dispatch()
+        manifests = []
+        for shard_id in self._wait():
+            entry = self.state['running'].pop(shard_id)
+            manifest = read_shard_manifest(self.bucket, shard_manifest_name(self.run_id, entry['shard']))
+            if manifest is None or manifest['summary'].get('error'):
+                error = manifest['summary']['error'] if manifest else 'no shard manifest'
+                logging.error(f'Shard {shard_id} failed: {error}')
+                self.state['failed'].append(entry['shard'])
+                continue
+            self.state['done'].append(manifest['summary'])
+            manifests.append(manifest)
+        return manifests
+
+    def close(self):
+        """Stop the process pool, the running Lambda workers keep running"""
+        if self._executor is not None:
+            self._executor.shutdown(wait=True)
+            self._executor = None
+
+    def _dispatch(self):
+        while self.state['pending'] and len(self.state['running']) < self.max_workers:
+            shard = self.state['pending'].pop(0)
+            try:
+                if self.backend == 'lambda':
+                    self._invoke_worker_lambda(shard)
+                else:
+                    if self._executor is None:
+                        self._executor = ProcessPoolExecutor(max_workers=self.max_workers, mp_context=multiprocessing.get_context('spawn'))
+                    self._futures[self._executor.submit(self.worker, shard, **self._shard_args(shard))] = shard['shard_id']
+            except (BotoCoreError, ClientError) as e:
+                logging.error(f"Could not dispatch shard {shard['shard_id']}: {e}")
+                self.state['failed'].append(shard)
+                continue
+            self.state['running'][shard['shard_id']] = {'shard': shard, 'started': time.time()}
+
+    def _wait(self):
+        """Return the ids of the running shards that finished (or timed out), sleeps one poll interval when none did"""
+        if self.backend != 'lambda':
+            done, _ = wait(list(self._futures), timeout=fan_out_poll_interval, return_when=FIRST_COMPLETED)
+            finished = []
+            for future in done:
+                shard_id = self._futures.pop(future)
+                if future.exception() is not None:
+                    logging.error(f'Shard {shard_id} worker error: {future.exception()}')
+                finished.append(shard_id)
+            return finished
+        present = list_etags_s3(self.bucket, f'{fan_out_prefix}{self.run_id}/') if self.state['running'] else {}
+        finished = [shard_id for shard_id, entry in self.state['running'].items()
+                    if shard_manifest_name(self.run_id, entry['shard']) in present
+                    or time.time() - entry['started'] > fan_out_shard_timeout]
+        if self.state['running'] and not finished:
+            time.sleep(fan_out_poll_interval)
+        return finished
+
+    def _shard_args(self, shard):
+        args = dict(self.worker_args)
+        if 'collection_fields' in args:
+            args['collection_fields'] = {coll_id: fields for coll_id, fields in args['collection_fields'].items()
+                                         if coll_id == shard['collection']}
+        return args
+
+    def _invoke_worker_lambda(self, shard):
+        if self._lambda_client is None:
+            self._lambda_client = boto3.client('lambda')
+        event = dict(self._shard_args(shard), fan_out_shard=shard)
+        self._lambda_client.invoke(FunctionName=self.context.function_name, InvocationType='Event',
+                                   Payload=json.dumps(event).encode('utf-8'))
+
+
+def read_shard_manifest(bucket, name):
+    """Return the manifest {'summary', 'keys', 'incremental'} written by a shard worker, or None"""
+    body = open_file_s3(bucket, name)
+    if not body:
+        return None
+    try:
+        return json.loads(body)
+    except ValueError as e:
+        logging.error(f'An error occurred while decoding {name}: {e}')
+        return None
+
+
+def failed_shard_keys(bucket, state, source, collection_ids):
+    """Yield the keys of the previous run manifest that the failed shards would have logged
+    A failed shard logs none of its keys, so an incremental or deduplicated harvest would delete the records of its
+    collection as stale. Their keys are carried forward instead, except the keys logged by the other shards of the
+    collection: the records of the previous harvest stay in place until a harvest maps the collection again.
+    Call it before the previous manifest is replaced and before the shard manifests are cleared.
+    :param bucket: template bucket name
+    :param state: dispatch state of the finished fan-out, see new_fan_out_state()
+    :param source: prefix of the record keys
+    :param collection_ids: ids of the harvested collections, to tell 'a-b-item' of collection 'a-b' from an item of 'a'
+    """
+    failed_collections = {shard['collection'] for shard in state['failed']}
+    if not failed_collections:
+        return
+    logged = set()
+    for summary in state['done']:
+        if summary.get('collection') in failed_collections:
+            manifest = read_shard_manifest(bucket, summary['manifest'])
+            logged.update(manifest['keys'] if manifest else ())
+    # Longest ids first, so a key is attributed to the most specific collection
+    prefixes = sorted(((f'{source}-{coll_id}-', coll_id) for coll_id in collection_ids), key=lambda prefix: -len(prefix[0]))
+    for key in iter_manifest_keys(bucket) or ():
+        coll_id = next((coll_id for prefix, coll_id in prefixes if key.startswith(prefix)), None)
+        if coll_id in failed_collections and key not in logged:
+            yield key
+
+
+def clear_shard_manifests(bucket, run_id):
+    """Delete the shard manifests of a harvest once they are merged in lastRun.txt"""
+    names = sorted(list_etags_s3(bucket, f'{fan_out_prefix}{run_id}/'))
+    if names:
+        delete_filelist_s3(names, bucket)
+
+
+def _parse_datetime(value):
+    """Parse a RFC 3339 datetime, naive datetimes are UTC
+    isoparse() accepts any number of fractional digits, datetime.fromisoformat() on python 3.9 only 3 or 6.
+    """
+    if not value or not isinstance(value, str):
+        return None
+    try:
+        parsed = isoparse(value)
+    except (ValueError, OverflowError):
+        return None
+    return parsed if parsed.tzinfo else parsed.replace(tzinfo=timezone.utc)
+
+
+def _format_datetime(value):
+    return value.astimezone(timezone.utc).strftime('%Y-%m-%dT%H:%M:%S.%f')[:-3] + 'Z'
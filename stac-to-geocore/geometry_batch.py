@@ -0,0 +1,103 @@
+from collections import Counter, namedtuple
+
+from metrics import increment, log_records
+
+try:
+    import numpy as np
+except ImportError:
+    np = None
+
+# Geometry of one bounding box of a page:
+# - coordinates: GeoCore polygon coordinates [[[west, south], [east, south], [east, north], [west, north], [west, south]]]
+# - wkt: 'POLYGON((...))' string of the GeoCore geometry property
+# - flags: tuple of the issues found in the bbox, empty when the bbox is valid
+BoxGeometry = namedtuple('BoxGeometry', ['coordinates', 'wkt', 'flags'])
+
+# Flags of a bbox
+FLAG_INVALID = 'invalid'            # missing, or not a 2D [west, south, east, north] bbox
+FLAG_NAN = 'nan'                    # NaN or infinite coordinate
+FLAG_ANTIMERIDIAN = 'antimeridian'  # west > east, the bbox crosses the antimeridian
+FLAG_DEGENERATE = 'degenerate'      # zero width or height after rounding, or south > north
+
+
+def page_geometries(bboxes, ids=None):
+    """Round and validate the bounding boxes of a search page in one pass, and build their geometries
+    The rounding matches round(coord, 2) of to_features_geometry(), so the records are unchanged.
+    :param bboxes: list of STAC bbox [west, south, east, north], one per record
+    :param ids: optional record ids, printed for the flagged bboxes with HARVEST_LOG_RECORDS=true
+    :return a list of BoxGeometry, None for the invalid bboxes (the mappers then use the record bbox as is)
+    """
+    valid = [i for i, bbox in enumerate(bboxes) if isinstance(bbox, (list, tuple)) and len(bbox) == 4]
+    results = [None] * len(bboxes)
+    rounded = _round_boxes([bboxes[i] for i in valid])
+    for i, (west, south, east, north), flags in zip(valid, rounded, _flag_boxes(rounded)):
+        # Each coordinate is formatted once, the WKT ring repeats them
+        w, s, e, n = str(west), str(south), str(east), str(north)
+        results[i] = BoxGeometry(
+            [[[west, south], [east, south], [east, north], [west, north], [west, south]]],
+            f"POLYGON(({w} {s}, {e} {s}, {e} {n}, {w} {n}, {w} {s}))",
+            flags)
+    flagged = [(i, result.flags if result else (FLAG_INVALID,)) for i, result in enumerate(results) if not result or result.flags]
+    if flagged:
+        increment('bbox_flagged', len(flagged))
+        for flag, count in Counter(flag for i, flags in flagged for flag in flags).items():
+            increment(f'bbox_flagged_{flag}', count)
+        # The ids of the flagged records are only printed with the per record lines, the counters are always emitted
+        if log_records:
+            print(f"Flagged {len(flagged)} of {len(bboxes)} bboxes: " +
+                  ', '.join(f"{ids[i] if ids else i} ({'/'.join(flags)})" for i, flags in flagged))
+    return results
+
+
+def _round_boxes(boxes):
+    """Return the boxes rounded to 2 decimals as lists of floats"""
+    if not boxes:
+        return []
+    if np is None:
+        return [[round(coord, 2) for coord in box] for box in boxes]
+    values = np.asarray(boxes, dtype=np.float64)
+    scaled = values * 100
+    rounded = (np.round(scaled) / 100).tolist()
+    # numpy rounds the scaled value, which can land on the other side of a .5 tie than the exact decimal
+    # rounding of round(), recompute the few coordinates close to a tie in Python
+    with np.errstate(invalid='ignore'):
+        near_tie = np.abs(scaled - np.floor(scaled) - 0.5) < 1e-6
+    for row, column in zip(*np.nonzero(near_tie)):
+        rounded[row][column] = round(float(values[row, column]), 2)
+    # round() keeps integer coordinates as int, which the WKT writes without a decimal point,
+    # only the boxes with a whole number coordinate can hold an int
+    with np.errstate(invalid='ignore'):
+        whole = np.nonzero((values == np.floor(values)).any(axis=1))[0]
+    for row in whole.tolist():
+        if not all(type(coord) is float for coord in boxes[row]):
+            rounded[row] = [round(coord, 2) for coord in boxes[row]]
+    return rounded
+
+
+def _flag_boxes(rounded):
+    """Return the flags of each rounded box"""
+    if not rounded:
+        return []
+    if np is None:
+        return [_flag_box(*box) for box in rounded]
+    values = np.asarray(rounded, dtype=np.float64)
+    west, south, east, north = values.T
+    with np.errstate(invalid='ignore'):
+        nan = ~np.isfinite(values).all(axis=1)
+        antimeridian = ~nan & (west > east)
+        degenerate = ~nan & ((west == east) | (south >= north))
+    flags = [()] * len(rounded)
+    for row in np.nonzero(nan | antimeridian | degenerate)[0].tolist():
+        flags[row] = tuple(flag for flag, mask in ((FLAG_NAN, nan), (FLAG_ANTIMERIDIAN, antimeridian), (FLAG_DEGENERATE, degenerate)) if mask[row])
+    return flags
+
+
+def _flag_box(west, south, east, north):
+    if not all(abs(coord) != float('inf') and coord == coord for coord in (west, south, east, north)):
+        return (FLAG_NAN,)
+    flags = ()
+    if west > east:
+        flags += (FLAG_ANTIMERIDIAN,)
+    if west == east or south >= north:
+        flags += (FLAG_DEGENERATE,)
+    return flags
@@ -0,0 +1,230 @@
+import hashlib
+import json
+import logging
+import os
+import threading
+import time
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from metrics import increment
+from s3_operations import delete_filelist_s3, get_s3_client
+
+# 'off' disables the cache, 'tmp' keeps it in the Lambda /tmp (reused by the warm invocations of a container),
+# 's3' keeps it in a bucket so every invocation can revalidate the pages of the previous harvest
+http_cache_backend = os.environ.get('STAC_HTTP_CACHE', 'off').lower()
+http_cache_dir = os.environ.get('STAC_HTTP_CACHE_DIR', '/tmp/stac-http-cache')
+http_cache_bucket = os.environ.get('STAC_HTTP_CACHE_BUCKET') or os.environ.get('GEOCORE_TEMPLATE_BUCKET_NAME')
+http_cache_prefix = os.environ.get('STAC_HTTP_CACHE_PREFIX', 'httpCache/')
+# The least recently used bodies are evicted once the cached bodies exceed this size
+http_cache_max_bytes = int(os.environ.get('STAC_HTTP_CACHE_MAX_BYTES', str(256 * 1024 * 1024)))
+
+_cache = None
+
+
+class HttpCache:
+    """Cache of the STAC API GET responses that carry an ETag or a Last-Modified validator.
+
+    Before a GET, request_headers() returns the If-None-Match / If-Modified-Since headers of the cached
+    response, and resolve() turns the 304 Not Modified answer back into the cached 200 response. The index
+    (url -> validators, size and last use) is loaded by open_http_cache() and saved by close_http_cache(),
+    the bodies are stored one file or S3 object per url. The cache is shared by the fetch threads.
+    """
+
+    def __init__(self, backend, max_bytes=None, read_only=False):
+        self.backend = backend
+        self.max_bytes = http_cache_max_bytes if max_bytes is None else max_bytes
+        self.read_only = read_only
+        self.stats = {'hits': 0, 'misses': 0, 'stored': 0, 'evicted': 0, 'uncacheable': 0, 'bytes_saved': 0}
+        self._lock = threading.Lock()
+        self._evicted_keys = []
+        self._index = self._load_index()
+        self._size = sum(entry['size'] for entry in self._index.values())
+
+    def request_headers(self, url):
+        """Return the conditional request headers of a cached url, or {}"""
+        with self._lock:
+            entry = self._index.get(_cache_key(url))
+        if not entry:
+            return {}
+        headers = {}
+        if entry.get('etag'):
+            headers['If-None-Match'] = entry['etag']
+        if entry.get('last_modified'):
+            headers['If-Modified-Since'] = entry['last_modified']
+        return headers
+
+    def resolve(self, url, status_code, headers, content):
+        """Return the (status code, content type, body) of a GET response, the cached 200 for a 304
+        Returns None when the url answered 304 but its body is gone, the request must be sent again
+        without the conditional headers.
+        """
+        key = _cache_key(url)
+        if status_code == 304:
+            with self._lock:
+                entry = self._index.get(key)
+            body = self._read_body(key) if entry else None
+            if body is None:
+                with self._lock:
+                    entry = self._index.pop(key, None)
+                    if entry:
+                        self._size -= entry['size']
+                return None
+            with self._lock:
+                entry['used'] = time.time()
+                self.stats['hits'] += 1
+                self.stats['bytes_saved'] += len(body)
+            return 200, entry.get('content_type'), body
+        with self._lock:
+            self.stats['misses'] += 1
+        content_type = headers.get('Content-Type')
+        if status_code == 200 and not self.read_only:
+            etag, last_modified = headers.get('ETag'), headers.get('Last-Modified')
+            if etag or last_modified:
+                self._store(key, url, etag, last_modified, content_type, content)
+            else:
+                with self._lock:
+                    self.stats['uncacheable'] += 1
+        return status_code, content_type, content
+
+    def close(self):
+        """Save the index and delete the evicted bodies, a read only cache is left as is"""
+        if self.read_only:
+            return
+        with self._lock:
+            index = dict(self._index)
+            evicted, self._evicted_keys = self._evicted_keys, []
+        body = json.dumps(index).encode('utf-8')
+        if self.backend == 's3':
+            try:
+                get_s3_client().put_object(Bucket=http_cache_bucket, Key=f'{http_cache_prefix}index.json', Body=body)
+            except (BotoCoreError, ClientError) as e:
+                logging.error(f'Could not save the HTTP cache index: {e}')
+            if evicted:
+                delete_filelist_s3([self._body_name(key) for key in evicted], http_cache_bucket)
+        else:
+            path = os.path.join(http_cache_dir, 'index.json')
+            with open(path + '.tmp', 'wb') as f:
+                f.write(body)
+            os.replace(path + '.tmp', path)
+
+    def _store(self, key, url, etag, last_modified, content_type, content):
+        try:
+            self._write_body(key, content)
+        except (OSError, BotoCoreError, ClientError) as e:
+            logging.error(f'Could not cache {url}: {e}')
+            return
+        with self._lock:
+            previous = self._index.get(key)
+            if previous:
+                self._size -= previous['size']
+            self._index[key] = {'url': url, 'etag': etag, 'last_modified': last_modified, 'content_type': content_type,
+                                'size': len(content), 'used': time.time()}
+            self._size += len(content)
+            self.stats['stored'] += 1
+            evicted = self._evict() if self._size > self.max_bytes else []
+            if self.backend == 's3':
+                # The evicted objects are deleted in batches by close()
+                self._evicted_keys.extend(evicted)
+        if self.backend != 's3':
+            for evicted_key in evicted:
+                try:
+                    os.remove(self._body_name(evicted_key))
+                except OSError:
+                    pass
+
+    def _evict(self):
+        """Drop the least recently used entries until the bodies fit in max_bytes, return their keys"""
+        evicted = []
+        for key, entry in sorted(self._index.items(), key=lambda item: item[1]['used']):
+            if self._size <= self.max_bytes:
+                break
+            self._size -= entry['size']
+            del self._index[key]
+            evicted.append(key)
+        self.stats['evicted'] += len(evicted)
+        return evicted
+
+    def _body_name(self, key):
+        if self.backend == 's3':
+            return f'{http_cache_prefix}{key}.body'
+        return os.path.join(http_cache_dir, f'{key}.body')
+
+    def _load_index(self):
+        try:
+            if self.backend == 's3':
+                response = get_s3_client().get_object(Bucket=http_cache_bucket, Key=f'{http_cache_prefix}index.json')
+                return json.loads(response['Body'].read())
+            os.makedirs(http_cache_dir, exist_ok=True)
+            with open(os.path.join(http_cache_dir, 'index.json'), 'rb') as f:
+                return json.loads(f.read())
+        except ClientError as e:
+            if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+                logging.error(f'Could not load the HTTP cache index: {e}')
+        except FileNotFoundError:
+            pass
+        except (OSError, ValueError, BotoCoreError) as e:
+            logging.error(f'Could not load the HTTP cache index: {e}')
+        return {}
+
+    def _read_body(self, key):
+        try:
+            if self.backend == 's3':
+                return get_s3_client().get_object(Bucket=http_cache_bucket, Key=self._body_name(key))['Body'].read()
+            with open(self._body_name(key), 'rb') as f:
+                return f.read()
+        except (OSError, BotoCoreError, ClientError) as e:
+            logging.error(f'Could not read the cached body {key}: {e}')
+            return None
+
+    def _write_body(self, key, content):
+        if self.backend == 's3':
+            get_s3_client().put_object(Bucket=http_cache_bucket, Key=self._body_name(key), Body=content)
+        else:
+            with open(self._body_name(key), 'wb') as f:
+                f.write(content)
+
+
+def _cache_key(url):
+    return hashlib.sha256(url.encode('utf-8')).hexdigest()
+
+
+def open_http_cache(read_only=False):
+    """Open the HTTP cache of STAC_HTTP_CACHE for the STAC API GET requests of this invocation
+    :param read_only: revalidate the cached responses but do not store new ones (fan-out workers, which would
+                      overwrite the index of each other)
+    :return the HttpCache, or None when the cache is off
+    """
+    global _cache
+    if http_cache_backend not in ('tmp', 's3'):
+        _cache = None
+        return None
+    if http_cache_backend == 's3' and not http_cache_bucket:
+        logging.error('STAC_HTTP_CACHE=s3 requires STAC_HTTP_CACHE_BUCKET, the HTTP cache is off')
+        _cache = None
+        return None
+    _cache = HttpCache(http_cache_backend, read_only=read_only)
+    return _cache
+
+
+def get_http_cache():
+    """Return the HttpCache opened by open_http_cache(), or None"""
+    return _cache
+
+
+def close_http_cache():
+    """Save the HTTP cache, print its hit and miss counts and add them to the metrics"""
+    global _cache
+    cache, _cache = _cache, None
+    if cache is None:
+        return None
+    cache.close()
+    stats = cache.stats
+    requests_count = stats['hits'] + stats['misses']
+    hit_rate = stats['hits'] / requests_count * 100 if requests_count else 0
+    print(f"HTTP cache ({cache.backend}): {stats['hits']} hits, {stats['misses']} misses ({hit_rate:.0f}% hits), "
+          f"{stats['stored']} stored, {stats['evicted']} evicted, {stats['uncacheable']} without validators, "
+          f"{stats['bytes_saved']} bytes not downloaded")
+    for name, value in stats.items():
+        increment(f'http_cache_{name}', value)
+    return stats
@@ -0,0 +1,153 @@
+import importlib.util
+import os
+import threading
+import time
+from urllib.parse import urlsplit
+
+import requests
+from requests.adapters import HTTPAdapter
+from urllib3.util.retry import Retry
+
+from http_cache import get_http_cache
+from metrics import increment, observe_latency
+
+# HTTP settings for the STAC API calls, timeouts are in seconds
+http_connect_timeout = float(os.environ.get('STAC_CONNECT_TIMEOUT', '10'))
+http_read_timeout = float(os.environ.get('STAC_READ_TIMEOUT', '60'))
+http_max_retries = int(os.environ.get('STAC_MAX_RETRIES', '5'))
+# Exponential backoff between retries: backoff_factor * 2 ** (retry - 1) seconds, a Retry-After header wins
+http_backoff_factor = float(os.environ.get('STAC_BACKOFF_FACTOR', '0.5'))
+http_pool_size = int(os.environ.get('STAC_POOL_SIZE', '10'))
+http_retry_status = (429, 500, 502, 503, 504)
+
+# urllib3 decodes brotli responses only when a brotli package is installed
+if importlib.util.find_spec('brotli') or importlib.util.find_spec('brotlicffi'):
+    accept_encoding = 'gzip, deflate, br'
+else:
+    accept_encoding = 'gzip, deflate'
+
+_session = None
+_session_lock = threading.Lock()
+# endpoint path -> {'requests', 'errors', 'seconds', 'bytes'}
+_http_stats = {}
+_stats_lock = threading.Lock()
+
+
+def get_http_session():
+    """Return the requests session shared by every STAC API call
+    The session keeps the connections alive between calls and retries connection errors and
+    429/5xx responses with exponential backoff, honouring the Retry-After header.
+    """
+    global _session
+    with _session_lock:
+        if _session is None:
+            retry = Retry(
+                total=http_max_retries,
+                backoff_factor=http_backoff_factor,
+                status_forcelist=http_retry_status,
+                allowed_methods=frozenset(['GET', 'HEAD', 'POST']),
+                respect_retry_after_header=True,
+                raise_on_status=False,
+            )
+            adapter = HTTPAdapter(pool_connections=http_pool_size, pool_maxsize=http_pool_size, max_retries=retry)
+            session = requests.Session()
+            session.mount('http://', adapter)
+            session.mount('https://', adapter)
+            session.headers.update({'Accept-Encoding': accept_encoding, 'Accept': 'application/json, application/geo+json'})
+            _session = session
+    return _session
+
+
+def stac_request(method, url, **kwargs):
+    """Send a request to the STAC API through the shared session
+    The buffered GET requests go through the HTTP cache when one is open (see http_cache.py): a cached
+    response is revalidated with a conditional request, and a 304 Not Modified is returned as the cached 200.
+    :param method: HTTP method, 'GET' or 'POST'
+    :param url: url of the STAC API endpoint
+    :param kwargs: passed to requests, the timeout defaults to (STAC_CONNECT_TIMEOUT, STAC_READ_TIMEOUT)
+    :return: the requests.Response
+    """
+    kwargs.setdefault('timeout', (http_connect_timeout, http_read_timeout))
+    cache = get_http_cache()
+    if cache is not None and method == 'GET' and not kwargs.get('stream'):
+        return _cached_get(cache, url, **kwargs)
+    return _send(method, url, **kwargs)
+
+
+def _cached_get(cache, url, **kwargs):
+    conditional = cache.request_headers(url)
+    headers = dict(kwargs.pop('headers', None) or {})
+    response = _send('GET', url, headers=dict(headers, **conditional), **kwargs)
+    resolved = cache.resolve(url, response.status_code, response.headers, response.content)
+    if resolved is None:
+        # 304 for a body that is no longer cached, ask for the full response
+        response.close()
+        response = _send('GET', url, headers=headers, **kwargs)
+        resolved = cache.resolve(url, response.status_code, response.headers, response.content)
+    if resolved is None:
+        return response
+    status_code, content_type, body = resolved
+    if response.status_code == 304:
+        response.status_code = status_code
+        response._content = body
+        if content_type:
+            response.headers['Content-Type'] = content_type
+    return response
+
+
+def _send(method, url, **kwargs):
+    start = time.perf_counter()
+    response = None
+    try:
+        response = get_http_session().request(method, url, **kwargs)
+        return response
+    finally:
+        elapsed = time.perf_counter() - start
+        # Streamed bodies are not read here, only the size of the buffered ones is known
+        size = len(response.content) if response is not None and not kwargs.get('stream') else 0
+        error = response is None or response.status_code >= 400
+        record_http_call(urlsplit(url).path or '/', elapsed, size, error)
+
+
+def stac_get(url, **kwargs):
+    """GET a STAC API url through the shared session, see stac_request()"""
+    return stac_request('GET', url, **kwargs)
+
+
+def stac_post(url, json=None, **kwargs):
+    """POST a json payload to a STAC API url through the shared session, see stac_request()"""
+    return stac_request('POST', url, json=json, **kwargs)
+
+
+def record_http_call(endpoint, elapsed, size, error):
+    """Add a call to the per-endpoint counters, also used by the HTTP clients of the async engine"""
+    with _stats_lock:
+        stats = _http_stats.setdefault(endpoint, {'requests': 0, 'errors': 0, 'seconds': 0.0, 'bytes': 0})
+        stats['requests'] += 1
+        stats['errors'] += int(error)
+        stats['seconds'] += elapsed
+        stats['bytes'] += size
+    observe_latency('stac_request', elapsed)
+    increment('stac_response_bytes', size)
+    if error:
+        increment('stac_errors')
+
+
+def get_http_stats():
+    """Return a copy of the per-endpoint latency and byte counters"""
+    with _stats_lock:
+        return {endpoint: dict(stats) for endpoint, stats in _http_stats.items()}
+
+
+def reset_http_stats():
+    """Clear the per-endpoint counters, called at the start of a harvest"""
+    with _stats_lock:
+        _http_stats.clear()
+
+
+def log_http_stats():
+    """Print the per-endpoint counters of the harvest"""
+    for endpoint, stats in sorted(get_http_stats().items()):
+        avg_ms = stats['seconds'] / stats['requests'] * 1000 if stats['requests'] else 0
+        print(f"HTTP {endpoint}: {stats['requests']} requests, {stats['errors']} errors, "
+              f"{stats['bytes']} bytes, {stats['seconds']:.2f} s total, {avg_ms:.0f} ms average")
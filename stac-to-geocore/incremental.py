@@ -0,0 +1,110 @@
+import hashlib
+import json
+import logging
+import os
+
+from s3_operations import open_file_s3, upload_file_s3
+
+# 'full' deletes the previous harvest and uploads every record, 'incremental' only uploads new or changed
+# records and deletes the records that disappeared upstream
+harvest_mode = os.environ.get('HARVEST_MODE', 'full').lower()
+# Manifest of the last incremental harvest, stored next to lastRun.txt in the template bucket
+harvest_manifest_name = os.environ.get('HARVEST_MANIFEST_NAME', 'harvestManifest.json')
+
+
+def record_hash(json_data):
+    """Return the sha256 of a GeoCore record, independent of the dictionary key order"""
+    canonical = json.dumps(json_data, sort_keys=True, separators=(',', ':'), ensure_ascii=False)
+    return hashlib.sha256(canonical.encode('utf-8')).hexdigest()
+
+
+class IncrementalHarvest:
+    """Decide which GeoCore records must be uploaded by comparing them with the previous harvest.
+
+    The manifest maps each GeoCore record id to {'key', 'hash', 'updated'}, where hash is the sha256 of
+    the translated record. Records are still translated on every run, so changes to the collection
+    metadata, the template or the mapping rules are picked up, but only the records whose hash changed
+    are uploaded. A new hash is only kept once the upload succeeded (mark_uploaded), a failed upload keeps
+    the previous entry (mark_failed), so the previous object is not deleted as stale and the upload is
+    retried on the next run.
+    """
+
+    def __init__(self, bucket, manifest_name=None):
+        self.bucket = bucket
+        self.manifest_name = manifest_name or harvest_manifest_name
+        self.previous = self._load_manifest()
+        self.current = {}
+        self._pending = {}
+        self.unchanged = 0
+
+    def _load_manifest(self):
+        body = open_file_s3(self.bucket, self.manifest_name)
+        if not body:
+            print(f'No existing {self.manifest_name}, every record will be uploaded')
+            return {}
+        try:
+            return json.loads(body)
+        except json.JSONDecodeError as e:
+            logging.error(f'An error occurred while decoding {self.manifest_name}: {e}')
+            return {}
+
+    def is_changed(self, record_id, key, json_data, updated=None):
+        """Return True if the record is new or changed and must be uploaded
+        :param record_id: GeoCore properties id of the record
+        :param key: S3 key of the record
+        :param json_data: translated GeoCore dictionary
+        :param updated: STAC 'updated' timestamp of the record, if any
+        """
+        entry = {'key': key, 'hash': record_hash(json_data), 'updated': updated}
+        previous = self.previous.get(record_id)
+        if previous and previous.get('hash') == entry['hash'] and previous.get('key') == key:
+            self.current[record_id] = entry
+            self.unchanged += 1
+            return False
+        self._pending[key] = (record_id, entry)
+        return True
+
+    def mark_uploaded(self, key):
+        """Record the hash of an uploaded record, called by the upload pipeline on success
+        A key that did not go through is_changed() has no hash to record.
+        """
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return
+        record_id, entry = pending
+        self.current[record_id] = entry
+
+    def mark_failed(self, key):
+        """Keep the previous entry of a record whose upload failed, its object in S3 is still valid
+        :return the S3 key of the previous version of the record, or None for a new record
+        """
+        pending = self._pending.pop(key, None)
+        if pending is None:
+            return None
+        record_id, entry = pending
+        previous = self.previous.get(record_id)
+        if previous is None:
+            return None
+        self.current[record_id] = previous
+        return previous['key']
+
+    def current_keys(self):
+        """Return the set of the S3 keys of the records of this harvest, uploaded or unchanged"""
+        return {entry['key'] for entry in self.current.values()}
+
+    def save(self):
+        """Upload the manifest of this harvest, records that failed to upload keep their previous entry"""
+        manifest = dict(self.current)
+        for record_id, entry in self._pending.values():
+            if record_id in self.previous:
+                manifest[record_id] = self.previous[record_id]
+        return upload_file_s3(self.manifest_name, bucket=self.bucket, json_data=manifest, object_name=None)
+
+
+def stale_keys(previous_keys, current_keys):
+    """Yield the keys of the previous harvest that were not produced by this harvest
+    :param previous_keys: keys listed in the previous lastRun.txt, an iterable such as iter_manifest_keys()
+    :param current_keys: keys produced by this harvest
+    """
+    current = current_keys if isinstance(current_keys, (set, frozenset)) else set(current_keys)
+    return (key for key in previous_keys if key and key not in current)
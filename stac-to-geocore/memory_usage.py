@@ -0,0 +1,47 @@
+import logging
+import os
+import resource
+import sys
+
+_page_size = os.sysconf('SC_PAGE_SIZE') if hasattr(os, 'sysconf') else 4096
+
+
+def peak_rss_mb():
+    """Return the peak resident memory of the process in MB
+    The peak is kept for the life of the process, a warm Lambda container reports the peak of its previous invocations too.
+    """
+    peak = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # ru_maxrss is in bytes on macOS, in KB on Linux
+    return peak / 1024 / 1024 if sys.platform == 'darwin' else peak / 1024
+
+
+def current_rss_mb():
+    """Return the current resident memory of the process in MB, or None if /proc is not available"""
+    try:
+        with open('/proc/self/statm') as f:
+            return int(f.read().split()[1]) * _page_size / 1024 / 1024
+    except (OSError, ValueError, IndexError):
+        return None
+
+
+def log_memory(phase):
+    """Print the resident memory at the end of a harvest phase and its change during the phase
+    The peak is the one of the process, it can come from an earlier phase or a previous invocation.
+    """
+    global _previous_rss_mb
+    try:
+        current = current_rss_mb()
+        if current is None:
+            current_str = 'unknown resident'
+        else:
+            current_str = f'{current:.0f} MB resident'
+            if _previous_rss_mb is not None:
+                current_str += f' ({current - _previous_rss_mb:+.0f} MB during the phase)'
+            _previous_rss_mb = current
+        print(f'Memory after {phase}: {current_str}, {peak_rss_mb():.0f} MB process peak')
+    except (OSError, ValueError) as e:
+        logging.error(e)
+
+
+# Resident memory at the previous log_memory() call, the first phase is measured from the import
+_previous_rss_mb = current_rss_mb()
@@ -0,0 +1,215 @@
+import bisect
+import heapq
+import json
+import os
+import random
+import threading
+import time
+from contextlib import contextmanager
+
+# 'emf' prints one CloudWatch Embedded Metric Format summary at the end of the harvest, 'text' prints it as
+# plain lines, 'off' prints nothing (the metrics are still collected)
+metrics_format = os.environ.get('HARVEST_METRICS', 'emf').lower()
+metrics_namespace = os.environ.get('HARVEST_METRICS_NAMESPACE', 'StacToGeoCore')
+# Number of slowest records kept per phase
+metrics_slowest_n = int(os.environ.get('HARVEST_METRICS_SLOWEST', '10'))
+# Fraction of the records logged as a json span line, 0 disables the span logs
+span_sample_rate = float(os.environ.get('HARVEST_SPAN_SAMPLE_RATE', '0'))
+# 'true' prints a line per mapped record, at our volume these lines cost more CloudWatch ingestion than the metrics
+log_records = os.environ.get('HARVEST_LOG_RECORDS', 'false').lower() == 'true'
+
+# Upper bounds of the latency histogram buckets in ms, the last bucket counts the slower calls
+latency_buckets_ms = (1, 2.5, 5, 10, 25, 50, 100, 250, 500, 1000, 2500, 5000, 10000)
+
+_lock = threading.Lock()
+# phase -> wall clock seconds
+_phases = {}
+# record phase (translation, serialization, compression, upload, and the concurrent page fetches of the async
+# engine) -> seconds summed over the records, the upload threads overlap so a total can exceed the harvest duration
+_record_totals = {}
+# name -> value
+_counters = {}
+# name -> {'counts': [..], 'count', 'sum', 'max'}, in ms
+_latencies = {}
+# phase -> min heap of (seconds, key)
+_slowest = {}
+
+
+def reset_metrics():
+    """Clear the metrics, called at the start of a harvest (a warm Lambda container keeps the module state)"""
+    with _lock:
+        _phases.clear()
+        _record_totals.clear()
+        _counters.clear()
+        _latencies.clear()
+        _slowest.clear()
+
+
+def add_phase_time(phase, seconds):
+    """Add wall clock time to a phase of the harvest, for the code that runs in the main thread"""
+    with _lock:
+        _phases[phase] = _phases.get(phase, 0.0) + seconds
+
+
+def add_record_time(phase, seconds):
+    """Add the time spent on one record to the total of a record phase, for the code that runs in the upload threads"""
+    with _lock:
+        _record_totals[phase] = _record_totals.get(phase, 0.0) + seconds
+
+
+@contextmanager
+def timed_phase(phase):
+    """Add the time spent in the with block to a phase"""
+    start = time.perf_counter()
+    try:
+        yield
+    finally:
+        elapsed = time.perf_counter() - start
+        add_phase_time(phase, elapsed)
+        if span_sample_rate > 0:
+            _log_span(phase, None, elapsed)
+
+
+def timed_iter(iterable, phase):
+    """Yield the values of an iterable, adding the time spent waiting for each value to a phase"""
+    iterator = iter(iterable)
+    while True:
+        start = time.perf_counter()
+        try:
+            value = next(iterator)
+        except StopIteration:
+            add_phase_time(phase, time.perf_counter() - start)
+            return
+        add_phase_time(phase, time.perf_counter() - start)
+        yield value
+
+
+def increment(name, value=1):
+    """Add value to a counter"""
+    with _lock:
+        _counters[name] = _counters.get(name, 0) + value
+
+
+def observe_latency(name, seconds):
+    """Add a call duration to the latency histogram of name (e.g. 'stac_request', 's3_put')"""
+    ms = seconds * 1000
+    with _lock:
+        histogram = _latencies.get(name)
+        if histogram is None:
+            histogram = _latencies[name] = {'counts': [0] * (len(latency_buckets_ms) + 1), 'count': 0, 'sum': 0.0, 'max': 0.0}
+        histogram['counts'][bisect.bisect_left(latency_buckets_ms, ms)] += 1
+        histogram['count'] += 1
+        histogram['sum'] += ms
+        histogram['max'] = max(histogram['max'], ms)
+
+
+def observe_record(phase, key, seconds):
+    """Add the time spent on one record to the total of a record phase, keep the slowest records and log a sampled span"""
+    with _lock:
+        _record_totals[phase] = _record_totals.get(phase, 0.0) + seconds
+        heap = _slowest.setdefault(phase, [])
+        if len(heap) < metrics_slowest_n:
+            heapq.heappush(heap, (seconds, key))
+        elif heap and seconds > heap[0][0]:
+            heapq.heapreplace(heap, (seconds, key))
+    if span_sample_rate > 0 and random.random() < span_sample_rate:
+        _log_span(phase, key, seconds)
+
+
+def _log_span(name, key, seconds):
+    span = {'span': name, 'duration_ms': round(seconds * 1000, 3)}
+    if key is not None:
+        span['key'] = key
+    print(json.dumps(span))
+
+
+def latency_percentile(histogram, q):
+    """Return the upper bound in ms of the histogram bucket holding the q quantile (0 < q <= 1)
+    The max is returned for the last bucket, and when it is lower than the bucket bound.
+    """
+    rank = q * histogram['count']
+    cumulative = 0
+    for bound, count in zip(latency_buckets_ms + (None,), histogram['counts']):
+        cumulative += count
+        if count and cumulative >= rank:
+            return histogram['max'] if bound is None else min(bound, histogram['max'])
+    return histogram['max']
+
+
+def metrics_summary():
+    """Return a copy of the metrics {'phases', 'record_totals', 'counters', 'latencies', 'slowest'}
+    phases are wall clock seconds, record_totals are the seconds of the record phases summed over the records.
+    latencies are {'count', 'avg_ms', 'p50_ms', 'p90_ms', 'p99_ms', 'max_ms', 'buckets'}, buckets maps the
+    bucket upper bounds to their counts. slowest lists the slowest [key, ms] of each record phase.
+    """
+    with _lock:
+        latencies = {}
+        for name, histogram in _latencies.items():
+            bounds = [str(bound) for bound in latency_buckets_ms] + ['inf']
+            latencies[name] = {
+                'count': histogram['count'],
+                'avg_ms': round(histogram['sum'] / histogram['count'], 3) if histogram['count'] else 0,
+                'p50_ms': round(latency_percentile(histogram, 0.5), 3),
+                'p90_ms': round(latency_percentile(histogram, 0.9), 3),
+                'p99_ms': round(latency_percentile(histogram, 0.99), 3),
+                'max_ms': round(histogram['max'], 3),
+                'buckets': {bound: count for bound, count in zip(bounds, histogram['counts']) if count},
+            }
+        return {
+            'phases': {phase: round(seconds, 3) for phase, seconds in _phases.items()},
+            'record_totals': {phase: round(seconds, 3) for phase, seconds in _record_totals.items()},
+            'counters': dict(_counters),
+            'latencies': latencies,
+            'slowest': {phase: [[key, round(seconds * 1000, 3)] for seconds, key in sorted(heap, reverse=True)]
+                        for phase, heap in _slowest.items()},
+        }
+
+
+def emit_metrics(function_name=None, properties=None):
+    """Print the metrics summary of the harvest, in the format of HARVEST_METRICS
+    With 'emf', CloudWatch turns the line into metrics (phase seconds, record phase totals, counters and latency
+    percentiles, with a FunctionName dimension), the histograms and the slowest records are searchable log properties.
+    :param function_name: name of the Lambda function, the dimension of the metrics
+    :param properties: extra properties of the summary, e.g. the fan-out shard id
+    """
+    if metrics_format == 'off':
+        return
+    summary = metrics_summary()
+    if metrics_format == 'text':
+        for phase, seconds in summary['phases'].items():
+            print(f'Phase {phase}: {seconds:.3f} s')
+        for phase, seconds in summary['record_totals'].items():
+            print(f'Record total {phase}: {seconds:.3f} s, summed over the records')
+        for name, value in sorted(summary['counters'].items()):
+            print(f'Counter {name}: {value}')
+        for name, stats in sorted(summary['latencies'].items()):
+            print(f"Latency {name}: {stats['count']} calls, p50 {stats['p50_ms']} ms, p90 {stats['p90_ms']} ms, "
+                  f"p99 {stats['p99_ms']} ms, max {stats['max_ms']} ms")
+        for phase, records in summary['slowest'].items():
+            print(f"Slowest {phase}: " + ', '.join(f'{key} ({ms} ms)' for key, ms in records))
+        return
+    values = {}
+    definitions = []
+    for phase, seconds in summary['phases'].items():
+        values[f'{phase}_seconds'] = seconds
+        definitions.append({'Name': f'{phase}_seconds', 'Unit': 'Seconds'})
+    for phase, seconds in summary['record_totals'].items():
+        # Summed over the overlapping upload threads, not a duration
+        values[f'{phase}_record_seconds_total'] = seconds
+        definitions.append({'Name': f'{phase}_record_seconds_total', 'Unit': 'Seconds'})
+    for name, value in sorted(summary['counters'].items()):
+        values[name] = value
+        definitions.append({'Name': name, 'Unit': 'Bytes' if name.endswith('_bytes') else 'Count'})
+    for name, stats in sorted(summary['latencies'].items()):
+        for stat in ('p50_ms', 'p90_ms', 'p99_ms', 'max_ms'):
+            values[f'{name}_{stat}'] = stats[stat]
+            definitions.append({'Name': f'{name}_{stat}', 'Unit': 'Milliseconds'})
+    # CloudWatch accepts at most 100 metrics per directive
+    directives = [{'Namespace': metrics_namespace, 'Dimensions': [['FunctionName']], 'Metrics': definitions[i:i + 100]}
+                  for i in range(0, len(definitions), 100)]
+    document = {'_aws': {'Timestamp': int(time.time() * 1000), 'CloudWatchMetrics': directives},
+                'FunctionName': function_name or 'stac-to-geocore'}
+    document.update(values)
+    document.update({'latencies': summary['latencies'], 'slowest': summary['slowest']})
+    document.update(properties or {})
+    print(json.dumps(document))
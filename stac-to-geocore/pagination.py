@@ -1,5 +1,28 @@
-import requests
-import json 
+import logging
+import os
+from concurrent.futures import ThreadPoolExecutor
+from urllib.parse import urlencode
+
+from http_client import stac_get, stac_post
+
+try:
+    import ijson
+except ImportError:
+    ijson = None
+
+# 'true' parses the items of each search page while the body is downloaded (requires ijson), so the memory
+# does not grow with the page size. Pages are then not prefetched and their geometries not batched.
+stream_items = os.environ.get('STAC_STREAM_ITEMS', 'false').lower() == 'true'
+# Items per search page asked to an API conforming to item-search, 0 keeps the server default (30 for Franklin)
+search_limit = int(os.environ.get('STAC_SEARCH_LIMIT', '250'))
+# 'true' asks only for the item fields below when the API conforms to the fields extension
+search_fields_enabled = os.environ.get('STAC_SEARCH_FIELDS', 'true').lower() == 'true'
+# Item fields read by the GeoCore mapping (get_item_fields, item_to_features_properties), the incremental
+# harvest (properties.updated) and the fan-out windows (properties.start_datetime)
+search_fields = ['id', 'collection', 'bbox', 'links', 'assets', 'properties.datetime', 'properties.start_datetime',
+                 'properties.created', 'properties.updated']
+# The item geometries are not mapped, the GeoCore geometry is built from the bbox
+search_exclude_fields = ['geometry']
 
 
 def search_pages_get(url: str, payload: dict = None) -> list:
@@ -30,35 +53,162 @@ def search_pages_get(url: str, payload: dict = None) -> list:
     url = 'datacube.services.geo.ca/collections/msi/items'
     pages = stac_api_paginate(url)
     for page in pages:
-        r = requests.get(page)
+        r = stac_get(page)
         ...
 
     """
-    # Get a list of collections from /collections endpoint
-    pages = []
-    next_page = url
-    returned = 0
+    return [page for page, features in search_pages_iter(url, payload=payload, prefetch=False)]
+
+def search_pages_iter(url: str, payload: dict = None, prefetch: bool = True, returned: int = 0, stream: bool = None):
+    """
+    Stream the features of the valid pages of a STAC API search endpoint.
+
+    Each page is fetched once: the page is validated with the same
+    context returned/matched test as search_pages_get (Franklin STAC API
+    generates a next link even when there is no next page) and its
+    features are yielded right away. With prefetch, the next page is
+    requested in a background thread while the caller translates the
+    current one.
+
+    Parameters
+    ----------
+    url : str
+        The stac api endpoint.
+    payload: dict
+        The POST payload of the first page, the next pages are requested
+        as their next links say (see get_next_request).
+        The default is None.
+    prefetch: bool
+        Fetch the next page while the current page is processed.
+        The default is True.
+    returned: int
+        Number of items returned by the pages before url, used to resume
+        a pagination from a page in the middle of the search.
+        The default is 0.
+    stream: bool
+        Parse the features while the page body is downloaded, with ijson.
+        Features is then an iterator that must be consumed before the
+        next page, and prefetch is ignored.
+        The default is STAC_STREAM_ITEMS.
+
+    Yields
+    -------
+    (page, features): tuple
+        The page url and the list (iterator when streaming) of features
+        (STAC items) of the page.
+
+    Example
+    -------
+    url = 'datacube.services.geo.ca/api/search'
+    for page, features in search_pages_iter(url):
+        for item in features:
+            ...
+
+    """
+    stream = stream_items if stream is None else stream
+    if stream and ijson is None:
+        logging.error('ijson is not installed, the search pages are parsed in full')
+        stream = False
+    if stream:
+        yield from _stream_pages(url, payload, returned)
+        return
+    executor = ThreadPoolExecutor(max_workers=1) if prefetch else None
     matched = 0
-   
-    while next_page:
-        r = requests.get(next_page)
-        if r.status_code == 200:
-            j = r.json()                     
+    next_page = url
+    pending = executor.submit(_get_page, next_page, payload) if executor else None
+    try:
+        while next_page:
+            j = pending.result() if executor else _get_page(next_page, payload)
+            if j is None:
+                break
+            page = next_page
             # Test the returns total against total matched
             returned += j['context']['returned']
             matched = j['context']['matched']
-            if returned > 0:
-                pages.append(next_page)
             if returned < matched:
-                links = j['links']
-                next_page = get_next_page(links)
+                next_page, payload = get_next_request(j['links'], payload)
             else:
                 next_page = None
+            if executor and next_page:
+                pending = executor.submit(_get_page, next_page, payload)
+            features = j.get('features', [])
+            del j
+            if returned > 0:
+                yield page, features
+    finally:
+        if executor:
+            executor.shutdown(wait=False)
+
+def _stream_pages(url: str, payload: dict = None, returned: int = 0):
+    """search_pages_iter() with the features of each page parsed from the response stream"""
+    next_page = url
+    while next_page:
+        page = next_page
+        page_fields = {}
+        features = _stream_page(page, payload, page_fields)
+        try:
+            yield page, features
+            # The context and the links are known once the body is read to its end
+            for _ in features:
+                pass
+        finally:
+            # Closes the response when the caller stops in the middle of a page
+            features.close()
+        if 'context' not in page_fields:
+            break
+        returned += page_fields['context']['returned']
+        matched = page_fields['context']['matched']
+        if returned < matched:
+            next_page, payload = get_next_request(page_fields.get('links', []), payload)
         else:
             next_page = None
-                            
-    r.close()
-    return pages
+
+def _stream_page(url: str, payload: dict, page_fields: dict):
+    """Yield the features of a search page one at a time, and store its context and links in page_fields"""
+    if payload:
+        r = stac_post(url, json=payload, stream=True)
+    else:
+        r = stac_get(url, stream=True)
+    try:
+        if r.status_code != 200:
+            return
+        r.raw.decode_content = True
+        builder, target, depth = None, None, 0
+        for prefix, event, value in ijson.parse(r.raw, use_float=True):
+            if builder is None:
+                if prefix == 'features.item' and event == 'start_map':
+                    target = 'feature'
+                elif prefix in ('context', 'links') and event in ('start_map', 'start_array'):
+                    target = prefix
+                else:
+                    continue
+                builder, depth = ijson.ObjectBuilder(), 0
+            builder.event(event, value)
+            if event in ('start_map', 'start_array'):
+                depth += 1
+            elif event in ('end_map', 'end_array'):
+                depth -= 1
+                if not depth:
+                    if target == 'feature':
+                        yield builder.value
+                    else:
+                        page_fields[target] = builder.value
+                    builder = None
+    finally:
+        r.close()
+
+def _get_page(url: str, payload: dict = None):
+    """Returns the parsed json of a search page or None if it is not a HTTP 200 OK"""
+    if payload:
+        r = stac_post(url, json=payload)
+    else:
+        r = stac_get(url)
+    try:
+        if r.status_code == 200:
+            return r.json()
+        return None
+    finally:
+        r.close()
 
 def get_next_page(links:list):
     """Returns the next page link or None from STAC API Search links list"""
@@ -67,3 +217,85 @@ def get_next_page(links:list):
         if link['rel'] == 'next':
             next_page = link['href']
     return next_page
+
+def get_next_request(links: list, payload: dict = None):
+    """Returns the (url, POST payload) of the next page or (None, None) from STAC API Search links list
+
+    A POST search announces its next page with a link {'method': 'POST', 'body': {...}}, the body
+    replaces the payload of the current page, or is merged into it when the link has 'merge': true.
+    A next link without a method is a GET of its href.
+    """
+    next_link = None
+    for link in links:
+        if link['rel'] == 'next':
+            next_link = link
+    if next_link is None:
+        return None, None
+    if next_link.get('method', 'GET').upper() != 'POST':
+        return next_link['href'], None
+    body = next_link.get('body')
+    if body is None:
+        return next_link['href'], payload
+    if next_link.get('merge') and payload:
+        body = dict(payload, **body)
+    return next_link['href'], body
+
+def negotiate_search_params(api_root: str, root: dict) -> dict:
+    """
+    The /search parameters supported by a STAC API, from its conformance classes
+
+    The conformance classes are read from the conformsTo of the landing
+    page, or from /conformance for the APIs that do not list them there.
+    The limit is sent to an API conforming to item-search, the fields to
+    an API conforming to the fields extension. An API that conforms to
+    neither is searched with its defaults.
+
+    Parameters
+    ----------
+    api_root : str
+        The stac api root url.
+    root: dict
+        The json of the landing page.
+
+    Returns
+    -------
+    search_params: dict
+        {'limit': int, 'fields': {'include': [...], 'exclude': [...]}},
+        each key only when the API supports it. See add_search_params().
+
+    """
+    conforms_to = root.get('conformsTo')
+    if conforms_to is None:
+        r = stac_get(f'{api_root}/conformance')
+        try:
+            conforms_to = r.json().get('conformsTo', []) if r.status_code == 200 else []
+        except ValueError:
+            conforms_to = []
+        finally:
+            r.close()
+    search_params = {}
+    if search_limit > 0 and any(uri.rstrip('/').endswith('/item-search') for uri in conforms_to):
+        search_params['limit'] = search_limit
+    if search_fields_enabled and any(uri.endswith('item-search#fields') for uri in conforms_to):
+        search_params['fields'] = {'include': search_fields, 'exclude': search_exclude_fields}
+    return search_params
+
+def add_search_params(url: str, payload: dict = None, search_params: dict = None):
+    """Returns the (url, payload) of a search with the parameters of negotiate_search_params()
+
+    A POST search gets the parameters in its payload, a GET search in its
+    query string (the fields as a comma separated list, the excluded
+    ones prefixed with '-'). The next links of the API carry them on.
+    """
+    if not search_params:
+        return url, payload
+    if payload is not None:
+        return url, dict(payload, **search_params)
+    query = {}
+    if 'limit' in search_params:
+        query['limit'] = search_params['limit']
+    if 'fields' in search_params:
+        fields = search_params['fields']
+        query['fields'] = ','.join(fields['include'] + ['-' + field for field in fields['exclude']])
+    separator = '&' if '?' in url else '?'
+    return url + separator + urlencode(query, safe=','), None
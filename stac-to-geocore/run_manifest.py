@@ -0,0 +1,226 @@
+import base64
+import logging
+import os
+import zlib
+
+from botocore.exceptions import BotoCoreError, ClientError
+
+from s3_operations import delete_filelist_s3, get_s3_client
+from serializers import content_encoding
+
+# Keys of the records of the last harvest, one per line, stored in the template bucket
+run_manifest_name = os.environ.get('RUN_MANIFEST_NAME', 'lastRun.txt')
+# 'true' stores the manifest with Content-Encoding gzip, the readers below detect and decompress it. The default
+# follows GEOCORE_CONTENT_ENCODING, a zstd harvest writes a gzip manifest (gzip members can be streamed in parts)
+run_manifest_gzip = os.environ.get('RUN_MANIFEST_GZIP', 'false' if content_encoding() == 'identity' else 'true').lower() == 'true'
+# Size of the multipart upload parts, S3 requires at least 5 MiB for every part but the last one
+run_manifest_part_size = max(int(os.environ.get('RUN_MANIFEST_PART_SIZE', str(8 * 1024 * 1024))), 5 * 1024 * 1024)
+_min_part_size = 5 * 1024 * 1024
+_read_chunk_size = 1024 * 1024
+
+
+def iter_manifest_keys(bucket, name=None):
+    """Return an iterator over the keys of a manifest, read as a stream with a single GET
+    A gzip manifest (Content-Encoding gzip, or the gzip magic bytes) is decompressed on the fly, its parts
+    may be separate gzip members.
+    :param bucket: template bucket name
+    :param name: manifest key, default is RUN_MANIFEST_NAME
+    :return an iterator of keys, or None when there is no manifest
+    """
+    name = name or run_manifest_name
+    try:
+        response = get_s3_client().get_object(Bucket=bucket, Key=name)
+    except ClientError as e:
+        if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'):
+            logging.error(e)
+        return None
+    return _iter_lines(response['Body'], response.get('ContentEncoding') == 'gzip')
+
+
+def _iter_lines(body, gzipped):
+    try:
+        chunks = iter(lambda: body.read(_read_chunk_size), b'')
+        first = next(chunks, b'')
+        if gzipped or first[:2] == b'\x1f\x8b':
+            chunks = _gunzip(first, chunks)
+        else:
+            chunks = _prepend(first, chunks)
+        tail = b''
+        for chunk in chunks:
+            lines = (tail + chunk).split(b'\n')
+            tail = lines.pop()
+            for line in lines:
+                key = line.decode('utf-8').rstrip('\r')
+                if key:
+                    yield key
+        if tail.strip():
+            yield tail.decode('utf-8').rstrip('\r')
+    finally:
+        body.close()
+
+
+def _prepend(first, chunks):
+    yield first
+    yield from chunks
+
+
+def _gunzip(first, chunks):
+    """Decompress a stream of one or more concatenated gzip members"""
+    decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    for chunk in _prepend(first, chunks):
+        while chunk:
+            yield decompressor.decompress(chunk)
+            if not decompressor.eof:
+                break
+            # End of a member, the rest of the chunk starts the next one
+            chunk = decompressor.unused_data
+            decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+    yield decompressor.flush()
+
+
+def delete_stac_s3(bucket_geojson, bucket_template):
+    """Delete the records listed in the manifest of the previous harvest
+    The manifest is streamed with one GET and the records are deleted in batches as they are read.
+    :param bucket_geojson: GeoCore bucket name
+    :param bucket_template: template bucket name, where the manifest is stored
+    :return an error message, or None
+    """
+    keys = iter_manifest_keys(bucket_template)
+    if keys is None:
+        print(f'No existing {run_manifest_name}')
+        return None
+    report = delete_filelist_s3(deleted_filelist=keys, bucket=bucket_geojson)
+    if report['errors']:
+        return f"Failed to delete {len(report['errors'])} records of the previous harvest from {bucket_geojson}. "
+    return None
+
+
+class ManifestWriter:
+    """Write the manifest of a harvest to S3 while the keys are logged.
+
+    Keys are buffered and sent as the parts of a multipart upload, so the writer memory stays bounded by
+    the part size whatever the number of keys. With gzip, the buffer holds complete gzip members (the
+    member being written is finished at every part and every state()), and their concatenation is the
+    gzip manifest. The manifest replaces the previous one when close() completes the upload, a manifest
+    that is only written in small parts is sent with a single PUT instead.
+
+    state() returns what a checkpoint must save to continue the manifest in the next invocation, see
+    ManifestWriter.resume(). An upload that is never completed or aborted is removed by the bucket
+    lifecycle rule of the incomplete multipart uploads.
+
+    Example
+    -------
+    manifest = ManifestWriter(bucket)
+    for key in keys:
+        manifest.write(key)
+    manifest.close()
+    """
+
+    def __init__(self, bucket, name=None, gzip=None, part_size=None):
+        self.bucket = bucket
+        self.name = name or run_manifest_name
+        self.gzip = run_manifest_gzip if gzip is None else gzip
+        self.part_size = part_size or run_manifest_part_size
+        self.count = 0
+        self.upload_id = None
+        self.parts = []
+        self._buffer = bytearray()
+        self._compressor = None
+        # Buffer size at which the next part is sent, a failed part is retried one part size later
+        self._next_part = self.part_size
+
+    @classmethod
+    def resume(cls, bucket, state, name=None, part_size=None):
+        """Return a writer continuing the manifest saved by state()"""
+        writer = cls(bucket, name=name, gzip=state['gzip'], part_size=part_size)
+        writer.count = state['count']
+        writer.upload_id = state['upload_id']
+        writer.parts = state['parts']
+        writer._buffer = bytearray(base64.b64decode(state['pending']))
+        return writer
+
+    def write(self, key):
+        """Add a key to the manifest, a part is uploaded once the buffer reaches the part size"""
+        line = f'{key}\n'.encode('utf-8')
+        if self.gzip:
+            if self._compressor is None:
+                self._compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+            line = self._compressor.compress(line)
+        self._buffer += line
+        self.count += 1
+        if len(self._buffer) >= self._next_part:
+            self._finish_member()
+            self._upload_part()
+
+    def state(self):
+        """Return the json serializable state of an unfinished manifest, uploading the buffer if it is a valid part"""
+        self._finish_member()
+        if len(self._buffer) >= _min_part_size:
+            self._upload_part()
+        return {'gzip': self.gzip, 'count': self.count, 'upload_id': self.upload_id, 'parts': self.parts,
+                'pending': base64.b64encode(bytes(self._buffer)).decode('ascii')}
+
+    def close(self):
+        """Write the last part and complete the manifest, return True if it is stored"""
+        self._finish_member()
+        s3_client = get_s3_client()
+        extra = {'ContentType': 'text/plain'}
+        if self.gzip:
+            extra['ContentEncoding'] = 'gzip'
+        try:
+            if self.upload_id is None:
+                body = bytes(self._buffer)
+                if self.gzip and not body:
+                    body = _empty_gzip()
+                s3_client.put_object(Bucket=self.bucket, Key=self.name, Body=body, **extra)
+            else:
+                if self._buffer and not self._upload_part():
+                    return False
+                s3_client.complete_multipart_upload(Bucket=self.bucket, Key=self.name, UploadId=self.upload_id,
+                                                    MultipartUpload={'Parts': self.parts})
+        except (BotoCoreError, ClientError) as e:
+            logging.error(f'Could not write {self.name}: {e}')
+            return False
+        self._buffer = bytearray()
+        return True
+
+    def abort(self):
+        """Give up on the manifest, the previous one stays in place"""
+        if self.upload_id is not None:
+            try:
+                get_s3_client().abort_multipart_upload(Bucket=self.bucket, Key=self.name, UploadId=self.upload_id)
+            except (BotoCoreError, ClientError) as e:
+                logging.error(e)
+        self.upload_id = None
+        self.parts = []
+        self._buffer = bytearray()
+
+    def _finish_member(self):
+        if self._compressor is not None:
+            self._buffer += self._compressor.flush()
+            self._compressor = None
+
+    def _upload_part(self):
+        s3_client = get_s3_client()
+        try:
+            if self.upload_id is None:
+                extra = {'ContentEncoding': 'gzip'} if self.gzip else {}
+                self.upload_id = s3_client.create_multipart_upload(Bucket=self.bucket, Key=self.name,
+                                                                   ContentType='text/plain', **extra)['UploadId']
+            part_number = len(self.parts) + 1
+            response = s3_client.upload_part(Bucket=self.bucket, Key=self.name, UploadId=self.upload_id,
+                                             PartNumber=part_number, Body=bytes(self._buffer))
+        except (BotoCoreError, ClientError) as e:
+            # The buffer is kept, the part is sent again with the next one
+            logging.error(f'Could not upload part {len(self.parts) + 1} of {self.name}: {e}')
+            self._next_part = len(self._buffer) + self.part_size
+            return False
+        self.parts.append({'ETag': response['ETag'], 'PartNumber': part_number})
+        self._buffer = bytearray()
+        self._next_part = self.part_size
+        return True
+
+
+def _empty_gzip():
+    compressor = zlib.compressobj(6, zlib.DEFLATED, zlib.MAX_WBITS | 16)
+    return compressor.compress(b'') + compressor.flush()
@@ -1,53 +1,98 @@
 import boto3 
 import logging
 import os 
-import json
-from botocore.exceptions import ClientError
+import time
+from concurrent.futures import ThreadPoolExecutor
+from botocore.config import Config
+from botocore.exceptions import BotoCoreError, ClientError
+
+from serializers import decode_body, encode_body, serialize_json
+from metrics import add_record_time, increment, observe_latency, observe_record
+
+# Size of the urllib3 connection pool of the shared S3 client, keep it >= the number of upload threads
+s3_max_pool_connections = int(os.environ.get('S3_MAX_POOL_CONNECTIONS', '32'))
+# DeleteObjects requests sent in parallel, each request deletes up to delete_batch_size keys
+delete_workers = int(os.environ.get('S3_DELETE_WORKERS', '8'))
+delete_batch_size = 1000
+# Custom S3 endpoint, e.g. a local moto server or MinIO for the offline benchmarks, None uses AWS
+s3_endpoint_url = os.environ.get('S3_ENDPOINT_URL') or None
+_s3_client = None
+
+def get_s3_client():
+    """Return the S3 client shared by every S3 operation of the harvest
+    boto3 clients are thread safe, so one client with a large connection pool is reused by the
+    upload threads instead of creating a new client (and new TLS connections) for each object.
+    """
+    global _s3_client
+    if _s3_client is None:
+        config = Config(max_pool_connections=s3_max_pool_connections, retries={'max_attempts': 5, 'mode': 'standard'})
+        _s3_client = boto3.client('s3', config=config, endpoint_url=s3_endpoint_url)
+    return _s3_client
 
 def delete_filelist_s3(deleted_filelist, bucket):
     """ Delete the STAC JSON files in deleted_filelist from an s3 bucket
-    Return a message to the user: "Deleted xx records from S3 yy bucket"
-    :parm deleted_filelist: a list of s3 files to be deleted 
+    Keys are deleted with DeleteObjects in batches of 1000 keys (the S3 limit), the batches are sent in parallel.
+    deleted_filelist can be a generator (e.g. a streamed manifest), at most 2 batches per thread are read ahead.
+    Print a message to the user: "Deleted xx records from S3 yy bucket"
+    :parm deleted_filelist: a list or an iterable of s3 files to be deleted 
     :parm bucket: s3 bucket to delete from 
+    :return a report {'deleted': number of deleted keys, 'errors': [{'Key': .., 'Code': .., 'Message': ..}]}
     """
-    s3 = boto3.resource('s3')
-    error_msg = None 
-    count = 0
-    for filename in deleted_filelist:    
-        try: 
-            s3object = s3.Object(bucket, filename)
-            response = s3object.delete()
-            count += 1
-            #print("Response: ", response)
-            #print(f"Deleted filenames: {filename} from bucket {bucket}")
-        except ClientError as e: 
-            logging.error(e)
-            error_msg += e
-    print('Deleted ', count, " records from S3 ", bucket)
-        
-    return error_msg
+    report = {'deleted': 0, 'errors': []}
+    def collect(future): 
+        deleted, errors = future.result()
+        report['deleted'] += deleted
+        report['errors'].extend(errors)
+    with ThreadPoolExecutor(max_workers=delete_workers) as executor:
+        pending = []
+        for batch in _key_batches(deleted_filelist): 
+            if len(pending) >= delete_workers * 2: 
+                collect(pending.pop(0))
+            pending.append(executor.submit(_delete_batch_s3, batch, bucket))
+        for future in pending: 
+            collect(future)
+    print('Deleted ', report['deleted'], " records from S3 ", bucket)
+    if report['errors']: 
+        print(f"Failed to delete {len(report['errors'])} records from S3 {bucket}")
+    return report
 
-# Requires open_s3_file(bucket, filename),  s3_list_filenames(bucket), delete_files_s3(filename_list, bucket)
-def delete_stac_s3(bucket_geojson, bucket_template):
-    error_msg = None 
-    filenames_list = list_filenames_s3(bucket_template)    
-    if 'lastRun.txt' in filenames_list: 
-        lastRun = open_file_s3(bucket_template, 'lastRun.txt')
-        #ccmeo_napl-ottawa_napl-ottawa-2001.geojson, or lastRun.replace('\r\n', ' ').split(' ')
-        lastRun_list = lastRun.splitlines()
-        e = delete_filelist_s3(deleted_filelist=lastRun_list, bucket=bucket_geojson)
-        if e != None: 
-            error_msg += e
-    else: 
-        print("No existing lastRun.txt")
-    return error_msg
+def _key_batches(keys):
+    """Yield the non empty keys in lists of delete_batch_size keys"""
+    batch = []
+    for key in keys: 
+        if key: 
+            batch.append(key)
+            if len(batch) == delete_batch_size: 
+                yield batch
+                batch = []
+    if batch: 
+        yield batch
+
+def _delete_batch_s3(keys, bucket):
+    """Delete up to 1000 keys with a single DeleteObjects request, return (deleted count, errors)"""
+    s3_client = get_s3_client()
+    try: 
+        response = s3_client.delete_objects(Bucket=bucket, Delete={'Objects': [{'Key': key} for key in keys], 'Quiet': True})
+    except ClientError as e: 
+        logging.error(e)
+        error = e.response.get('Error', {})
+        return 0, [{'Key': key, 'Code': error.get('Code'), 'Message': error.get('Message')} for key in keys]
+    except BotoCoreError as e: 
+        # Connection errors and timeouts fail this batch only, the other batches are still sent 
+        logging.error(f'Could not delete {len(keys)} records from {bucket}: {e}')
+        return 0, [{'Key': key, 'Code': type(e).__name__, 'Message': str(e)} for key in keys]
+    # Quiet mode only reports the keys that could not be deleted 
+    errors = [{'Key': error.get('Key'), 'Code': error.get('Code'), 'Message': error.get('Message')} for error in response.get('Errors', [])]
+    for error in errors: 
+        logging.error(f"Could not delete {error['Key']} from {bucket}: {error['Code']} {error['Message']}")
+    return len(keys) - len(errors), errors
 
 # Open files from s3 bucket
 def open_file_s3(bucket, filename):
     """Open a S3 file from bucket and filename and return the body as a string
     :param bucket: Bucket name
     :param filename: Specific file name to open
-    :return: body of the file as a string
+    :return: body of the file as a string, or False if the file is missing or cannot be read
     """
     try: 
         """
@@ -59,15 +104,47 @@ def open_file_s3(bucket, filename):
         #print(type(file_body))
         """
         # Second option to load file from S3 buckets 
-        s3 = boto3.resource('s3')
+        s3 = boto3.resource('s3', endpoint_url=s3_endpoint_url)
         content_object = s3.Object(bucket, filename)
-        file_body= content_object.get()['Body'].read().decode('utf-8')
+        response = content_object.get()
+        # gzip or zstd objects (GEOCORE_CONTENT_ENCODING) are decoded transparently 
+        file_body = decode_body(response['Body'].read(), response.get('ContentEncoding')).decode('utf-8')
         #json_content = json.loads(file_content)
         
         return str(file_body)
     except ClientError as e:
-        logging.error(e)
+        # A missing object (e.g. the manifest of a first harvest) is not an error, the caller handles it 
+        if e.response.get('Error', {}).get('Code') not in ('NoSuchKey', '404'): 
+            logging.error(e)
         return False 
+
+def open_file_s3_with_etag(bucket, filename):
+    """Open a S3 file from bucket and filename and return the body together with its ETag
+    :param bucket: Bucket name
+    :param filename: Specific file name to open
+    :return: (body of the file as a string, ETag), or (False, None) if an error occurs
+    """
+    try: 
+        s3 = boto3.resource('s3', endpoint_url=s3_endpoint_url)
+        response = s3.Object(bucket, filename).get()
+        file_body = decode_body(response['Body'].read(), response.get('ContentEncoding')).decode('utf-8')
+        return str(file_body), response.get('ETag')
+    except ClientError as e:
+        logging.error(e)
+        return False, None
+
+def get_etag_s3(bucket, filename):
+    """Return the ETag of a S3 object with a single HEAD request, or None if it cannot be read
+    :param bucket: Bucket name
+    :param filename: Specific file name to check
+    """
+    s3_client = get_s3_client()
+    try: 
+        response = s3_client.head_object(Bucket=bucket, Key=filename)
+        return response.get('ETag')
+    except ClientError as e:
+        logging.error(e)
+        return None
     
     
 def list_filenames_s3(bucket):
@@ -76,7 +153,7 @@ def list_filenames_s3(bucket):
     :parm bucket: name of the bucket 
     :return a list of filenames within the bucket 
     """
-    s3 = boto3.resource("s3")
+    s3 = boto3.resource("s3", endpoint_url=s3_endpoint_url)
     my_bucket = s3.Bucket(bucket)
     filename_list = []
     count = 0 
@@ -88,31 +165,81 @@ def list_filenames_s3(bucket):
     return filename_list
 
 
+def list_etags_s3(bucket, prefix=''):
+    """ List the objects of a S3 bucket under a prefix with their ETag
+    The listing is paginated, each ListObjectsV2 request returns up to 1000 objects.
+    :parm bucket: name of the bucket 
+    :parm prefix: key prefix of the listed objects 
+    :return a dictionary {key: ETag without its quotes}, empty if the bucket cannot be listed 
+    """
+    etags = {}
+    paginator = get_s3_client().get_paginator('list_objects_v2')
+    try: 
+        for page in paginator.paginate(Bucket=bucket, Prefix=prefix): 
+            for obj in page.get('Contents', []): 
+                etags[obj['Key']] = obj['ETag'].strip('"')
+    except ClientError as e:
+        logging.error(e)
+        return {}
+    return etags
+
+
+def encode_body_timed(body): 
+    """encode_body() with the GEOCORE_CONTENT_ENCODING, adding its time to the compression phase and the 
+    bytes it saves to the compression_saved_bytes counter 
+    :return (bytes, Content-Encoding value or None)
+    """
+    start = time.perf_counter()
+    encoded, encoding = encode_body(body)
+    if encoding: 
+        add_record_time('compression', time.perf_counter() - start)
+        increment('compression_saved_bytes', len(body) - len(encoded))
+    return encoded, encoding
+
+
 # Upload a a text or json file to S3 
-def upload_file_s3(filename, bucket, json_data, object_name=None):
+def upload_file_s3(filename, bucket, json_data, object_name=None, dedup=None):
     """Upload a file to an S3 bucket
     :param file_name: File to upload
     :param bucket: Bucket to upload to
-    :param json_data: json_data to be updated, can be none 
+    :param json_data: json_data to be updated, can be none. It is serialized by serialize_json(), compact by default 
+                      and compressed by encode_body() when GEOCORE_CONTENT_ENCODING is gzip or zstd 
     :param object_name: S3 object name. If not specified then file_name is used
-    :return: True if file was uploaded, else False
+    :param dedup: UploadDedup of the harvest, the PUT of a json_data already in the bucket is skipped 
+    :return: True if file was uploaded (or is already in the bucket), else False
     """
     # If S3 object_name was not specified, use file_name
     if object_name is None:
         object_name = os.path.basename(filename)
     # boto3.client vs boto3.resources:https://www.learnaws.org/2021/02/24/boto3-resource-client/ 
-    s3_client = boto3.client('s3')  
+    s3_client = get_s3_client()  
     if json_data: 
+        start = time.perf_counter()
+        body = serialize_json(json_data)
+        add_record_time('serialization', time.perf_counter() - start)
+        body, encoding = encode_body_timed(body)
+        encoded = time.perf_counter()
+        # The ETag of an encoded object is the MD5 of the compressed bytes 
+        if dedup is not None and dedup.unchanged(filename, body): 
+            increment('s3_put_skipped')
+            return True
+        extra = {'ContentEncoding': encoding} if encoding else {}
         try:
-            response = s3_client.put_object(Body=(bytes(json.dumps(json_data, indent=4, ensure_ascii=False).encode('utf-8'))), 
-                                            Bucket=bucket,
-                                            Key = filename)
+            s3_client.put_object(Body=body, 
+                                 Bucket=bucket,
+                                 Key = filename, 
+                                 **extra)
         except ClientError as e:
             logging.error(e)
+            increment('s3_put_errors')
             return False    
+        finally: 
+            observe_latency('s3_put', time.perf_counter() - encoded)
+        observe_record('upload', filename, time.perf_counter() - encoded)
+        increment('s3_put_bytes', len(body))
     else:     
         try: 
-            response = s3_client.upload_file(filename, bucket, object_name)
+            s3_client.upload_file(filename, bucket, object_name)
         except ClientError as e:
             logging.error(e)
             return False 
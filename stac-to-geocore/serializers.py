@@ -0,0 +1,103 @@
+import gzip
+import json
+import logging
+import os
+
+try:
+    import orjson
+except ImportError:
+    orjson = None
+
+try:
+    import zstandard
+except ImportError:
+    zstandard = None
+
+# 'compact' writes no whitespace, 'indent' keeps the previous human readable output (indent=4)
+geocore_json_format = os.environ.get('GEOCORE_JSON_FORMAT', 'compact').lower()
+# 'auto' uses orjson if it is installed, 'json' always uses the standard json module
+geocore_json_backend = os.environ.get('GEOCORE_JSON_BACKEND', 'auto').lower()
+# 'identity' stores the records as plain json, 'gzip' or 'zstd' store them compressed with a Content-Encoding header.
+# The readers of the records (open_file_s3 and the downstream stages) must decode them
+geocore_content_encoding = os.environ.get('GEOCORE_CONTENT_ENCODING', 'identity').lower()
+# Compression level, default is 6 for gzip and 3 for zstd
+geocore_compression_level = os.environ.get('GEOCORE_COMPRESSION_LEVEL')
+
+if geocore_content_encoding == 'zstd' and zstandard is None:
+    logging.error('zstandard is not installed, the records are gzip encoded instead of zstd')
+
+_gzip_magic = b'\x1f\x8b'
+_zstd_magic = b'\x28\xb5\x2f\xfd'
+
+
+def serialize_json(json_data, json_format=None, backend=None):
+    """Serialize a GeoCore record (or any json data) to UTF-8 bytes, ready to be sent as an S3 object body
+    :param json_data: json serializable data
+    :param json_format: 'compact' or 'indent', default is GEOCORE_JSON_FORMAT
+    :param backend: 'auto' or 'json', default is GEOCORE_JSON_BACKEND
+    :return: bytes
+    """
+    json_format = json_format or geocore_json_format
+    backend = backend or geocore_json_backend
+    if json_format == 'indent':
+        return json.dumps(json_data, indent=4, ensure_ascii=False).encode('utf-8')
+    if orjson is not None and backend == 'auto':
+        try:
+            # orjson returns bytes directly, without an intermediate str
+            return orjson.dumps(json_data)
+        except TypeError as e:
+            # e.g. integers larger than 64 bits, the standard json module handles them
+            logging.error(f'orjson could not serialize the record, falling back to json: {e}')
+    return json.dumps(json_data, separators=(',', ':'), ensure_ascii=False).encode('utf-8')
+
+
+def serializer_name(json_format=None, backend=None):
+    """Return a short description of the serializer in use, e.g. 'compact (orjson)'"""
+    json_format = json_format or geocore_json_format
+    backend = backend or geocore_json_backend
+    if json_format == 'indent':
+        return 'indent (json)'
+    return f"compact ({'orjson' if orjson is not None and backend == 'auto' else 'json'})"
+
+
+def content_encoding(encoding=None):
+    """Return the content encoding in use: 'identity', 'gzip' or 'zstd' (only when zstandard is installed)"""
+    encoding = encoding or geocore_content_encoding
+    if encoding == 'zstd' and zstandard is None:
+        return 'gzip'
+    return encoding if encoding in ('gzip', 'zstd') else 'identity'
+
+
+def encode_body(body, encoding=None, level=None):
+    """Compress a serialized record with the content encoding of GEOCORE_CONTENT_ENCODING
+    The output only depends on the input (the gzip header has no timestamp), so an unchanged record keeps the
+    same bytes and the same ETag from one harvest to the next.
+    :param body: bytes
+    :param encoding: 'identity', 'gzip' or 'zstd', default is GEOCORE_CONTENT_ENCODING
+    :param level: compression level, default is GEOCORE_COMPRESSION_LEVEL
+    :return: (bytes, Content-Encoding value or None)
+    """
+    encoding = content_encoding(encoding)
+    if encoding == 'identity':
+        return body, None
+    level = level or geocore_compression_level
+    if encoding == 'zstd':
+        return zstandard.ZstdCompressor(level=int(level or 3)).compress(body), 'zstd'
+    return gzip.compress(body, compresslevel=int(level or 6), mtime=0), 'gzip'
+
+
+def decode_body(body, encoding=None):
+    """Decompress an S3 object body written by encode_body()
+    The encoding is read from the Content-Encoding of the object, or detected from the gzip and zstd magic bytes.
+    :param body: bytes
+    :param encoding: Content-Encoding of the object, can be None
+    :return: bytes
+    """
+    if encoding == 'zstd' or (encoding is None and body[:4] == _zstd_magic):
+        if zstandard is None:
+            raise ValueError('zstandard is not installed, cannot decode a zstd object')
+        return zstandard.ZstdDecompressor().decompressobj().decompress(body)
+    if encoding == 'gzip' or (encoding is None and body[:2] == _gzip_magic):
+        # Several concatenated gzip members (e.g. a multipart manifest) decode to one body
+        return gzip.decompress(body)
+    return body
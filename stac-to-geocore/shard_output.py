@@ -0,0 +1,340 @@
+import base64
+import io
+import json
+import logging
+import os
+import struct
+
+from boto3.s3.transfer import TransferConfig
+from botocore.exceptions import BotoCoreError, ClientError
+
+from s3_operations import delete_filelist_s3, get_s3_client, open_file_s3
+from serializers import serialize_json
+from upload_pipeline import UploadPipeline
+
+try:
+    import pyarrow as pa
+    import pyarrow.parquet as pq
+except ImportError:
+    pa = None
+    pq = None
+
+# 'objects' uploads one .geojson object per record, 'ndjson' and 'geoparquet' batch the GeoCore features in shards.
+# The shards are rewritten by every harvest, so the incremental harvest mode only applies to 'objects'.
+geocore_output_mode = os.environ.get('GEOCORE_OUTPUT_MODE', 'objects').lower()
+# A shard is closed when it holds this many records or this many bytes of serialized features
+shard_max_records = int(os.environ.get('GEOCORE_SHARD_MAX_RECORDS', '10000'))
+shard_max_bytes = int(os.environ.get('GEOCORE_SHARD_MAX_BYTES', str(128 * 1024 * 1024)))
+# Shards and their index are written under {shard_prefix}{run_id}/ in the GeoCore bucket
+shard_prefix = os.environ.get('GEOCORE_SHARD_PREFIX', 'shards/')
+# Size of the multipart upload parts, S3 requires at least 5 MiB for every part but the last one
+shard_part_size = max(int(os.environ.get('GEOCORE_SHARD_PART_SIZE', str(8 * 1024 * 1024))), 5 * 1024 * 1024)
+
+# S3 minimum size of every multipart upload part but the last one
+_min_part_size = 5 * 1024 * 1024
+
+
+def open_output(bucket, on_success=None, run_id=None, name='main', resume=False, mode=None, dedup=None, state=None):
+    """Return the writer of the translated records for the output mode
+    Both writers take records with submit(key, json_data) and have drain(), close(), uploaded and failed.
+    :param bucket: GeoCore bucket name
+    :param on_success: function on_success(key) called for each object written to the bucket
+    :param run_id: identifier of the harvest, used in the shard keys
+    :param name: name of the writer, the workers of a fan-out harvest each write their own shards
+    :param resume: continue the shards and the index of an unfinished harvest
+    :param mode: 'objects', 'ndjson' or 'geoparquet', default is GEOCORE_OUTPUT_MODE
+    :param dedup: UploadDedup skipping the objects that did not change, the shards are always written
+    :param state: ShardWriter.state() saved by the checkpoint of an unfinished harvest
+    """
+    mode = mode or geocore_output_mode
+    if mode == 'objects':
+        return UploadPipeline(bucket=bucket, on_success=on_success, dedup=dedup)
+    return ShardWriter(bucket=bucket, run_id=run_id, name=name, on_success=on_success, resume=resume, mode=mode, state=state)
+
+
+class ShardWriter:
+    """Write the GeoCore features of a harvest in size and count bounded shards.
+
+    - ndjson: one compact GeoCore feature per line, streamed to S3 with a multipart upload
+    - geoparquet: one row per feature with the id, the WKB geometry, a bbox covering column and the
+      properties as a JSON string, written once the shard is full
+
+    The index {shard_prefix}{run_id}/{name}-index.json maps every record id to its shard and its offset
+    (byte offset and length of the line for ndjson, row number for geoparquet). Records are written from
+    the harvest loop, the writer is not thread safe.
+
+    A shard is only closed at its record or byte limit, or by close(). A checkpoint saves the open shard
+    with state(): the multipart upload and the buffered lines of an ndjson shard, the keys of the rows of
+    a geoparquet shard that drain() staged in the bucket. The next invocation continues the shard with
+    ShardWriter(..., resume=True, state=state), and suspend() leaves it open when the harvest hands over.
+
+    Example
+    -------
+    with ShardWriter(bucket, run_id, on_success=log_key) as writer:
+        for item in items:
+            writer.submit(item_name, item_geocore)
+    print(writer.uploaded, writer.failed)
+    """
+
+    def __init__(self, bucket, run_id, name='main', on_success=None, resume=False, mode='ndjson',
+                 max_records=None, max_bytes=None, state=None):
+        if mode == 'geoparquet' and pa is None:
+            logging.error('pyarrow is not installed, writing ndjson shards instead of geoparquet')
+            mode = 'ndjson'
+        self.bucket = bucket
+        self.mode = mode
+        self.on_success = on_success
+        self.max_records = max_records or shard_max_records
+        self.max_bytes = max_bytes or shard_max_bytes
+        self.uploaded = 0
+        self.failed = []
+        self.base_key = f'{shard_prefix}{run_id}/{name}'
+        self.index_key = f'{self.base_key}-index.json'
+        self.index = {'format': mode, 'shards': [], 'records': {}}
+        self._index_logged = False
+        if resume:
+            previous = open_file_s3(bucket, self.index_key)
+            if previous:
+                self.index = json.loads(previous)
+                self._index_logged = True
+        self._shard = None
+        if resume and state:
+            self._shard = self._resume_shard(state)
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, filename, json_data):
+        """Add a record to the current shard, the shard is written once it is full
+        :param filename: S3 key the record would have in the 'objects' output, reported in failed
+        :param json_data: GeoCore dictionary
+        """
+        if self._shard is None:
+            self._shard = self._new_shard()
+        shard = self._shard
+        shard['keys'].append(filename)
+        for feature in json_data.get('features', []):
+            record_id = feature.get('properties', {}).get('id') or filename
+            if self.mode == 'ndjson':
+                line = serialize_json(feature, json_format='compact') + b'\n'
+                shard['entries'][record_id] = [shard['key'], shard['size'], len(line) - 1]
+                shard['buffer'] += line
+                shard['size'] += len(line)
+                if len(shard['buffer']) >= shard_part_size and not self._upload_part(shard):
+                    self._fail_shard(shard)
+                    return
+            else:
+                properties = serialize_json(feature.get('properties', {}), json_format='compact')
+                shard['entries'][record_id] = [shard['key'], len(shard['rows'])]
+                shard['rows'].append((record_id, feature.get('geometry'), properties))
+                shard['size'] += len(properties)
+        if len(shard['keys']) >= self.max_records or shard['size'] >= self.max_bytes:
+            self._finish_shard()
+
+    def drain(self):
+        """Send what the open shard can already store and write the index, so every record submitted so far is
+        in S3 or in state(): the buffered lines of an ndjson shard that make a valid part, the new rows of a
+        geoparquet shard"""
+        shard = self._shard
+        if shard is not None:
+            if self.mode == 'ndjson':
+                written = len(shard['buffer']) < _min_part_size or self._upload_part(shard)
+            else:
+                written = self._stage_rows(shard)
+            if not written:
+                self._fail_shard(shard)
+        self._save_index()
+
+    def state(self):
+        """Return the json serializable state of the open shard after drain(), or None"""
+        shard = self._shard
+        if shard is None or not shard['keys']:
+            return None
+        return {'key': shard['key'], 'keys': shard['keys'], 'entries': shard['entries'], 'size': shard['size'],
+                'upload_id': shard['upload_id'], 'parts': shard['parts'], 'staged': shard['staged'],
+                'pending': base64.b64encode(bytes(shard['buffer'])).decode('ascii')}
+
+    def suspend(self):
+        """Leave the open shard unfinished, the next invocation continues it from the checkpoint state()"""
+        self._shard = None
+        self._save_index()
+
+    def close(self):
+        """Write the open shard and the index"""
+        if self._shard is not None:
+            self._finish_shard()
+        self._save_index()
+
+    def _new_shard(self):
+        extension = 'ndjson' if self.mode == 'ndjson' else 'parquet'
+        key = f"{self.base_key}-{len(self.index['shards']):05d}.{extension}"
+        return {'key': key, 'keys': [], 'entries': {}, 'size': 0, 'buffer': bytearray(), 'rows': [],
+                'upload_id': None, 'parts': [], 'staged': []}
+
+    def _resume_shard(self, state):
+        shard = self._new_shard()
+        shard.update({'key': state['key'], 'keys': state['keys'], 'entries': state['entries'], 'size': state['size'],
+                      'upload_id': state['upload_id'], 'parts': state['parts'], 'staged': state['staged'],
+                      'buffer': bytearray(base64.b64decode(state['pending']))})
+        for staged_key in shard['staged']:
+            body = open_file_s3(self.bucket, staged_key)
+            if not body:
+                self._fail_shard(shard)
+                return None
+            for line in body.splitlines():
+                record_id, geometry, properties = json.loads(line)
+                shard['rows'].append((record_id, geometry, properties.encode('utf-8')))
+        shard['staged_rows'] = len(shard['rows'])
+        print(f"Continuing shard {shard['key']} with {len(shard['keys'])} records")
+        return shard
+
+    def _stage_rows(self, shard):
+        """Store the rows of a geoparquet shard added since the last drain(), the shard is written from them once full"""
+        rows = shard['rows'][shard.get('staged_rows', 0):]
+        if not rows:
+            return True
+        staged_key = f"{shard['key']}.rows-{len(shard['staged']):03d}.ndjson"
+        body = b''.join(serialize_json([record_id, geometry, properties.decode('utf-8')], json_format='compact') + b'\n'
+                        for record_id, geometry, properties in rows)
+        try:
+            get_s3_client().put_object(Bucket=self.bucket, Key=staged_key, Body=body, ContentType='application/x-ndjson')
+        except (BotoCoreError, ClientError) as e:
+            logging.error(f"Could not stage the rows of {shard['key']}: {e}")
+            return False
+        shard['staged'].append(staged_key)
+        shard['staged_rows'] = len(shard['rows'])
+        return True
+
+    def _upload_part(self, shard):
+        """Send the buffered lines as the next part of the multipart upload of the shard"""
+        s3_client = get_s3_client()
+        try:
+            if shard['upload_id'] is None:
+                shard['upload_id'] = s3_client.create_multipart_upload(
+                    Bucket=self.bucket, Key=shard['key'], ContentType='application/geo+json-seq')['UploadId']
+            part_number = len(shard['parts']) + 1
+            response = s3_client.upload_part(Bucket=self.bucket, Key=shard['key'], UploadId=shard['upload_id'],
+                                             PartNumber=part_number, Body=bytes(shard['buffer']))
+        except (BotoCoreError, ClientError) as e:
+            logging.error(f"Could not upload part {len(shard['parts']) + 1} of {shard['key']}: {e}")
+            return False
+        shard['parts'].append({'ETag': response['ETag'], 'PartNumber': part_number})
+        shard['buffer'] = bytearray()
+        return True
+
+    def _finish_shard(self):
+        shard, self._shard = self._shard, None
+        if not shard['keys']:
+            return
+        if self.mode == 'ndjson':
+            written = self._write_ndjson(shard)
+        else:
+            written = self._write_geoparquet(shard)
+        if not written:
+            self._fail_shard(shard)
+            return
+        if shard['staged']:
+            delete_filelist_s3(deleted_filelist=shard['staged'], bucket=self.bucket)
+        self.index['shards'].append(shard['key'])
+        self.index['records'].update(shard['entries'])
+        self.uploaded += len(shard['keys'])
+        if self.on_success:
+            self.on_success(shard['key'])
+        print(f"Wrote {len(shard['keys'])} records to shard {shard['key']}")
+
+    def _write_ndjson(self, shard):
+        s3_client = get_s3_client()
+        try:
+            if shard['upload_id'] is None:
+                # Small shard, a single PUT is enough
+                s3_client.put_object(Bucket=self.bucket, Key=shard['key'], Body=bytes(shard['buffer']),
+                                     ContentType='application/geo+json-seq')
+                return True
+            if shard['buffer'] and not self._upload_part(shard):
+                return False
+            s3_client.complete_multipart_upload(Bucket=self.bucket, Key=shard['key'], UploadId=shard['upload_id'],
+                                                MultipartUpload={'Parts': shard['parts']})
+        except (BotoCoreError, ClientError) as e:
+            logging.error(f"Could not write shard {shard['key']}: {e}")
+            return False
+        return True
+
+    def _write_geoparquet(self, shard):
+        ids, geometries, bboxes, properties = [], [], [], []
+        for record_id, geometry, record_properties in shard['rows']:
+            ids.append(record_id)
+            wkb, bbox = polygon_to_wkb(geometry)
+            geometries.append(wkb)
+            bboxes.append(bbox)
+            properties.append(record_properties.decode('utf-8'))
+        bbox_type = pa.struct([('xmin', pa.float64()), ('ymin', pa.float64()), ('xmax', pa.float64()), ('ymax', pa.float64())])
+        table = pa.table({
+            'id': pa.array(ids, pa.string()),
+            'geometry': pa.array(geometries, pa.binary()),
+            'bbox': pa.array(bboxes, bbox_type),
+            'properties': pa.array(properties, pa.string()),
+        })
+        known = [bbox for bbox in bboxes if bbox]
+        geo = {'version': '1.1.0', 'primary_column': 'geometry', 'columns': {'geometry': {
+            'encoding': 'WKB', 'geometry_types': ['Polygon'],
+            'bbox': [min(b['xmin'] for b in known), min(b['ymin'] for b in known),
+                     max(b['xmax'] for b in known), max(b['ymax'] for b in known)] if known else [],
+            'covering': {'bbox': {'xmin': ['bbox', 'xmin'], 'ymin': ['bbox', 'ymin'],
+                                  'xmax': ['bbox', 'xmax'], 'ymax': ['bbox', 'ymax']}},
+        }}}
+        table = table.replace_schema_metadata({b'geo': json.dumps(geo).encode('utf-8')})
+        buffer = io.BytesIO()
+        pq.write_table(table, buffer, compression='zstd')
+        buffer.seek(0)
+        try:
+            # upload_fileobj switches to a multipart upload above the part size
+            get_s3_client().upload_fileobj(buffer, self.bucket, shard['key'],
+                                           ExtraArgs={'ContentType': 'application/vnd.apache.parquet'},
+                                           Config=TransferConfig(multipart_threshold=shard_part_size, multipart_chunksize=shard_part_size))
+        except (BotoCoreError, ClientError) as e:
+            logging.error(f"Could not write shard {shard['key']}: {e}")
+            return False
+        return True
+
+    def _fail_shard(self, shard):
+        if shard['upload_id'] is not None:
+            try:
+                get_s3_client().abort_multipart_upload(Bucket=self.bucket, Key=shard['key'], UploadId=shard['upload_id'])
+            except (BotoCoreError, ClientError) as e:
+                logging.error(e)
+        if shard['staged']:
+            delete_filelist_s3(deleted_filelist=shard['staged'], bucket=self.bucket)
+        if self._shard is shard:
+            self._shard = None
+        self.failed.extend(shard['keys'])
+        logging.error(f"Giving up on shard {shard['key']}, {len(shard['keys'])} records are not written")
+
+    def _save_index(self):
+        try:
+            get_s3_client().put_object(Bucket=self.bucket, Key=self.index_key, Body=serialize_json(self.index))
+        except (BotoCoreError, ClientError) as e:
+            logging.error(f'Could not write the shard index {self.index_key}: {e}')
+            return False
+        if not self._index_logged and self.on_success:
+            self.on_success(self.index_key)
+            self._index_logged = True
+        return True
+
+
+def polygon_to_wkb(geometry):
+    """Return the little endian WKB and the bbox {'xmin', 'ymin', 'xmax', 'ymax'} of a GeoJSON polygon
+    Other geometry types return (None, None).
+    """
+    if not geometry or geometry.get('type') != 'Polygon' or not geometry.get('coordinates'):
+        return None, None
+    rings = geometry['coordinates']
+    parts = [struct.pack('<BII', 1, 3, len(rings))]
+    for ring in rings:
+        parts.append(struct.pack('<I', len(ring)))
+        parts.append(struct.pack(f'<{2 * len(ring)}d', *(float(c) for point in ring for c in point[:2])))
+    xs = [point[0] for point in rings[0]]
+    ys = [point[1] for point in rings[0]]
+    return b''.join(parts), {'xmin': min(xs), 'ymin': min(ys), 'xmax': max(xs), 'ymax': max(ys)}
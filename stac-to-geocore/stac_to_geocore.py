@@ -1,7 +1,10 @@
 import json 
+import marshal
 from datetime import datetime
 import re 
-import requests
+from functools import lru_cache
+from types import MappingProxyType
+
 
 # Hardcoded variables for the STAC to GeoCore translation 
 status = 'unknown'
@@ -166,16 +169,45 @@ def update_geocore_dict(geocore_features_dict, properties_dict, geometry_dict):
         "features": [updated_dict]
     }
 
+def dedup_options(options_list):
+    """Delete the duplicated GeoCore options in linear time.
+    Options are compared on a hashable key built from their url, protocol, name and description, the last
+    occurrence of each option is kept, in the original order, like the previous pairwise comparison did.
+
+    Parameters:
+    - options_list: List of GeoCore options dictionaries.
+
+    Returns:
+    - A new list without the duplicated options.
+    """
+    seen = set()
+    unique_options = []
+    for option in reversed(options_list):
+        key = option_key(option)
+        if key not in seen:
+            seen.add(key)
+            unique_options.append(option)
+    unique_options.reverse()
+    return unique_options
+
+def option_key(option):
+    """Return the hashable key of a GeoCore option used by dedup_options()"""
+    name = option.get('name') or {}
+    description = option.get('description') or {}
+    return (option.get('url'), option.get('protocol'), name.get('en'), name.get('fr'), description.get('en'), description.get('fr'))
+
 #stac_to_feature_geometry
-def to_features_geometry(geocore_features_dict, bbox, geometry_type='Polygon'):
+def to_features_geometry(geocore_features_dict, bbox, geometry_type='Polygon', coordinates=None):
     """Mapping to GeoCore features geometry field.
     
     :param bbox: list of bounding box [west, south, east, north]
     :param geometry_type: string of item or collection type, default is 'Polygon'
+    :param coordinates: polygon coordinates precomputed for the page by geometry_batch.page_geometries(), if any
     """
     geometry_dict = geocore_features_dict['geometry']
-    west, south, east, north = [round(coord, 2) for coord in bbox]
-    coordinates=[[[west, south], [east, south], [east, north], [west, north], [west, south]]]
+    if coordinates is None: 
+        west, south, east, north = [round(coord, 2) for coord in bbox]
+        coordinates=[[[west, south], [east, south], [east, north], [west, north], [west, south]]]
     # Update the geometry dictionary
     updates = {
         "type": geometry_type,
@@ -185,6 +217,93 @@ def to_features_geometry(geocore_features_dict, bbox, geometry_type='Polygon'):
     
     return geometry_dict
 
+# Precompiled lookup tables for the options builders 
+# For each builder, STAC link rel -> (English name template, French name template) and rel -> (English, French) description.
+# The name templates are formatted with the fields of the record: {id}, {coll_id}, and {name} (the link title, 'Unknown' if missing).
+# Rels that are not in a names table use the link title, rels that are not in a descriptions table use the "Other" description.
+def _rel_description(rel_key):
+    """(English, French) option description of a links_rel entry: type;format;languages"""
+    type, format = links_rel.get(rel_key, {}).get('type'), links_rel.get(rel_key, {}).get('format')
+    return (f'{type};{format};eng', f'{type};{format};fra')
+
+other_description = ('Other;Autre;eng', 'Other;Autre;fra')
+
+@lru_cache(maxsize=None)
+def compile_options_tables(root_name):
+    """Compile the link names and descriptions tables of the root, collection and item options builders.
+    The tables only depend on the root name, so they are compiled once per run (and cached per root name).
+
+    Parameters:
+    - root_name: English and French root names separated by '/'.
+
+    Returns:
+    - A dictionary {'root', 'root_self', 'collection', 'item'} of (names, descriptions) tables.
+    """
+    # The root names are constants of the templates, escape them for str.format 
+    root_name_en, root_name_fr = [n.replace('{', '{{').replace('}', '}}') for n in root_name.split('/')]
+    root_names = ('Root - ' + root_name_en, 'Racine - ' + root_name_fr)
+    self_names = ('Self - {id}', 'Soi - {id}')
+    root_names_table = {
+        'self': self_names,
+        'root': root_names,
+        'child': ('Collection - {name}', 'Collection - {name}'),
+        'data': ('Collections Listing', 'Collection Listing'),
+    }
+    root_descriptions = {rel: _rel_description(rel_key) for rel, rel_key in (
+        ('self', 'root'), ('root', 'root'), ('parent', 'root'), ('child', 'collection'), ('data', 'data'),
+        ('service-desc', 'service-desc'), ('service-doc', 'service-doc'), ('conformance', 'conformance'), ('search', 'search'))}
+    coll_names_table = {
+        'self': self_names,
+        'root': root_names,
+        'parent': root_names,
+        'child': ('Item - {name}', 'Item - {name}'),
+        'item': ('Item - {name}', 'Item - {name}'),
+        'items': ('Items Listing', 'Items Listing'),
+    }
+    coll_descriptions = {rel: _rel_description(rel_key) for rel, rel_key in (
+        ('self', 'collection'), ('root', 'root'), ('parent', 'root'), ('child', 'item'), ('items', 'item'),
+        ('license', 'license'), ('derived_ from', 'derived_ from'))}
+    item_names_table = {
+        'self': self_names,
+        'root': root_names,
+        'parent': ('Collection - {coll_id}', 'Collection - {coll_id}'),
+    }
+    item_descriptions = {rel: _rel_description(rel_key) for rel, rel_key in (
+        ('self', 'item'), ('root', 'root'), ('parent', 'collection'), ('collection', 'collection'), ('derived_ from', 'derived_ from'))}
+    return {
+        'root': (root_names_table, root_descriptions),
+        # The root catalog links to itself with rel 'self' 
+        'root_self': (dict(root_names_table, self=root_names), root_descriptions),
+        'collection': (coll_names_table, coll_descriptions),
+        'item': (item_names_table, item_descriptions),
+    }
+
+def _links_to_options(links_list, tables, fields, skip_rel=None):
+    """Map STAC links to GeoCore options with a (names, descriptions) table of compile_options_tables()"""
+    names_table, descriptions = tables
+    return_list = []
+    for var in links_list: 
+        href, rel, name = var.get('href'), var.get('rel'), var.get('title')
+        if skip_rel is not None and rel == skip_rel: 
+            continue
+        names = names_table.get(rel)
+        if names: 
+            fields['name'] = name if name is not None else 'Unknown'
+            name_en, name_fr = names[0].format_map(fields), names[1].format_map(fields)
+        else: 
+            # If rel is not a key in the names table, both names are either the value of name (if name is not None) 
+            # or the strings 'Unknown' and 'Inconnue' for English and French, respectively.   
+            name_en, name_fr = (name, name) if name else ('Unknown', 'Inconnue')
+        description_en, description_fr = descriptions.get(rel, other_description)
+        if name_en and name_fr:
+            return_list.append({
+                "url": href,
+                "protocol": 'Unknown',
+                "name": {"en": name_en, "fr": name_fr},
+                "description": {"en": description_en, "fr": description_fr}
+            })
+    return return_list
+
 # A function to map STAC Root links to GeoCore option 
 def root_links_to_properties_options(links_list, id, root_name, title_en, title_fr, stac_type): 
     """Mapping STAC Links object to GeoCore features properties options  
@@ -203,132 +322,50 @@ def root_links_to_properties_options(links_list, id, root_name, title_en, title_
             }
 	    }]
 	 """
-    return_list = []
-    root_name_en,root_name_fr = root_name.split('/')
-    
-    for var in links_list: 
-        href, rel, name = var.get('href'), var.get('rel'), var.get('title')
-        name_en, name_fr = {
-            'self': ('Self - ' + id if stac_type != 'root' else 'Root - ' + root_name_en, 'Soi - ' + id if stac_type != 'root' else 'Racine - ' + root_name_fr),
-            'root': ('Root - ' + root_name_en, 'Racine - ' + root_name_fr),
-            'parent': ('Parent - ' + title_en if stac_type == 'item' and title_en else 'Parent links', 'Parente - ' + title_fr if stac_type == 'item' and title_fr else 'Parente liens'),
-            'child':('Collection - ' + name, 'Collection - ' + name),
-            'data': ('Collections Listing', 'Collection Listing')
-           # 'service-desc': (name, name), 
-           # 'service-doc': (name, name), 
-           # 'conformance': (name, name), 
-           # 'search': (name, name)
-        }.get(rel, (name if name else 'Unknown', name if name else 'Inconnue'))
-        # If rel is not a key in the dictionary, it defaults to a tuple where both elements are either the value of name (if name is not None) 
-        # or the strings 'Unknown' and 'Inconnue' for English and French, respectively.   
-                
-        # Convert to options type and format 
-        type, format = {
-            'self': (links_rel.get('root', {}).get('type'), links_rel.get('root', {}).get('format')),
-            'root': (links_rel.get('root', {}).get('type'), links_rel.get('root', {}).get('format')),
-            'parent': (links_rel.get('root', {}).get('type'), links_rel.get('root', {}).get('format')),
-            'child':(links_rel.get('collection', {}).get('type'), links_rel.get('collection', {}).get('format')),
-            'data': (links_rel.get('data', {}).get('type'), links_rel.get('data', {}).get('format')),
-            'service-desc': (links_rel.get('service-desc', {}).get('type'), links_rel.get('service-desc', {}).get('format')),
-            'service-doc': (links_rel.get('service-doc', {}).get('type'), links_rel.get('service-doc', {}).get('format')),
-            'conformance': (links_rel.get('conformance', {}).get('type'), links_rel.get('conformance', {}).get('format')),
-            'search': (links_rel.get('search', {}).get('type'), links_rel.get('search', {}).get('format'))
-        }.get(rel, ("Other", "Autre"))
-                
-        if name_en and name_fr:
-            option_dic = {
-                "url": href,
-                "protocol": 'Unknown',
-                "name": {"en": name_en, "fr": name_fr},
-                "description": {"en": f'{type};{format};eng', "fr": f'{type};{format};fra'}
-            }        
-            return_list.append(option_dic)
-    return (return_list)
+    names_table, descriptions = compile_options_tables(root_name)['root_self' if stac_type == 'root' else 'root']
+    # The parent names depend on the titles of the record, they are the same for every link 
+    parent_names = ('Parent - ' + title_en.replace('{', '{{').replace('}', '}}') if stac_type == 'item' and title_en else 'Parent links', 
+                    'Parente - ' + title_fr.replace('{', '{{').replace('}', '}}') if stac_type == 'item' and title_fr else 'Parente liens')
+    names_table = dict(names_table, parent=parent_names)
+    return _links_to_options(links_list, (names_table, descriptions), {'id': id})
 
 # A function to map STAC Collection links to GeoCore option 
 def coll_links_to_properties_options(links_list, id, root_name, stac_type): 
-    return_list = []
-    root_name_en,root_name_fr = root_name.split('/')
-    
-    for var in links_list: 
-        href, rel, name = var.get('href'), var.get('rel'), var.get('title')
-        name_en, name_fr = {
-            'self': ('Self - ' + id if stac_type != 'root' else 'Root - ' + root_name_en, 'Soi - ' + id if stac_type != 'root' else 'Racine - ' + root_name_fr),
-            'root': ('Root - ' + root_name_en, 'Racine - ' + root_name_fr),
-            'parent': ('Root - ' + root_name_en, 'Racine - ' + root_name_fr),
-            'child':('Item - ' + (name if name is not None else 'Unknown'), 'Item - ' + (name if name is not None else 'Unknown')),
-            'item':('Item - ' + (name if name is not None else 'Unknown'), 'Item - ' + (name if name is not None else 'Unknown')),
-            'items': ('Items Listing', 'Items Listing')
-            # 'license': (name, name), 
-            # 'derived_ from': (name, name),
-        }.get(rel, (name if name else 'Unknown', name if name else 'Inconnue'))
-        # If rel is not a key in the dictionary, it defaults to a tuple where both elements are either the value of name (if name is not None) 
-        # or the strings 'Unknown' and 'Inconnue' for English and French, respectively.   
-                
-        # Convert to options type and format 
-        type, format = {
-            'self': (links_rel.get('collection', {}).get('type'), links_rel.get('collection', {}).get('format')),
-            'root': (links_rel.get('root', {}).get('type'), links_rel.get('root', {}).get('format')),
-            'parent': (links_rel.get('root', {}).get('type'), links_rel.get('root', {}).get('format')),
-            'child':(links_rel.get('item', {}).get('type'), links_rel.get('item', {}).get('format')),
-            'items': (links_rel.get('item', {}).get('type'), links_rel.get('item', {}).get('format')),
-            'license': (links_rel.get('license', {}).get('type'), links_rel.get('license', {}).get('format')),
-            'derived_ from': (links_rel.get('derived_ from', {}).get('type'), links_rel.get('derived_ from', {}).get('format'))
-        }.get(rel, ("Other", "Autre"))
-                
-        if name_en and name_fr:
-            option_dic = {
-                "url": href,
-                "protocol": 'Unknown',
-                "name": {"en": name_en, "fr": name_fr},
-                "description": {"en": f'{type};{format};eng', "fr": f'{type};{format};fra'}
-            }        
-            return_list.append(option_dic)
-    return (return_list)
+    tables = compile_options_tables(root_name)
+    names_table, descriptions = tables['collection']
+    if stac_type == 'root': 
+        names_table = dict(names_table, self=tables['root_self'][0]['self'])
+    return _links_to_options(links_list, (names_table, descriptions), {'id': id})
     
 # A function to map STAC Item links to GeoCore option 
 def item_links_to_properties_options(links_list, id, root_name, coll_id, stac_type): 
-    return_list = []
-    root_name_en,root_name_fr = root_name.split('/')
-    
-    for var in links_list: 
-        href, rel, name = var.get('href'), var.get('rel'), var.get('title')
-        
-        # Skip the iteration if rel is 'collection', because it points to a relative url "../collection.json"
-        if rel == 'collection':
-            continue
-        
-        name_en, name_fr = {
-            'self': ('Self - ' + id if stac_type != 'root' else 'Root - ' + root_name_en, 'Soi - ' + id if stac_type != 'root' else 'Racine - ' + root_name_fr),
-            'root': ('Root - ' + root_name_en, 'Racine - ' + root_name_fr),
-            'parent': ('Collection - ' + coll_id, 'Collection - ' + coll_id),
-            'collection':('Collection - ' + coll_id, 'Collection - ' + coll_id),
-            # 'derived_ from': (name, name),
-        }.get(rel, (name if name else 'Unknown', name if name else 'Inconnue'))
-        # If rel is not a key in the dictionary, it defaults to a tuple where both elements are either the value of name (if name is not None) 
-        # or the strings 'Unknown' and 'Inconnue' for English and French, respectively.   
-                
-        # Convert to options type and format 
-        type, format = {
-            'self': (links_rel.get('item', {}).get('type'), links_rel.get('item', {}).get('format')),
-            'root': (links_rel.get('root', {}).get('type'), links_rel.get('root', {}).get('format')),
-            'parent': (links_rel.get('collection', {}).get('type'), links_rel.get('collection', {}).get('format')),
-            'collection': (links_rel.get('collection', {}).get('type'), links_rel.get('collection', {}).get('format')),
-            'derived_ from': (links_rel.get('derived_ from', {}).get('type'), links_rel.get('derived_ from', {}).get('format'))
-        }.get(rel, ("Other", "Autre"))
-                
-        if name_en and name_fr:
-            option_dic = {
-                "url": href,
-                "protocol": 'Unknown',
-                "name": {"en": name_en, "fr": name_fr},
-                "description": {"en": f'{type};{format};eng', "fr": f'{type};{format};fra'}
-            }        
-            return_list.append(option_dic)
-    return (return_list)
-    
+    tables = compile_options_tables(root_name)
+    names_table, descriptions = tables['item']
+    if stac_type == 'root': 
+        names_table = dict(names_table, self=tables['root_self'][0]['self'])
+    # Skip the links with rel 'collection', because they point to a relative url "../collection.json"
+    return _links_to_options(links_list, (names_table, descriptions), {'id': id, 'coll_id': coll_id}, skip_rel='collection')
+
+# Precompiled assets tables: STAC media type -> (English, French) format, STAC roles -> (English, French) type 
+def compile_assets_tables(assets_type, assets_role):
+    """Compile the assets_type and assets_role mappings into (English, French) lookup tables.
+    The module mappings are compiled once at import, see assets_tables.
+
+    Parameters:
+    - assets_type: Mapping of STAC assets type to GeoCore format.
+    - assets_role: Mapping of STAC assets role to GeoCore type, a key can join several roles with ', '.
+
+    Returns:
+    - (formats table, types table), read-only. The types table is keyed on the tuple of roles of an asset.
+    """
+    formats = {type_str: (format, format) if format != "Other" else ("Other", "Autre") for type_str, format in assets_type.items()}
+    types = {tuple(roles.split(', ')): (type, type) if type != "Other" else ("Other", "Autre") for roles, type in assets_role.items()}
+    return MappingProxyType(formats), MappingProxyType(types)
+
+assets_tables = compile_assets_tables(assets_type, assets_role)
+
 # A function to map STAC assets to GeoCore option 
-def assets_to_properties_options(assets_list, assets_type, assets_role): 
+def assets_to_properties_options(assets_list, assets_tables=assets_tables): 
     """Mapping STAC Links object to GeoCore features properties options  
     GeoCore options is a json array 
         "options": [
@@ -345,20 +382,18 @@ def assets_to_properties_options(assets_list, assets_type, assets_role):
             }
 	    }]
     :param assets_list: STAC collection or item assets object
+    :param assets_tables: tables returned by compile_assets_tables(), default is the compiled assets_type and assets_role
     :return return list: geocore features properties option list  
     """ 
+    formats, types = assets_tables
     return_list = []
     for var_dict in assets_list.values():
-        href, type_str, name, role = var_dict.get('href'), var_dict.get('type', ''), var_dict.get('title', 'Unknown/Inconnu'), ', '.join(var_dict.get('roles'))
+        href, type_str, name, roles = var_dict.get('href'), var_dict.get('type', ''), var_dict.get('title', 'Unknown/Inconnu'), tuple(var_dict.get('roles'))
         name_en, name_fr = name.split('/') if '/' in name else (name, name)
         # Convert stac type_str to GeoCore format,return "Other" if type_str is not in assets_type
-        format = assets_type.get(type_str,"Other") 
-        format_en, format_fr = (format, format) if format != "Other" else ("Other", "Autre")
-        # Convert stac role to GeoCore type,return "Other" if role is not in assets_role
-        type =  assets_role.get(role,"Other") 
-        type_en, type_fr = (type, type) if type != "Other" else ("Other", "Autre")
-        #print(f'Type_str is: {type_str},  format: {format}')
-        #print(f'role is {role}, type: {type}')     
+        format_en, format_fr = formats.get(type_str, ("Other", "Autre"))
+        # Convert stac roles to GeoCore type,return "Other" if the joined roles are not in assets_role
+        type_en, type_fr = types.get(roles, ("Other", "Autre"))
         option_dic = {
             "url": href,
             "protocol": 'Unknown',
@@ -366,7 +401,6 @@ def assets_to_properties_options(assets_list, assets_type, assets_role):
             "description": {"en": f'{type_en};{format_en};eng', "fr": f'{type_fr};{format_fr};fra'}
         }
         return_list.append(option_dic)
-        #print(json.dumps(return_list, indent=2))
     return return_list
 
 
@@ -401,7 +435,7 @@ def root_to_features_properties(params, geocore_features_dict):
     links_list = root_links_to_properties_options(links_list=root_links, id=root_id, root_name=root_name, title_en=None, title_fr=None, stac_type='root')
     options_list = links_list
     print(f'This is option list before delete duplication: {json.dumps(options_list, indent=2)}')
-    options_list = [i for n, i in enumerate(options_list) if i not in options_list[n + 1:]] # delete duplicates
+    options_list = dedup_options(options_list) # delete duplicates
     print(f'This is option list after delete duplication: {json.dumps(options_list, indent=2)}')
     #Descrption 
     en_desc = root_des + '.' + disclaimer_en if root_des else disclaimer_en
@@ -441,7 +475,7 @@ def root_to_features_properties(params, geocore_features_dict):
     return (properties_dict)
 
 #collection_to_features_properties 
-def coll_to_features_properties(params, coll_dict,geocore_features_dict): 
+def coll_to_features_properties(params, coll_dict,geocore_features_dict, coll_fields=None): 
     # Get the parameters 
     root_name = params['root_name']
     root_id = params['root_id']
@@ -458,7 +492,12 @@ def coll_to_features_properties(params, coll_dict,geocore_features_dict):
     
     properties_dict = geocore_features_dict['properties']
     
-    coll_id, coll_bbox, time_begin, time_end, coll_links, coll_assets, title_en, title_fr, description_en, description_fr, keywords_en, keywords_fr = get_collection_fields(coll_dict)     
+    # Reuse the fields parsed once by the collection index (CollectionFields), if given
+    if coll_fields is not None:
+        coll_id, coll_bbox, time_begin, time_end, title_en, title_fr, description_en, description_fr, keywords_en, keywords_fr = coll_fields
+        coll_links, coll_assets = coll_dict.get('links'), coll_dict.get('assets')
+    else:
+        coll_id, coll_bbox, time_begin, time_end, coll_links, coll_assets, title_en, title_fr, description_en, description_fr, keywords_en, keywords_fr = get_collection_fields(coll_dict)     
     #id
     update_dict(properties_dict, {"id": source + '-' + coll_id})
     #title 
@@ -475,9 +514,9 @@ def coll_to_features_properties(params, coll_dict,geocore_features_dict):
 
     #options  
     links_list = coll_links_to_properties_options(links_list=coll_links, id=coll_id, root_name=root_name, stac_type='collection')
-    assets_list = assets_to_properties_options(assets_list=coll_assets, assets_type=assets_type, assets_role=assets_role) if coll_assets else []
+    assets_list = assets_to_properties_options(assets_list=coll_assets) if coll_assets else []
     options_list = links_list+assets_list
-    options_list = [i for n, i in enumerate(options_list) if i not in options_list[n + 1:]] # delete duplicates
+    options_list = dedup_options(options_list) # delete duplicates
 
 
     # The shared attributes between Items and Collections  
@@ -550,52 +589,65 @@ def get_collection_fields(coll_dict):
     
     return coll_id, coll_bbox, time_begin, time_end, coll_links, coll_assets, title_en, title_fr, description_en, description_fr, keywords_en, keywords_fr
 
-def create_coll_dict(api_root):
-    response_collection = requests.get(f'{api_root}/collections/')
-    collection_data_list = response_collection.json().get('collections', [])
-    
-    coll_id_dict = {
-        coll_dict['id']: {
-            "title": {'en': fields[6], 'fr': fields[7]},
-            'description': {'en': fields[8], 'fr': fields[9]},
-            'keywords': {'en': fields[10], 'fr': fields[11]},
-        }
-        for coll_dict in collection_data_list
-        for fields in [get_collection_fields(coll_dict)]
-    }
-    return coll_id_dict 
+#Item_prototype
+def build_item_prototype(params, coll_id, coll_fields):
+    """Compute the GeoCore properties shared by every item of a collection.
 
+    Parameters:
+    - params: Harvest parameters, see lambda_handler.
+    - coll_id: STAC collection id of the items.
+    - coll_fields: CollectionFields of the collection, or None if the collection is unknown.
+
+    Returns:
+    - A dictionary with the collection titles, the item id prefix, and 'properties': the invariant
+      properties in mapping order, 'options' and 'geometry' are left to each item. The properties are
+      serialized with marshal (like the template skeleton, see template_cache.py), each item loads its
+      own copy so no dictionary or list is shared between the item records.
+    """
+    source = params['source']
+    if coll_fields is not None:
+        title_en, title_fr = coll_fields.title_en, coll_fields.title_fr
+        description_en, description_fr = coll_fields.description_en, coll_fields.description_fr
+        keywords_en, keywords_fr = coll_fields.keywords_en, coll_fields.keywords_fr
+    else:
+        title_en = title_fr = description_en = description_fr = keywords_en = keywords_fr = None
+    properties = {
+        "topicCategory": params['topicCategory'],
+        "type": params['type_data'],
+        "spatialRepresentation": params['spatialRepresentation'],
+        "status": params['status'],
+        "maintenance": params['maintenance'],
+        'useLimits': {'en': params['useLimits_en'], 'fr': params['useLimits_fr']},
+        'contact': params['contact'],
+        'options': None,
+        # The shared attributes between Items and Collections
+        'description': {'en': f"{description_en or ''} {disclaimer_en}", 'fr': f"{description_fr or ''} {disclaimer_fr}"},
+        'keywords': {'en': f"SpatioTemporal Asset Catalog, stac, {keywords_en or ''}", 'fr': f"SpatioTemporal Asset Catalog, stac, {keywords_fr or ''}"},
+        "geometry": None,
+        "sourceSystemName": params['sourceSystemName'],
+    }
+    return {
+        'title_en': title_en,
+        'title_fr': title_fr,
+        'id_prefix': source + '-' + coll_id + '-',
+        'parentIdentifier': source + '-' + coll_id,
+        'properties': marshal.dumps(properties),
+    }
 
 #Item_to_features_properties
-def item_to_features_properties(params, geocore_features_dict, item_dict, coll_id_dict):
+def item_to_features_properties(params, geocore_features_dict, item_dict, collection_index, geometry_wkt=None):
     root_name = params['root_name']
-    root_id = params['root_id']
-    source = params['source']
-    status = params['status']
-    maintenance = params['maintenance'] 
-    useLimits_en = params['useLimits_en']
-    useLimits_fr = params['useLimits_fr']
-    spatialRepresentation = params['spatialRepresentation']
-    contact = params['contact']
-    type_data = params['type_data']
-    topicCategory = params['topicCategory']
-    sourceSystemName = params['sourceSystemName']
     
     properties_dict = geocore_features_dict['properties']
     # Get item level lelments 
     item_id, item_bbox, item_links, item_assets, item_properties,coll_id = get_item_fields(item_dict) 
     
-    # Get collection level keywords, title, and description 
-    coll_data = coll_id_dict.get(coll_id, {})
-    title_en = coll_data.get('title', {}).get('en')
-    title_fr = coll_data.get('title', {}).get('fr')
-    description_en = coll_data.get('description', {}).get('en')
-    description_fr = coll_data.get('description', {}).get('fr')
-    keywords_en = coll_data.get('keywords', {}).get('en')
-    keywords_fr = coll_data.get('keywords', {}).get('fr')
+    # Get collection level keywords, title, description and the other invariant properties, computed once per collection 
+    prototype = collection_index.item_prototype(coll_id, params)
+    title_en, title_fr = prototype['title_en'], prototype['title_fr']
     
     #id
-    properties_dict.update({"id": source + '-' + coll_id + '-' + item_id})
+    properties_dict.update({"id": prototype['id_prefix'] + item_id})
     #title 
     item_date= datetime.strptime(item_properties['datetime'], '%Y-%m-%dT%H:%M:%SZ')
     yr = item_date.strftime("%Y")  
@@ -620,7 +672,7 @@ def item_to_features_properties(params, geocore_features_dict, item_dict, coll_i
     """
     
     #parentIdentifier
-    update_dict(properties_dict, {"parentIdentifier":  source + '-'+ coll_id})
+    update_dict(properties_dict, {"parentIdentifier": prototype['parentIdentifier']})
     
     #TemporalExtent 
     if 'created' in item_properties.keys(): 
@@ -641,36 +693,22 @@ def item_to_features_properties(params, geocore_features_dict, item_dict, coll_i
     
     #options 
     links_list = item_links_to_properties_options(links_list=item_links, id=item_id, root_name=root_name,coll_id=coll_id, stac_type='item')
-    assets_list = assets_to_properties_options(assets_list=item_assets, assets_type=assets_type, assets_role=assets_role) if item_assets else []
+    assets_list = assets_to_properties_options(assets_list=item_assets) if item_assets else []
     options_list = links_list+assets_list
-    options_list = [i for n, i in enumerate(options_list) if i not in options_list[n + 1:]] # delete duplicates
+    options_list = dedup_options(options_list) # delete duplicates
         
-    # The shared attributes between Items and Collections  
-    description_en_str = f"{description_en or ''} {disclaimer_en}"
-    description_fr_str = f"{description_fr or ''} {disclaimer_fr}"
-    keywords_en_str = f"SpatioTemporal Asset Catalog, stac, {keywords_en or ''}"
-    keywords_fr_str = f"SpatioTemporal Asset Catalog, stac, {keywords_fr or ''}"
+    #Geometry: precomputed for the page by geometry_batch.page_geometries(), if given 
+    if geometry_wkt is not None: 
+        geometry_str = geometry_wkt
+    else: 
+        west, south, east, north = [round(coord, 2) for coord in item_bbox]
+        geometry_str = f"POLYGON(({west} {south}, {east} {south}, {east} {north}, {west} {north}, {west} {south}))"
     
-    #Geometry 
-    west, south, east, north = [round(coord, 2) for coord in item_bbox]
-    geometry_str = f"POLYGON(({west} {south}, {east} {south}, {east} {north}, {west} {north}, {west} {south}))"
-    
-    # Other properties 
-    update_dict(properties_dict, {
-        "topicCategory": topicCategory, 
-        "type": type_data, 
-        "spatialRepresentation":spatialRepresentation,
-        "status":status,
-        "maintenance":maintenance,
-        'useLimits': {'en': useLimits_en, 'fr': useLimits_fr},
-        'contact': contact,
-        'options': options_list, 
-        'description': {'en': description_en_str, 'fr': description_fr_str},
-        'keywords': {'en': keywords_en_str, 'fr': keywords_fr_str},
-        "geometry": geometry_str, 
-        "sourceSystemName": sourceSystemName, 
-          
-    })
+    # Other properties: the invariant values computed once per collection, copied for each item 
+    item_updates = marshal.loads(prototype['properties'])
+    item_updates['options'] = options_list
+    item_updates['geometry'] = geometry_str
+    update_dict(properties_dict, item_updates)
      
     #skipped: date: None for STAC collection 
     #skipped: refsys, refSys_version  
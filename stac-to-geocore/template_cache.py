@@ -0,0 +1,78 @@
+import json
+import logging
+import marshal
+import os
+import time
+from botocore.exceptions import ClientError
+
+from s3_operations import open_file_s3_with_etag, get_etag_s3
+
+# Seconds a warm Lambda container may reuse the parsed template without asking S3 again.
+# Once the TTL expires the template ETag is checked with a HEAD request and the template is only
+# downloaded again if it changed. 0 (default) reloads the template at the start of every invocation.
+template_cache_ttl = int(os.environ.get('GEOCORE_TEMPLATE_CACHE_TTL', '0'))
+
+# (bucket, template name) -> {'skeleton': bytes, 'etag': str, 'loaded_at': float}
+# Module level, so the entries survive between warm invocations of the same container.
+_template_cache = {}
+
+
+def load_geocore_template(geocore_template_bucket_name, geocore_template_name, ttl=None):
+    """Load the GeoCore null template from S3 once and keep it as a precompiled skeleton.
+    The skeleton is the 'features'[0] dictionary of the template serialized with marshal, so a
+    fresh copy for each record is a single C-level loads() instead of a S3 GetObject plus json.loads().
+
+    Parameters:
+    - geocore_template_bucket_name: S3 bucket name that stores the GeoCore template.
+    - geocore_template_name: Name of the GeoCore template file.
+    - ttl: Seconds a cached skeleton can be reused without revalidation, default is template_cache_ttl.
+
+    Returns:
+    - The template skeleton to pass to copy_geocore_template().
+
+    Raises:
+    - RuntimeError if the template cannot be read or parsed, the error is logged first.
+    """
+    ttl = template_cache_ttl if ttl is None else ttl
+    cache_key = (geocore_template_bucket_name, geocore_template_name)
+    entry = _template_cache.get(cache_key)
+    now = time.monotonic()
+    if entry and ttl > 0:
+        if now - entry['loaded_at'] < ttl:
+            return entry['skeleton']
+        # TTL expired: revalidate with the ETag before downloading the template again
+        if entry['etag'] and get_etag_s3(geocore_template_bucket_name, geocore_template_name) == entry['etag']:
+            entry['loaded_at'] = now
+            return entry['skeleton']
+    skeleton = None
+    try:
+        template, etag = open_file_s3_with_etag(geocore_template_bucket_name, geocore_template_name)
+        if not template:
+            logging.error("Template not found.")
+        else:
+            geocore_dict = json.loads(template)
+            skeleton = marshal.dumps(geocore_dict['features'][0])
+    except ClientError as e:
+        logging.error(f"An error occurred while accessing S3: {e}")
+    except json.JSONDecodeError as e:
+        logging.error(f"An error occurred while decoding JSON: {e}")
+    except Exception as e:
+        logging.error(f"An unexpected error occurred: {e}")
+    if skeleton is None:
+        # Every record is built from the template, the harvest cannot go on without it
+        raise RuntimeError(f'could not load the GeoCore template {geocore_template_name} from bucket {geocore_template_bucket_name}')
+    _template_cache[cache_key] = {'skeleton': skeleton, 'etag': etag, 'loaded_at': now}
+    return skeleton
+
+
+def copy_geocore_template(skeleton):
+    """Return a fresh GeoCore features dictionary built from a template skeleton.
+    The mapping functions update the template in place, so every record needs its own copy.
+
+    Parameters:
+    - skeleton: The value returned by load_geocore_template().
+
+    Returns:
+    - A new dictionary that shares no mutable objects with other copies.
+    """
+    return marshal.loads(skeleton)
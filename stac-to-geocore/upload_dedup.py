@@ -0,0 +1,56 @@
+import hashlib
+import os
+import threading
+import time
+
+from metrics import add_phase_time
+from s3_operations import list_etags_s3
+
+# 'true' skips the PUT of the records whose serialized bytes did not change since they were uploaded, and
+# deletes the records of the previous harvest at the end of the harvest instead of before it
+upload_dedup_enabled = os.environ.get('S3_UPLOAD_DEDUP', 'false').lower() == 'true'
+
+
+class UploadDedup:
+    """Skip the uploads of the records that are already in the bucket with the same content.
+
+    The ETags of the objects under a prefix are listed once (ListObjectsV2, 1000 keys per request). The ETag
+    of an object written with a single PUT (and SSE-S3 or no encryption) is the MD5 of its bytes, so a record
+    whose serialized body has the same MD5 is not written again and does not trigger the S3 events of the
+    downstream stages. Any other ETag (multipart or SSE-KMS object) never matches and the record is written.
+    unchanged() is called by the upload threads.
+
+    Example
+    -------
+    dedup = UploadDedup(bucket, prefix='ccmeo-')
+    with UploadPipeline(bucket, dedup=dedup) as pipeline:
+        ...
+    print(dedup.skipped)
+    """
+
+    def __init__(self, bucket, prefix=''):
+        self.bucket = bucket
+        self.prefix = prefix
+        start = time.perf_counter()
+        self.etags = list_etags_s3(bucket, prefix)
+        add_phase_time('dedup_listing', time.perf_counter() - start)
+        self.skipped = 0
+        self._lock = threading.Lock()
+        print(f'Upload dedup: {len(self.etags)} existing objects under {bucket}/{prefix}')
+
+    def unchanged(self, key, body):
+        """Return True if the object key already holds body, its PUT can be skipped
+        :param key: S3 key of the record
+        :param body: serialized record bytes
+        """
+        etag = self.etags.get(key)
+        if etag is None or etag != hashlib.md5(body).hexdigest():
+            return False
+        with self._lock:
+            self.skipped += 1
+        return True
+
+
+def open_upload_dedup(bucket, prefix=''):
+    """Return the UploadDedup of a harvest, or None when S3_UPLOAD_DEDUP is off"""
+    return UploadDedup(bucket, prefix) if upload_dedup_enabled else None
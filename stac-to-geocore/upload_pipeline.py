@@ -0,0 +1,113 @@
+import logging
+import os
+import threading
+import time
+from concurrent.futures import ThreadPoolExecutor
+
+from s3_operations import upload_file_s3
+
+# Number of upload threads sharing the S3 client, see s3_operations.s3_max_pool_connections
+upload_workers = int(os.environ.get('S3_UPLOAD_WORKERS', '16'))
+# Records that may wait for an upload thread before submit() blocks the translation loop
+upload_max_pending = int(os.environ.get('S3_UPLOAD_MAX_PENDING', str(upload_workers * 4)))
+# Attempts per object on top of the botocore retries, with exponential backoff between them
+upload_max_attempts = int(os.environ.get('S3_UPLOAD_MAX_ATTEMPTS', '3'))
+
+
+class UploadPipeline:
+    """Bounded, concurrent upload stage for translated GeoCore records.
+
+    The translation loop calls submit() for each record and continues with the next one while a pool of
+    threads uploads the previous records. At most max_pending records are queued, when the queue is full
+    submit() blocks until an upload finishes (backpressure), so memory stays bounded when S3 is slower
+    than the translation. on_success(filename) is called once per object that was uploaded. With an
+    UploadDedup, the records already in the bucket with the same content are not written again, they count
+    as uploaded.
+
+    Example
+    -------
+    with UploadPipeline(bucket, on_success=log_key) as pipeline:
+        for item in items:
+            pipeline.submit(item_name, item_geocore)
+    print(pipeline.uploaded, pipeline.failed)
+    """
+
+    def __init__(self, bucket, on_success=None, max_workers=None, max_pending=None, max_attempts=None, dedup=None):
+        self.bucket = bucket
+        self.on_success = on_success
+        self.dedup = dedup
+        self.max_attempts = max_attempts or upload_max_attempts
+        self.uploaded = 0
+        self.failed = []
+        self._executor = ThreadPoolExecutor(max_workers=max_workers or upload_workers)
+        self._slots = threading.BoundedSemaphore(max_pending or upload_max_pending)
+        self._lock = threading.Lock()
+        self._idle = threading.Condition(self._lock)
+        self._outstanding = 0
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, exc_type, exc_value, traceback):
+        self.close()
+
+    def submit(self, filename, json_data):
+        """Queue a record for upload, blocks while max_pending records are already waiting
+        :param filename: S3 key of the record
+        :param json_data: GeoCore dictionary, it must not be modified after it is submitted
+        """
+        self._slots.acquire()
+        with self._lock:
+            self._outstanding += 1
+        try:
+            future = self._executor.submit(self._upload, filename, json_data)
+        except Exception:
+            with self._lock:
+                self._outstanding -= 1
+            self._slots.release()
+            raise
+        future.add_done_callback(lambda f: self._done(f, filename))
+        return future
+
+    def drain(self):
+        """Wait until every record submitted so far is uploaded or failed, the pipeline stays open"""
+        with self._idle:
+            while self._outstanding:
+                self._idle.wait()
+
+    def close(self):
+        """Wait for the queued uploads to finish"""
+        self._executor.shutdown(wait=True)
+
+    def _upload(self, filename, json_data):
+        for attempt in range(1, self.max_attempts + 1):
+            try:
+                if upload_file_s3(filename, bucket=self.bucket, json_data=json_data, object_name=None, dedup=self.dedup):
+                    return True
+            except Exception as e:
+                # upload_file_s3 handles ClientError, connection errors are raised by botocore
+                logging.error(f"Upload of {filename} failed on attempt {attempt}: {e}")
+            if attempt < self.max_attempts:
+                time.sleep(0.5 * 2 ** (attempt - 1))
+        return False
+
+    def _done(self, future, filename):
+        self._slots.release()
+        success = future.exception() is None and future.result()
+        with self._lock:
+            try:
+                if success:
+                    self.uploaded += 1
+                    if self.on_success:
+                        self.on_success(filename)
+                else:
+                    self.failed.append(filename)
+                    logging.error(f"Giving up on uploading {filename} to bucket {self.bucket}")
+            except Exception as e:
+                # The callback runs in an upload thread, an error would only reach the discarded future
+                logging.error(f"on_success failed for {filename}: {e}")
+            finally:
+                # drain() waits for this count, it must go down whatever on_success does
+                self._outstanding -= 1
+                if not self._outstanding:
+                    self._idle.notify_all()
@@ -0,0 +1,136 @@
+"""Fixtures of the tests: S3 mocked by moto, the synthetic STAC API of the benchmarks and a harvest runner.
+
+The modules of stac-to-geocore read their settings from the environment at import, so the required
+variables are set here before app is imported, and the tests change the module settings with monkeypatch.
+"""
+import json
+import os
+import sys
+import threading
+import time
+from http.server import ThreadingHTTPServer
+
+import boto3
+import pytest
+from moto import mock_aws
+
+TESTS_DIR = os.path.dirname(os.path.abspath(__file__))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'benchmarks'))
+sys.path.insert(0, os.path.join(TESTS_DIR, '..', 'stac-to-geocore'))
+
+TEMPLATE_BUCKET = 'test-geocore-template'
+GEOCORE_BUCKET = 'test-geocore-json-to-geojson'
+TEMPLATE_NAME = 'geocore-format-null-template.json'
+
+os.environ.update({
+    'GEOCORE_TEMPLATE_BUCKET_NAME': TEMPLATE_BUCKET, 'GEOCORE_TEMPLATE_NAME': TEMPLATE_NAME,
+    'GEOCORE_TO_PARQUET_BUCKET_NAME': GEOCORE_BUCKET, 'STAC_API_ROOT': 'http://127.0.0.1:0',
+    'ROOT_NAME': 'Synthetic datacube / Cube de données synthétique', 'SOURCE': 'test',
+    'SOURCESYSTEMNAME': 'test-datacube', 'HARVEST_SELF_INVOKE': 'false', 'HARVEST_METRICS': 'off',
+    'AWS_DEFAULT_REGION': 'us-east-1', 'AWS_ACCESS_KEY_ID': 'testing', 'AWS_SECRET_ACCESS_KEY': 'testing',
+})
+
+import stac_server  # noqa: E402
+from bench_harvest import NULL_TEMPLATE  # noqa: E402
+
+
+class LambdaContext:
+    """Lambda context whose remaining time drops below the checkpoint margin every hand_over_every checks"""
+
+    function_name = 'stac-to-geocore-test'
+    aws_request_id = 'test-run'
+
+    def __init__(self, hand_over_every=0):
+        self.hand_over_every = hand_over_every
+        self.checks = 0
+
+    def get_remaining_time_in_millis(self):
+        self.checks += 1
+        if self.hand_over_every and self.checks % self.hand_over_every == 0:
+            return 1000
+        return 900000
+
+
+@pytest.fixture
+def s3():
+    """S3 client of a moto account holding the template bucket, the null template and the GeoCore bucket"""
+    import s3_operations
+    with mock_aws():
+        s3_operations._s3_client = None
+        client = boto3.client('s3')
+        client.create_bucket(Bucket=TEMPLATE_BUCKET)
+        client.create_bucket(Bucket=GEOCORE_BUCKET)
+        client.put_object(Bucket=TEMPLATE_BUCKET, Key=TEMPLATE_NAME, Body=json.dumps(NULL_TEMPLATE).encode('utf-8'))
+        yield client
+        s3_operations._s3_client = None
+
+
+@pytest.fixture
+def stac_api():
+    """Synthetic STAC API of 2 collections x 12 items, served on a free port
+    The catalog and the request counters belong to the test, set server.handler.catalog to change the catalog.
+    """
+    handler = type('StacRequestHandler', (stac_server.StacRequestHandler,), {
+        'catalog': stac_server.SyntheticCatalog(collections=2, items=12, page_size=5), 'stats': {}})
+    server = ThreadingHTTPServer(('127.0.0.1', 0), handler)
+    server.daemon_threads = True
+    server.handler = handler
+    server.url = f'http://127.0.0.1:{server.server_port}'
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield server
+    server.shutdown()
+    server.server_close()
+
+
+@pytest.fixture
+def harvest(s3, stac_api, monkeypatch):
+    """Return run(context=None), which runs lambda_handler and the invocations resuming it until the harvest is done
+    run() returns the number of invocations.
+    """
+    import app
+    monkeypatch.setattr(app, 'api_root', stac_api.url)
+    # lambda_handler moves to /tmp, the working directory of the tests is restored afterwards
+    monkeypatch.chdir(TESTS_DIR)
+
+    def run(context=None):
+        app.lambda_handler({}, context)
+        invocations = 1
+        while checkpoint_exists(s3):
+            assert invocations < 100, 'the harvest does not finish'
+            app.lambda_handler({'resume': True}, context)
+            invocations += 1
+        return invocations
+    return run
+
+
+def checkpoint_exists(s3):
+    import checkpoint
+    response = s3.list_objects_v2(Bucket=TEMPLATE_BUCKET, Prefix=checkpoint.checkpoint_name)
+    return response.get('KeyCount', 0) > 0
+
+
+def bucket_objects(s3, bucket=GEOCORE_BUCKET):
+    """Return {key: body bytes} of the objects of a bucket"""
+    objects = {}
+    for page in s3.get_paginator('list_objects_v2').paginate(Bucket=bucket):
+        for entry in page.get('Contents', []):
+            objects[entry['Key']] = s3.get_object(Bucket=bucket, Key=entry['Key'])['Body'].read()
+    return objects
+
+
+def manifest_keys(bucket=TEMPLATE_BUCKET):
+    """Return the keys of lastRun.txt, in the order of the manifest"""
+    from run_manifest import iter_manifest_keys
+    return list(iter_manifest_keys(bucket))
+
+
+def requests_count(stac_api, endpoint, expected):
+    """Return the requests of an endpoint counted by the server, waiting a moment for the expected count
+    The server counts a request after sending its response, the client may read the response first.
+    """
+    deadline = time.monotonic() + 2
+    while True:
+        count = stac_api.handler.stats.get(endpoint, {}).get('requests', 0)
+        if count == expected or time.monotonic() > deadline:
+            return count
+        time.sleep(0.01)
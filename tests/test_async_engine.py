@@ -0,0 +1,42 @@
+"""The async engine writes the records of the sync engine, and does not run when the harvest may hand over"""
+import threading
+
+import pytest
+
+from conftest import LambdaContext, bucket_objects, manifest_keys
+
+
+def test_async_harvest_matches_sync(harvest, s3, monkeypatch):
+    import app
+    harvest()
+    records = bucket_objects(s3)
+    keys = manifest_keys()
+
+    translate_item = app.translate_item
+    threads = set()
+
+    def translate_item_thread(*args):
+        threads.add(threading.current_thread().name)
+        return translate_item(*args)
+    monkeypatch.setattr(app, 'translate_item', translate_item_thread)
+    monkeypatch.setattr(app, 'harvest_engine', 'async')
+    harvest()
+    assert bucket_objects(s3) == records
+    assert sorted(manifest_keys()) == sorted(keys)
+    # The translations run in the worker thread, not on the event loop
+    assert len(threads) == 1 and threads.pop().startswith('translate')
+
+
+def test_async_engine_requires_no_self_invoke(harvest, s3, monkeypatch, caplog):
+    import app
+    harvest()
+    records = bucket_objects(s3)
+
+    def run_async_harvest(*args, **kwargs):
+        pytest.fail('the async engine ran with HARVEST_SELF_INVOKE=true')
+    monkeypatch.setattr(app, 'run_async_harvest', run_async_harvest)
+    monkeypatch.setattr(app, 'harvest_engine', 'async')
+    monkeypatch.setattr(app, 'self_invoke', True)
+    assert harvest(LambdaContext()) == 1
+    assert bucket_objects(s3) == records
+    assert 'HARVEST_SELF_INVOKE=false' in caplog.text
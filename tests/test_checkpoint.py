@@ -0,0 +1,124 @@
+"""A harvest that hands over to the next invocation writes the same records and lastRun.txt as one invocation"""
+import json
+import time
+
+import pytest
+
+from conftest import GEOCORE_BUCKET, TEMPLATE_BUCKET, LambdaContext, bucket_objects, checkpoint_exists, manifest_keys
+
+
+def test_resume_after_checkpoint(harvest, s3):
+    assert harvest() == 1
+    records = bucket_objects(s3)
+    keys = manifest_keys()
+    assert len(records) == 1 + 2 + 2 * 12
+    assert sorted(keys) == sorted(records)
+
+    # The next full harvest deletes the records of lastRun.txt, then hands over after every few records
+    invocations = harvest(LambdaContext(hand_over_every=4))
+    assert invocations > 5
+    assert bucket_objects(s3) == records
+    resumed_keys = manifest_keys()
+    assert len(resumed_keys) == len(set(resumed_keys))
+    assert sorted(resumed_keys) == sorted(keys)
+
+
+def test_resume_continues_the_open_shard(harvest, s3, monkeypatch):
+    import app
+    import shard_output
+    monkeypatch.setattr(app, 'geocore_output_mode', 'ndjson')
+    monkeypatch.setattr(shard_output, 'geocore_output_mode', 'ndjson')
+    monkeypatch.setattr(shard_output, 'shard_max_records', 10)
+
+    assert harvest(LambdaContext(hand_over_every=3)) > 5
+    objects = bucket_objects(s3, GEOCORE_BUCKET)
+    shards = sorted(key for key in objects if key.endswith('.ndjson'))
+    # The shards are only closed at their record limit, not at the checkpoints
+    assert [len(objects[key].splitlines()) for key in shards] == [10, 10, 7]
+    index = json.loads(next(body for key, body in objects.items() if key.endswith('-index.json')))
+    assert index['shards'] == shards
+    assert len(index['records']) == 27
+    for record_id, (shard, offset, length) in index['records'].items():
+        feature = json.loads(objects[shard][offset:offset + length])
+        assert feature['properties']['id'] == record_id
+
+
+def test_resume_without_staged_rows_fails_the_shard(s3):
+    pytest.importorskip('pyarrow')
+    from shard_output import ShardWriter
+    feature = {'type': 'Feature', 'geometry': None, 'properties': {'id': 'record-0'}}
+    writer = ShardWriter(GEOCORE_BUCKET, 'run', mode='geoparquet')
+    writer.submit('record-0.geojson', {'features': [feature]})
+    writer.drain()
+    state = json.loads(json.dumps(writer.state()))
+    writer.suspend()
+    assert len(state['staged']) == 1
+
+    # The staged rows were deleted (e.g. by a lifecycle rule) before the next invocation
+    s3.delete_object(Bucket=GEOCORE_BUCKET, Key=state['staged'][0])
+    resumed = ShardWriter(GEOCORE_BUCKET, 'run', mode='geoparquet', resume=True, state=state)
+    assert resumed.failed == ['record-0.geojson']
+    resumed.close()
+    assert not any(key.endswith('.parquet') for key in bucket_objects(s3))
+
+
+def put_checkpoint(s3, **cursor):
+    import checkpoint
+    s3.put_object(Bucket=TEMPLATE_BUCKET, Key=checkpoint.checkpoint_name, Body=json.dumps(dict(checkpoint.new_cursor(), **cursor)).encode('utf-8'))
+
+
+def get_checkpoint(s3):
+    import checkpoint
+    return json.loads(s3.get_object(Bucket=TEMPLATE_BUCKET, Key=checkpoint.checkpoint_name)['Body'].read())
+
+
+def test_running_lease_blocks_other_invocations(harvest, s3):
+    import app
+    put_checkpoint(s3, lease={'owner': 'other', 'expires': time.time() + 600})
+    app.lambda_handler({}, LambdaContext())
+    assert bucket_objects(s3) == {}
+    assert get_checkpoint(s3)['lease']['owner'] == 'other'
+
+
+def test_continuation_takes_the_handed_over_lease(harvest, s3, monkeypatch):
+    import app
+    import checkpoint
+    events = []
+    monkeypatch.setattr(checkpoint, 'self_invoke', True)
+    monkeypatch.setattr(app, 'self_invoke', True)
+    monkeypatch.setattr(app, 'invoke_continuation', lambda context, event: events.append(event) or True)
+    context = LambdaContext(hand_over_every=4)
+    app.lambda_handler({}, context)
+    assert events and get_checkpoint(s3)['lease']['owner'] == events[-1]['lease']
+    # A scheduled run does not start while the continuation may be starting
+    app.lambda_handler({}, context)
+    assert len(events) == 1
+    while checkpoint_exists(s3):
+        assert len(events) < 100, 'the harvest does not finish'
+        app.lambda_handler(events[-1], context)
+    assert len(bucket_objects(s3)) == 27
+
+
+def test_checkpoint_writes_are_conditional(s3):
+    from checkpoint import CheckpointLease, load_checkpoint, new_cursor, save_checkpoint
+    first = CheckpointLease(TEMPLATE_BUCKET, LambdaContext())
+    assert first.claim(new_cursor())
+    # A second new harvest cannot claim the checkpoint
+    assert not CheckpointLease(TEMPLATE_BUCKET, LambdaContext()).claim(new_cursor())
+    cursor, etag = load_checkpoint(TEMPLATE_BUCKET)
+    assert first.save(dict(cursor, coll_index=1))
+    # A write based on the checkpoint read before the save is refused
+    assert save_checkpoint(TEMPLATE_BUCKET, cursor, etag=etag) is False
+    assert load_checkpoint(TEMPLATE_BUCKET)[0]['coll_index'] == 1
+
+
+def test_failing_checkpoint_is_given_up(harvest, s3, caplog):
+    put_checkpoint(s3, phase='collections', attempts=3, lease={'owner': 'crashed', 'expires': time.time() - 1},
+                   manifest={'gzip': False, 'count': 0, 'upload_id': None, 'parts': [], 'pending': ''})
+    assert harvest() == 1
+    assert 'Giving up' in caplog.text
+    assert not checkpoint_exists(s3)
+    assert bucket_objects(s3) == {}
+    # The next run starts a new harvest
+    harvest()
+    assert len(bucket_objects(s3)) == 27
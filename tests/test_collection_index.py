@@ -0,0 +1,23 @@
+"""The collection index fetches every page of /collections once and shares the parsed collection fields"""
+import stac_server
+
+from conftest import requests_count
+
+
+def test_index_follows_the_next_links(stac_api):
+    from collection_index import CollectionIndex
+    stac_api.handler.catalog = stac_server.SyntheticCatalog(collections=5, items=1, collections_page_size=2)
+    index = CollectionIndex.from_api(stac_api.url)
+    assert [coll['id'] for coll in index.collections] == [f'collection-{c}' for c in range(5)]
+    assert len(index) == 5 and 'collection-4' in index
+    assert requests_count(stac_api, 'GET /collections', 3) == 3
+
+
+def test_fields_survive_the_round_trip_of_the_workers(stac_api):
+    from collection_index import CollectionIndex
+    index = CollectionIndex.from_api(stac_api.url)
+    rebuilt = CollectionIndex.from_fields(index.to_fields_dict())
+    assert rebuilt.ids() == index.ids()
+    for coll_id in index.ids():
+        assert rebuilt.get(coll_id) == index.get(coll_id)
+    assert rebuilt.collections == []
@@ -0,0 +1,103 @@
+"""Every item is owned by exactly one datetime window, so a fan-out harvest maps each item once"""
+import json
+import re
+from concurrent.futures import ThreadPoolExecutor
+
+import pytest
+import stac_server
+
+from conftest import TEMPLATE_BUCKET, bucket_objects, manifest_keys
+
+COLLECTION = {'id': 'collection-0', 'extent': {'temporal': {'interval': [['2020-01-01T00:00:00Z', '2020-01-10T00:00:00Z']]}}}
+
+
+def item(**properties):
+    return {'id': 'item', 'collection': 'collection-0', 'properties': properties}
+
+
+def owners(shards, stac_item):
+    from fan_out import shard_owns_item
+    return [shard['shard_id'] for shard in shards if shard_owns_item(shard, stac_item)]
+
+
+def test_windows_own_each_item_once():
+    from fan_out import plan_shards
+    shards = plan_shards([COLLECTION], window_days=3)
+    # Open ended first and last windows
+    assert [shard['datetime'] for shard in shards] == [
+        '../2020-01-03T23:59:59.999Z', '2020-01-04T00:00:00.000Z/2020-01-06T23:59:59.999Z', '2020-01-07T00:00:00.000Z/..']
+    assert owners(shards, item(datetime='2020-01-04T00:00:00Z')) == ['collection-0-1']
+    assert owners(shards, item(datetime='2020-01-03T23:59:59.999Z')) == ['collection-0-0']
+    assert owners(shards, item(datetime='2020-01-06T12:00:00+05:00')) == ['collection-0-1']
+    assert owners(shards, item(datetime='2019-06-01T00:00:00Z')) == ['collection-0-0']
+    assert owners(shards, item(datetime='2021-06-01T00:00:00Z')) == ['collection-0-2']
+    # A range item is returned by the searches of every window it spans, only the window of its start owns it
+    spanning = item(datetime=None, start_datetime='2020-01-02T00:00:00Z', end_datetime='2020-01-08T00:00:00Z')
+    assert owners(shards, spanning) == ['collection-0-0']
+    assert owners(shards, item(datetime=None)) == ['collection-0-0']
+    assert owners(shards, item(datetime='not a date')) == ['collection-0-0']
+
+
+def test_collection_shard_owns_every_item():
+    from fan_out import plan_shards
+    shards = plan_shards([COLLECTION], window_days=0)
+    assert shards == [{'shard_id': 'collection-0', 'collection': 'collection-0', 'datetime': None}]
+    assert owners(shards, item(datetime=None)) == ['collection-0']
+
+
+def test_fan_out_harvest_maps_each_item_once(harvest, s3, monkeypatch):
+    import app
+    import fan_out
+    harvest()
+    records = bucket_objects(s3)
+
+    monkeypatch.setattr(app, 'harvest_strategy', 'fan-out')
+    monkeypatch.setattr(fan_out, 'fan_out_window_days', 3)
+    # The process backend runs the workers in threads, so they see the S3 mock of the test
+    monkeypatch.setattr(fan_out, 'fan_out_backend', 'process')
+    monkeypatch.setattr(fan_out, 'ProcessPoolExecutor', lambda max_workers, mp_context: ThreadPoolExecutor(max_workers))
+    harvest()
+    assert bucket_objects(s3) == records
+    keys = manifest_keys()
+    assert len(keys) == len(set(keys))
+    assert sorted(keys) == sorted(records)
+
+
+@pytest.mark.parametrize('mode', ['incremental', 'dedup'])
+def test_failed_shard_keeps_its_previous_records(harvest, s3, stac_api, monkeypatch, mode):
+    import app
+    import fan_out
+    import upload_dedup
+    if mode == 'incremental':
+        monkeypatch.setattr(app, 'harvest_mode', 'incremental')
+    else:
+        monkeypatch.setattr(upload_dedup, 'upload_dedup_enabled', True)
+    harvest()
+    records = bucket_objects(s3)
+
+    # Items 9 to 11 of both collections are gone upstream, the second window of collection-1 fails
+    stac_api.handler.catalog = stac_server.SyntheticCatalog(collections=2, items=9, page_size=5)
+    harvest_shard = app.harvest_shard
+
+    def failing_shard(shard, **worker_args):
+        if shard['shard_id'] == 'collection-1-1':
+            raise RuntimeError('worker timed out')
+        return harvest_shard(shard, **worker_args)
+    monkeypatch.setattr(app, 'harvest_shard', failing_shard)
+    monkeypatch.setattr(app, 'harvest_strategy', 'fan-out')
+    monkeypatch.setattr(fan_out, 'fan_out_window_days', 3)
+    monkeypatch.setattr(fan_out, 'fan_out_backend', 'process')
+    monkeypatch.setattr(fan_out, 'ProcessPoolExecutor', lambda max_workers, mp_context: ThreadPoolExecutor(max_workers))
+    harvest()
+    after = bucket_objects(s3)
+    # Only the stale records of collection-0 are deleted, collection-1 keeps every previous record
+    gone = {key for key in records if re.search(r'collection-0-item-(9|10|11)\.geojson$', key)}
+    assert len(gone) == 3
+    assert set(after) == set(records) - gone
+    keys = manifest_keys()
+    assert len(keys) == len(set(keys))
+    assert sorted(keys) == sorted(after)
+    if mode == 'incremental':
+        import incremental
+        manifest = json.loads(s3.get_object(Bucket=TEMPLATE_BUCKET, Key=incremental.harvest_manifest_name)['Body'].read())
+        assert sorted(entry['key'] for entry in manifest.values()) == sorted(after)
@@ -0,0 +1,26 @@
+"""The numpy rounding of the page bboxes gives the same coordinates and WKT as round(coord, 2)"""
+import random
+
+import pytest
+
+
+def test_numpy_rounding_matches_round(monkeypatch):
+    pytest.importorskip('numpy')
+    import geometry_batch
+    # .5 ties of the decimal values that round() and the scaled numpy rounding can resolve differently
+    ties = [0.125, 0.135, 0.145, 1.005, 2.675, 0.285, -0.125, -75.125, -141.005, 83.115, 1e-3 + 0.005]
+    random.seed(0)
+    bboxes = [[tie, -tie, tie + 1, abs(tie) + 2] for tie in ties]
+    bboxes += [[random.randint(-18000, 18000) / 100 + random.choice([0.005, 0.0049999, 0.0050001]),
+                random.uniform(-90, 0), random.uniform(0, 180), random.randint(1, 90)] for _ in range(2000)]
+    bboxes += [[-141, 41.675, -52.625, 83], [-141.0, 41.675, -52.625, 83.0]]
+
+    numpy_geometries = geometry_batch.page_geometries(bboxes)
+    monkeypatch.setattr(geometry_batch, 'np', None)
+    python_geometries = geometry_batch.page_geometries(bboxes)
+    for bbox, numpy_geometry, python_geometry in zip(bboxes, numpy_geometries, python_geometries):
+        assert numpy_geometry.coordinates[0][2] == [round(bbox[2], 2), round(bbox[3], 2)]
+        assert numpy_geometry.coordinates[0][0] == [round(bbox[0], 2), round(bbox[1], 2)]
+        # The types are compared too, an int coordinate is written without a decimal point
+        assert [type(coord) for coord in numpy_geometry.coordinates[0][0]] == [type(coord) for coord in python_geometry.coordinates[0][0]]
+        assert numpy_geometry == python_geometry, bbox
@@ -0,0 +1,57 @@
+"""A 304 Not Modified of a cached STAC response is returned as the cached 200 response"""
+import os
+
+import pytest
+
+from conftest import requests_count
+
+
+@pytest.fixture
+def http_cache(tmp_path, monkeypatch):
+    """Open a 'tmp' HTTP cache in the test directory, return a function reopening it like a new invocation"""
+    import http_cache
+    monkeypatch.setattr(http_cache, 'http_cache_backend', 'tmp')
+    monkeypatch.setattr(http_cache, 'http_cache_dir', str(tmp_path))
+
+    def reopen():
+        http_cache.close_http_cache()
+        return http_cache.open_http_cache()
+    yield reopen
+    http_cache.close_http_cache()
+
+
+def test_304_resolves_to_cached_response(stac_api, http_cache):
+    from http_client import stac_get
+    url = f'{stac_api.url}/collections'
+    cache = http_cache()
+    first = stac_get(url)
+    second = stac_get(url)
+    assert first.status_code == second.status_code == 200
+    assert second.json() == first.json()
+    assert second.headers['Content-Type'] == 'application/json'
+    assert requests_count(stac_api, 'GET /collections', 1) == 1
+    assert requests_count(stac_api, 'GET /collections 304', 1) == 1
+    assert cache.stats['hits'] == 1 and cache.stats['stored'] == 1
+
+    # The index is saved at the end of the invocation, the next one revalidates the cached body
+    cache = http_cache()
+    assert stac_get(url).json() == first.json()
+    assert requests_count(stac_api, 'GET /collections 304', 2) == 2
+    assert cache.stats['hits'] == 1
+
+
+def test_304_without_cached_body_fetches_the_response_again(stac_api, http_cache, tmp_path):
+    from http_client import stac_get
+    url = f'{stac_api.url}/collections'
+    http_cache()
+    first = stac_get(url)
+    cache = http_cache()
+    for name in os.listdir(tmp_path):
+        if name.endswith('.body'):
+            os.remove(tmp_path / name)
+    again = stac_get(url)
+    assert again.status_code == 200
+    assert again.json() == first.json()
+    assert requests_count(stac_api, 'GET /collections 304', 1) == 1
+    assert requests_count(stac_api, 'GET /collections', 2) == 2
+    assert cache.stats['hits'] == 0
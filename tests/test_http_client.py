@@ -0,0 +1,55 @@
+"""The shared STAC session retries the 5xx responses before returning them"""
+import json
+import threading
+from http.server import BaseHTTPRequestHandler, ThreadingHTTPServer
+
+import pytest
+
+
+@pytest.fixture
+def flaky_api(monkeypatch):
+    """Server answering 503 to the first 2 requests of a path, then 200, return (url, requests per path)"""
+    import http_client
+    # A new session picks up the retry settings of the test
+    monkeypatch.setattr(http_client, '_session', None)
+    monkeypatch.setattr(http_client, 'http_backoff_factor', 0)
+    requests = {}
+
+    class Handler(BaseHTTPRequestHandler):
+        def log_message(self, format, *args):
+            pass
+
+        def do_GET(self):
+            requests[self.path] = requests.get(self.path, 0) + 1
+            status = 503 if requests[self.path] <= 2 else 200
+            body = json.dumps({'status': status}).encode('utf-8')
+            self.send_response(status)
+            self.send_header('Content-Type', 'application/json')
+            self.send_header('Content-Length', str(len(body)))
+            self.end_headers()
+            self.wfile.write(body)
+
+    server = ThreadingHTTPServer(('127.0.0.1', 0), Handler)
+    server.daemon_threads = True
+    threading.Thread(target=server.serve_forever, daemon=True).start()
+    yield f'http://127.0.0.1:{server.server_port}', requests
+    server.shutdown()
+    server.server_close()
+    http_client._session = None
+
+
+def test_5xx_responses_are_retried(flaky_api):
+    from http_client import stac_get
+    url, requests = flaky_api
+    response = stac_get(f'{url}/collections')
+    assert response.status_code == 200
+    assert requests['/collections'] == 3
+
+
+def test_last_5xx_is_returned_after_the_retries(flaky_api, monkeypatch):
+    import http_client
+    url, requests = flaky_api
+    monkeypatch.setattr(http_client, 'http_max_retries', 1)
+    response = http_client.stac_get(f'{url}/collections')
+    assert response.status_code == 503
+    assert requests['/collections'] == 2
@@ -0,0 +1,36 @@
+"""The item properties built from the collection prototype are those of the collection record, copied per item"""
+import json
+import marshal
+import re
+
+from conftest import bucket_objects
+
+SHARED = ['description', 'keywords', 'contact', 'useLimits', 'status', 'maintenance', 'sourceSystemName', 'topicCategory']
+
+
+def test_item_properties_match_their_collection(harvest, s3):
+    harvest()
+    records = {key: json.loads(body)['features'][0]['properties'] for key, body in bucket_objects(s3).items()}
+    for c in range(2):
+        collection = records[f'test-collection-{c}.geojson']
+        items = [properties for key, properties in records.items() if key.startswith(f'test-collection-{c}-')]
+        assert len(items) == 12
+        for properties in items:
+            assert {name: properties[name] for name in SHARED} == {name: collection[name] for name in SHARED}
+            assert properties['parentIdentifier'] == collection['id']
+            assert properties['id'].startswith(collection['id'] + '-')
+            # The year of the item and the title of the STAC collection
+            assert re.fullmatch(rf'\d{{4}} - Synthetic collection {c}', properties['title']['en'])
+            assert re.fullmatch(rf'\d{{4}} - Collection synthétique {c}', properties['title']['fr'])
+
+
+def test_prototype_copies_share_nothing():
+    from stac_to_geocore import build_item_prototype
+    params = {'source': 'test', 'topicCategory': 'imageryBaseMapsEarthCover', 'type_data': 'dataset', 'spatialRepresentation': 'grid',
+              'status': 'unknown', 'maintenance': 'unknown', 'useLimits_en': 'en', 'useLimits_fr': 'fr',
+              'contact': [{'organisation': {'en': 'o', 'fr': 'o'}}], 'sourceSystemName': 'test'}
+    prototype = build_item_prototype(params, 'collection-0', None)
+    first, second = marshal.loads(prototype['properties']), marshal.loads(prototype['properties'])
+    first['contact'][0]['organisation']['en'] = 'changed'
+    assert second['contact'][0]['organisation']['en'] == 'o'
+    assert prototype['parentIdentifier'] == 'test-collection-0'
@@ -0,0 +1,68 @@
+"""The search limit and fields are only sent to the APIs that conform to them, and do not change the records"""
+import pytest
+import stac_server
+
+from conftest import bucket_objects, requests_count
+
+ITEM_SEARCH = 'https://api.stacspec.org/v1.0.0/item-search'
+FIELDS = 'https://api.stacspec.org/v1.0.0/item-search#fields'
+
+
+@pytest.mark.parametrize('conforms_to, expected', [
+    ([ITEM_SEARCH, FIELDS], {'limit', 'fields'}),
+    ([ITEM_SEARCH + '/'], {'limit'}),
+    ([FIELDS], {'fields'}),
+    (['https://api.stacspec.org/v1.0.0/core'], set()),
+])
+def test_negotiate_from_landing_page(conforms_to, expected):
+    from pagination import negotiate_search_params, search_limit
+    # The landing page lists its conformance classes, /conformance is not requested
+    search_params = negotiate_search_params('http://127.0.0.1:0', {'conformsTo': conforms_to})
+    assert set(search_params) == expected
+    if 'limit' in expected:
+        assert search_params['limit'] == search_limit
+
+
+def test_negotiate_from_conformance_endpoint(stac_api):
+    from pagination import negotiate_search_params
+    stac_api.handler.catalog = stac_server.SyntheticCatalog(collections=2, items=12, page_size=5, fields=False)
+    assert set(negotiate_search_params(stac_api.url, {})) == {'limit'}
+    assert requests_count(stac_api, 'GET /conformance', 1) == 1
+
+
+def test_negotiate_without_conformance_endpoint(monkeypatch):
+    import pagination
+
+    class NotFound:
+        status_code = 404
+
+        def close(self):
+            pass
+    monkeypatch.setattr(pagination, 'stac_get', lambda url: NotFound())
+    assert pagination.negotiate_search_params('http://127.0.0.1:0', {}) == {}
+
+
+def test_add_search_params():
+    from pagination import add_search_params
+    search_params = {'limit': 100, 'fields': {'include': ['id', 'bbox'], 'exclude': ['geometry']}}
+    assert add_search_params('http://api/search?collections=a', search_params=search_params) == (
+        'http://api/search?collections=a&limit=100&fields=id,bbox,-geometry', None)
+    assert add_search_params('http://api/search', {'collections': ['a']}, search_params) == (
+        'http://api/search', dict(search_params, collections=['a']))
+    assert add_search_params('http://api/search', search_params={}) == ('http://api/search', None)
+
+
+@pytest.mark.parametrize('conformance', [[ITEM_SEARCH], [FIELDS], []])
+def test_harvest_records_do_not_depend_on_conformance(harvest, s3, stac_api, conformance):
+    harvest()
+    records = bucket_objects(s3)
+    # With the limit of 250 items, the 24 items come in a single search page
+    assert requests_count(stac_api, 'GET /search', 1) == 1
+
+    stac_api.handler.stats.clear()
+    stac_api.handler.catalog = stac_server.SyntheticCatalog(collections=2, items=12, page_size=5, conformance=conformance)
+    harvest()
+    assert bucket_objects(s3) == records
+    # Without the limit the server pages of 5 items are followed
+    pages = 1 if ITEM_SEARCH in conformance else 5
+    assert requests_count(stac_api, 'GET /search', pages) == pages
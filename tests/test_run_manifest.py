@@ -0,0 +1,57 @@
+"""A gzip lastRun.txt continued across checkpoints is a concatenation of gzip members that reads back in order"""
+import json
+import os
+import zlib
+
+from conftest import TEMPLATE_BUCKET, manifest_keys
+
+
+def gzip_members(body):
+    """Return the number of gzip members of a body"""
+    members = 0
+    while body:
+        decompressor = zlib.decompressobj(wbits=zlib.MAX_WBITS | 16)
+        decompressor.decompress(body)
+        assert decompressor.eof
+        body = decompressor.unused_data
+        members += 1
+    return members
+
+
+def write_resumed(keys, checkpoints, **options):
+    """Write the keys with a ManifestWriter saved and resumed at every index of checkpoints"""
+    from run_manifest import ManifestWriter
+    writer = ManifestWriter(TEMPLATE_BUCKET, gzip=True, **options)
+    for i, key in enumerate(keys):
+        if i in checkpoints:
+            # The state goes through the json of the checkpoint
+            writer = ManifestWriter.resume(TEMPLATE_BUCKET, json.loads(json.dumps(writer.state())), **options)
+        writer.write(key)
+    assert writer.close()
+    return writer
+
+
+def test_gzip_members_across_checkpoints(s3):
+    import run_manifest
+    keys = [f'test-collection-{i % 3}-item-{i}.geojson' for i in range(300)]
+    write_resumed(keys, checkpoints={100, 200})
+    response = s3.get_object(Bucket=TEMPLATE_BUCKET, Key=run_manifest.run_manifest_name)
+    assert response['ContentEncoding'] == 'gzip'
+    assert gzip_members(response['Body'].read()) == 3
+    assert manifest_keys() == keys
+
+
+def test_gzip_multipart_manifest(s3):
+    import run_manifest
+    # Random keys barely compress, so the manifest takes several 5 MiB parts
+    keys = [f'{os.urandom(24).hex()}.geojson' for _ in range(200000)]
+    writer = write_resumed(keys, checkpoints={50000, 150000}, part_size=5 * 1024 * 1024)
+    assert len(writer.parts) >= 2
+    response = s3.get_object(Bucket=TEMPLATE_BUCKET, Key=run_manifest.run_manifest_name)
+    assert response['ContentEncoding'] == 'gzip'
+    assert manifest_keys() == keys
+
+
+def test_empty_gzip_manifest(s3):
+    write_resumed([], checkpoints=set())
+    assert manifest_keys() == []
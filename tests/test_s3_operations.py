@@ -0,0 +1,22 @@
+"""The keys of the previous harvest are deleted with DeleteObjects batches of 1000 keys"""
+from conftest import GEOCORE_BUCKET, bucket_objects
+
+
+def test_keys_are_deleted_in_batches(s3, monkeypatch):
+    import s3_operations
+    from s3_operations import delete_filelist_s3, get_s3_client
+    monkeypatch.setattr(s3_operations, 'delete_workers', 2)
+    keys = [f'test-item-{i}.geojson' for i in range(2500)]
+    for key in keys[:10] + keys[-10:]:
+        s3.put_object(Bucket=GEOCORE_BUCKET, Key=key, Body=b'{}')
+    s3.put_object(Bucket=GEOCORE_BUCKET, Key='kept.geojson', Body=b'{}')
+    batches = []
+    get_s3_client().meta.events.register(
+        'provide-client-params.s3.DeleteObjects', lambda params, **kwargs: batches.append(len(params['Delete']['Objects'])))
+
+    # A streamed manifest is a generator, its empty lines are skipped
+    report = delete_filelist_s3((key for key in keys + ['']), GEOCORE_BUCKET)
+    assert sorted(batches) == [500, 1000, 1000]
+    # S3 reports the missing keys as deleted
+    assert report == {'deleted': 2500, 'errors': []}
+    assert list(bucket_objects(s3)) == ['kept.geojson']
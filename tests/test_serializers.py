@@ -0,0 +1,71 @@
+"""The compact records of orjson and of the json module are the same bytes, and the encoded bodies decode back"""
+import json
+
+import pytest
+
+from conftest import GEOCORE_BUCKET, bucket_objects
+
+
+def test_orjson_records_match_json(harvest, s3):
+    pytest.importorskip('orjson')
+    from serializers import serialize_json
+    harvest()
+    records = bucket_objects(s3)
+    assert records
+    for key, body in records.items():
+        record = json.loads(body)
+        assert serialize_json(record, backend='auto') == body, key
+        assert serialize_json(record, backend='json') == body, key
+
+
+def test_orjson_matches_json():
+    pytest.importorskip('orjson')
+    from serializers import serialize_json
+    data = {'fr': 'Données – été', 'null': None, 'flags': [True, False], 'bbox': [-141.0, 41.68, -52.62, 83.11],
+            'nested': {'list': [[1, 2.5], []], 'empty': {}}, 'quote': 'a "b" \\ c\n'}
+    assert serialize_json(data, backend='auto') == serialize_json(data, backend='json')
+    # orjson writes the exponents without a sign and padding (1e-7, 1.5e300), the values are the same
+    floats = [1e-07, 1.5e+300, 0.1 + 0.2]
+    assert json.loads(serialize_json(floats, backend='auto')) == floats
+    # Integers larger than 64 bits fall back to the json module
+    assert serialize_json({'n': 2 ** 70}, backend='auto') == serialize_json({'n': 2 ** 70}, backend='json')
+
+
+@pytest.mark.parametrize('encoding', ['gzip', 'zstd'])
+def test_encoded_body_round_trip(encoding):
+    if encoding == 'zstd':
+        pytest.importorskip('zstandard')
+    from serializers import decode_body, encode_body, serialize_json
+    body = serialize_json({'id': 'record', 'title': 'Données synthétiques ' * 50})
+    encoded, content_encoding = encode_body(body, encoding)
+    assert content_encoding == encoding
+    assert len(encoded) < len(body)
+    # The output has no timestamp, an unchanged record keeps its ETag
+    assert encode_body(body, encoding) == (encoded, content_encoding)
+    assert decode_body(encoded, content_encoding) == body
+    # Without a Content-Encoding, the encoding is detected from the magic bytes
+    assert decode_body(encoded) == body
+    # A multipart gzip object is a concatenation of members
+    if encoding == 'gzip':
+        assert decode_body(encoded + encoded) == body + body
+
+
+def test_identity_body_is_not_decoded():
+    from serializers import decode_body, encode_body
+    assert encode_body(b'{"id":"record"}', 'identity') == (b'{"id":"record"}', None)
+    assert decode_body(b'{"id":"record"}') == b'{"id":"record"}'
+
+
+def test_gzip_records_read_back(harvest, s3, monkeypatch):
+    import serializers
+    from s3_operations import open_file_s3
+    harvest()
+    records = bucket_objects(s3)
+
+    monkeypatch.setattr(serializers, 'geocore_content_encoding', 'gzip')
+    harvest()
+    for key, body in records.items():
+        response = s3.get_object(Bucket=GEOCORE_BUCKET, Key=key)
+        assert response['ContentEncoding'] == 'gzip'
+        assert response['Body'].read() != body
+        assert open_file_s3(GEOCORE_BUCKET, key) == body.decode('utf-8')
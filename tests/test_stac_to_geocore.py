@@ -0,0 +1,49 @@
+"""The options builders map the STAC links and assets like the original per-record lookups"""
+import pytest
+
+
+def test_assets_options_follow_the_mappings():
+    from stac_to_geocore import assets_role, assets_tables, assets_to_properties_options, assets_type
+    assets = {
+        'cog': {'href': 'https://example.com/a.tif', 'type': 'image/tiff; application=geotiff; profile=cloud-optimized', 'roles': ['data'], 'title': 'Image/Image'},
+        'thumb': {'href': 'https://example.com/a.png', 'type': 'image/png', 'roles': ['thumbnail']},
+        'both': {'href': 'https://example.com/b.tif', 'type': 'image/tiff; application=geotiff', 'roles': ['data', 'overview']},
+        'other': {'href': 'https://example.com/c.bin', 'type': 'application/octet-stream', 'roles': []},
+    }
+    options = assets_to_properties_options(assets)
+    for asset, option in zip(assets.values(), options):
+        format = assets_type.get(asset['type'], 'Other')
+        type = assets_role.get(', '.join(asset['roles']), 'Other')
+        assert option['description'] == {
+            'en': f'{type};{format};eng',
+            'fr': f"{type if type != 'Other' else 'Autre'};{format if format != 'Other' else 'Autre'};fra"}
+    assert options[0]['name'] == {'en': 'Asset - Image', 'fr': 'Asset - Image'}
+    assert options[1]['name'] == {'en': 'Asset - Unknown', 'fr': 'Asset - Inconnu'}
+    # The compiled tables are shared by every record, they cannot be changed
+    formats, types = assets_tables
+    with pytest.raises(TypeError):
+        types[('data', 'overview')] = ('Data', 'Data')
+
+
+def test_dedup_options_keeps_the_order():
+    from stac_to_geocore import dedup_options
+
+    def option(url, name='Link'):
+        return {'url': url, 'protocol': 'Unknown', 'name': {'en': name, 'fr': name}, 'description': {'en': 'd', 'fr': 'd'}}
+    options = [option('a'), option('b'), option('a'), option('c'), option('b', 'Other name'), option('b')]
+    unique = dedup_options(options)
+    # The last occurrence of each option is kept, in the order of the list
+    assert [(o['url'], o['name']['en']) for o in unique] == [('a', 'Link'), ('c', 'Link'), ('b', 'Other name'), ('b', 'Link')]
+    assert unique[0] is options[2] and unique[-1] is options[5]
+    assert dedup_options([]) == []
+
+
+def test_dedup_options_matches_the_pairwise_comparison():
+    import random
+    from stac_to_geocore import dedup_options
+    random.seed(7)
+    options = [{'url': random.choice('abc'), 'protocol': random.choice([None, 'Unknown']), 'name': {'en': random.choice('xy'), 'fr': 'f'},
+                'description': {'en': 'd', 'fr': 'd'}} for _ in range(200)]
+    # Pairwise comparison: an option is dropped when an equal one comes later
+    expected = [o for i, o in enumerate(options) if o not in options[i + 1:]]
+    assert dedup_options(options) == expected
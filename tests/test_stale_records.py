@@ -0,0 +1,64 @@
+"""The records of the previous harvest that are gone upstream are deleted, the unchanged records are not written again"""
+import re
+
+import pytest
+import stac_server
+
+from conftest import GEOCORE_BUCKET, TEMPLATE_BUCKET, bucket_objects, manifest_keys
+
+
+def count_geocore_puts(s3_client):
+    """Return a list that gets the key of every PutObject sent to the GeoCore bucket"""
+    puts = []
+
+    def count(params, **kwargs):
+        if params.get('Bucket') == GEOCORE_BUCKET:
+            puts.append(params.get('Key'))
+    s3_client.meta.events.register('provide-client-params.s3.PutObject', count)
+    return puts
+
+
+@pytest.mark.parametrize('mode', ['incremental', 'dedup'])
+def test_stale_records_are_deleted(harvest, s3, stac_api, monkeypatch, mode):
+    import app
+    import upload_dedup
+    from s3_operations import get_s3_client
+    if mode == 'incremental':
+        monkeypatch.setattr(app, 'harvest_mode', 'incremental')
+    else:
+        monkeypatch.setattr(upload_dedup, 'upload_dedup_enabled', True)
+    harvest()
+    before = bucket_objects(s3)
+    assert len(before) == 27
+
+    # Items 9 to 11 of both collections are gone upstream
+    stac_api.handler.catalog = stac_server.SyntheticCatalog(collections=2, items=9, page_size=5)
+    puts = count_geocore_puts(get_s3_client())
+    harvest()
+    after = bucket_objects(s3)
+    gone = {key for key in before if re.search(r'-item-(9|10|11)\.geojson$', key)}
+    assert len(gone) == 6
+    assert set(after) == set(before) - gone
+    assert sorted(manifest_keys()) == sorted(after)
+    # The temporal extent of the collections changed with their items, the other records are not written again
+    changed = ['test-collection-0.geojson', 'test-collection-1.geojson']
+    assert sorted(puts) == changed
+    assert {key: body for key, body in after.items() if key not in changed} == {key: before[key] for key in after if key not in changed}
+
+
+def test_stale_keys():
+    from incremental import stale_keys
+    previous = ['a.geojson', 'b.geojson', 'c.geojson', 'b.geojson']
+    assert list(stale_keys(previous, {'b.geojson'})) == ['a.geojson', 'c.geojson']
+
+
+def test_unknown_keys_are_ignored(s3):
+    from incremental import IncrementalHarvest
+    incremental = IncrementalHarvest(bucket=TEMPLATE_BUCKET)
+    assert incremental.is_changed('test-item', 'test-item.geojson', {'id': 'test-item'})
+    incremental.mark_uploaded('test-item.geojson')
+    # A second call for the same key, or a key that never went through is_changed()
+    incremental.mark_uploaded('test-item.geojson')
+    incremental.mark_uploaded('test-root.geojson')
+    assert incremental.mark_failed('test-root.geojson') is None
+    assert list(incremental.current) == ['test-item']
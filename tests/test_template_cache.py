@@ -0,0 +1,21 @@
+"""A harvest without its GeoCore template stops before touching the records of the previous harvest"""
+import pytest
+
+from conftest import TEMPLATE_BUCKET, TEMPLATE_NAME, bucket_objects
+
+
+def test_missing_template_stops_the_handler(harvest, s3):
+    harvest()
+    records = bucket_objects(s3)
+    s3.delete_object(Bucket=TEMPLATE_BUCKET, Key=TEMPLATE_NAME)
+    with pytest.raises(RuntimeError, match=TEMPLATE_NAME):
+        harvest()
+    assert bucket_objects(s3) == records
+
+
+def test_copies_do_not_share_objects(s3):
+    from template_cache import copy_geocore_template, load_geocore_template
+    skeleton = load_geocore_template(TEMPLATE_BUCKET, TEMPLATE_NAME, ttl=0)
+    first = copy_geocore_template(skeleton)
+    first['properties']['id'] = 'changed'
+    assert copy_geocore_template(skeleton)['properties']['id'] != 'changed'
@@ -0,0 +1,82 @@
+"""The upload pipeline bounds the queued records, retries the failed uploads and reports the records it gave up on"""
+import threading
+
+import pytest
+
+from conftest import GEOCORE_BUCKET, bucket_objects
+
+
+@pytest.fixture
+def uploads(s3, monkeypatch):
+    """Wrap upload_file_s3 of the pipeline, return the attempts and the settings of the wrapper
+    uploads['fail'] attempts of every key fail before the real upload, uploads['gate'] holds the uploads until it is set
+    """
+    import upload_pipeline
+    upload_file_s3 = upload_pipeline.upload_file_s3
+    uploads = {'attempts': [], 'fail': 0, 'gate': threading.Event()}
+    uploads['gate'].set()
+
+    def upload(filename, **kwargs):
+        uploads['gate'].wait(5)
+        uploads['attempts'].append(filename)
+        if uploads['attempts'].count(filename) <= uploads['fail']:
+            return False
+        return upload_file_s3(filename, **kwargs)
+    monkeypatch.setattr(upload_pipeline, 'upload_file_s3', upload)
+    monkeypatch.setattr(upload_pipeline.time, 'sleep', lambda seconds: None)
+    return uploads
+
+
+def test_submit_blocks_while_the_queue_is_full(uploads, s3):
+    from upload_pipeline import UploadPipeline
+    uploads['gate'].clear()
+    with UploadPipeline(GEOCORE_BUCKET, max_workers=1, max_pending=2) as pipeline:
+        pipeline.submit('a.geojson', {'id': 'a'})
+        pipeline.submit('b.geojson', {'id': 'b'})
+        third = threading.Thread(target=pipeline.submit, args=('c.geojson', {'id': 'c'}))
+        third.start()
+        third.join(0.2)
+        assert third.is_alive()
+        uploads['gate'].set()
+        third.join(5)
+        assert not third.is_alive()
+        pipeline.drain()
+        assert pipeline.uploaded == 3
+    assert sorted(bucket_objects(s3)) == ['a.geojson', 'b.geojson', 'c.geojson']
+
+
+def test_failed_attempts_are_retried(uploads):
+    from upload_pipeline import UploadPipeline
+    uploads['fail'] = 1
+    logged = []
+    with UploadPipeline(GEOCORE_BUCKET, on_success=logged.append, max_attempts=3) as pipeline:
+        pipeline.submit('a.geojson', {'id': 'a'})
+    assert uploads['attempts'] == ['a.geojson', 'a.geojson']
+    assert (pipeline.uploaded, pipeline.failed, logged) == (1, [], ['a.geojson'])
+
+
+def test_upload_gives_up_after_max_attempts(uploads, s3):
+    from upload_pipeline import UploadPipeline
+    uploads['fail'] = 5
+    logged = []
+    with UploadPipeline(GEOCORE_BUCKET, on_success=logged.append, max_attempts=2) as pipeline:
+        pipeline.submit('a.geojson', {'id': 'a'})
+    assert uploads['attempts'] == ['a.geojson', 'a.geojson']
+    assert (pipeline.uploaded, pipeline.failed, logged) == (0, ['a.geojson'], [])
+    assert bucket_objects(s3) == {}
+
+
+def test_on_success_error_does_not_block_drain(uploads, caplog):
+    from upload_pipeline import UploadPipeline
+
+    def on_success(filename):
+        raise ValueError('manifest closed')
+    with UploadPipeline(GEOCORE_BUCKET, on_success=on_success) as pipeline:
+        pipeline.submit('a.geojson', {'id': 'a'})
+        drained = threading.Thread(target=pipeline.drain)
+        drained.start()
+        drained.join(5)
+        assert not drained.is_alive()
+    assert pipeline.uploaded == 1
+    assert 'manifest closed' in caplog.text
+